@@ -1,60 +1,312 @@
-import datetime as dt
+import atexit
+import email.utils
+import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import json
-from time import sleep
-
-with open('../data/api_key.txt', mode='r') as f:
-    API_KEY = f.read()
-
-API_URL = 'https://api.wolvesville.com/'
+import os
+import threading
+from collections import OrderedDict
+from time import perf_counter, sleep, time
+from metrics import METRICS
+import logs
+
+try:  # the bot's key, never committed (see .gitignore), main refuses to run without it
+    with open('../data/api_key.txt', mode='r') as f:
+        API_KEY = f.read().strip()
+except FileNotFoundError:
+    API_KEY = None
+
+try:  # a local stand-in server can be used by putting its url into api_url.txt
+    with open('../data/api_url.txt', mode='r') as f:
+        API_URL = f.read().strip()
+except FileNotFoundError:
+    API_URL = 'https://api.wolvesville.com/'
 HEADERS = {"Content-Type": "application/json",
            "Accept": "application/json",
            "Authorization": f'Bot {API_KEY}'}
 
+TIMEOUT = (5, 30)  # (connect, read) seconds
+POOL_SIZE = 16  # keep-alive connections kept open to the API host
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds, doubled on every attempt
+BACKOFF_CAP = 30  # seconds, upper bound of a single backoff (Retry-After is honored as is)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+LOG = logs.get('api')
+
+
+class RequestBudget:
+    """Token bucket limiting the rate of requests sent by all threads together."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.last = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+BUDGET = None  # RequestBudget shared by every request, None for no limit
+
+
+def create_session(pool_size: int = POOL_SIZE) -> requests.Session:
+    """Returns a session whose connections are pooled and kept alive between requests."""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+SESSION = create_session()
+
+
+def configure(timeout: tuple = None, pool_size: int = None, max_retries: int = None,
+              requests_per_second: float = None, api_key: str = None):
+    """Changes transport settings, the session is recreated if the pool size changes."""
+    global TIMEOUT, POOL_SIZE, MAX_RETRIES, SESSION, BUDGET, API_KEY
+    if api_key is not None:
+        API_KEY = api_key
+        HEADERS['Authorization'] = f'Bot {API_KEY}'
+        SESSION.headers.update(HEADERS)
+    if requests_per_second is not None:
+        BUDGET = RequestBudget(requests_per_second)
+    if timeout is not None:
+        TIMEOUT = timeout
+    if max_retries is not None:
+        MAX_RETRIES = max_retries
+    if pool_size is not None and pool_size != POOL_SIZE:
+        POOL_SIZE = pool_size
+        SESSION.close()
+        SESSION = create_session(pool_size)
+
+
+def retry_after(response: requests.Response):
+    """Returns the delay in seconds requested by the Retry-After header, or None if there is none."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        try:
+            return max(0., email.utils.parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def never_sent(err: requests.RequestException) -> bool:
+    """Whether a failed request never reached the API: connecting to it timed out or was refused."""
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    reason = err.args[0] if isinstance(err, requests.ConnectionError) and len(err.args) > 0 else None
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
 
 def generic_request(method: str, endpoint: str, params: dict = None, data: dict = None) -> requests.Response:
+    """Sends a request through the shared session.\n
+    Idempotent requests are retried on connection errors and on RETRY_STATUSES. Non-idempotent ones (POST) are only
+    retried when they could not have been processed: the connection timed out or was refused, or the API answered 429.
+    Raises the last connection error once MAX_RETRIES is exhausted, a response with an error status is returned.
+    Every call and attempt is recorded in METRICS."""
     data = json.dumps(data)
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    attempt = 0
     while True:
+        if BUDGET is not None:
+            BUDGET.acquire()
+        start = perf_counter()
         try:
-            response = requests.request(method, f'{API_URL}{endpoint}', headers=HEADERS, params=params, data=data)
-            return response
-        except Exception as err:
-            print(f'Connection error: {err}, request args: method: {method}, endpoint: {endpoint}, params: {params}, data: {data}, retrying in 5 seconds...')
-            sleep(5)
+            response = SESSION.request(method, f'{API_URL}{endpoint}', params=params, data=data, timeout=TIMEOUT)
+        except requests.RequestException as err:
+            METRICS.attempt(method, endpoint, err, perf_counter() - start)
+            if attempt >= MAX_RETRIES or not (idempotent or never_sent(err)):
+                METRICS.call(method, endpoint, attempt + 1)
+                raise
+            delay = backoff(attempt)
+            LOG.warning('Connection error: %s, request args: method: %s, endpoint: %s, params: %s, data: %s, retrying in %s seconds...', err, method, endpoint, params, data, round(delay, 2))
+        else:
+            METRICS.attempt(method, endpoint, response.status_code, perf_counter() - start, len(response.content))
+            if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES or not (idempotent or response.status_code == 429):
+                METRICS.call(method, endpoint, attempt + 1)
+                return response
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff(attempt)
+            LOG.warning('HTTP %s, request args: method: %s, endpoint: %s, params: %s, data: %s, retrying in %s seconds...', response.status_code, method, endpoint, params, data, round(delay, 2))
+        attempt += 1
+        sleep(delay)
+
+
+CACHE_FILE = '../data/api_cache.json'
+CACHE_SIZE = 64 * 2**20  # bytes of response bodies kept, least recently used ones are evicted first
+CACHE_MAX_STALE = 7 * 86400  # seconds past ttl during which a stale response is served while it's being refreshed
+CACHE_FLUSH_INTERVAL = 60  # seconds between writes of the cache file, it's written at exit too
+CACHE_TTLS = {  # seconds a response is considered fresh, looked up by the longest matching endpoint prefix
+    'items/': 86400,
+    'clans/quests/all': 86400,
+    'roleRotations': 3600,
+    'battlePass/season': 6 * 3600,
+}
+
+
+def body_size(content: str) -> int:
+    """Returns the bytes of a cached response body, which is kept as text."""
+    return len(content.encode('utf-8'))
+
+
+class ResponseCache:
+    """LRU cache of successful GET responses, persisted to disk so cold starts don't touch the network.\n
+    A fresh entry is returned as is. A stale one is returned immediately while a background thread refreshes it
+    (stale-while-revalidate), unless it's more than CACHE_MAX_STALE past its ttl, then it's refetched synchronously.\n
+    Stored responses are written to disk at most every CACHE_FLUSH_INTERVAL seconds and at exit, outside of the lock."""
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.changed = False  # entries stored since the file was last written
+        self.flushed = time()
+        self.file_lock = threading.Lock()  # serializes writes of the file
+        self.entries = OrderedDict()  # endpoint -> {'t': fetch time, 'c': response body}, least recently used first
+        try:
+            with open(path, mode='r') as file:
+                self.entries.update(json.load(file))
+        except (FileNotFoundError, ValueError):
+            pass
+        self.size = sum(body_size(e['c']) for e in self.entries.values())  # bytes of the bodies, as the API sent them
+
+    def get(self, endpoint: str, ttl: float) -> requests.Response:
+        with self.lock:
+            entry = self.entries.get(endpoint)
+            if entry is not None:
+                self.entries.move_to_end(endpoint)
+                age = time() - entry['t']
+                if age < ttl:
+                    METRICS.cache_hit(endpoint)
+                    return self.response(endpoint, entry['c'])
+                if age < ttl + CACHE_MAX_STALE:
+                    METRICS.cache_hit(endpoint)
+                    if endpoint not in self.refreshing:
+                        self.refreshing.add(endpoint)
+                        threading.Thread(target=self.refresh, args=(endpoint, ), daemon=True).start()
+                    return self.response(endpoint, entry['c'])
+        return self.fetch(endpoint)
+
+    def fetch(self, endpoint: str) -> requests.Response:
+        response = generic_request('GET', endpoint)
+        if response.status_code == 200:
+            self.store(endpoint, response.text)
+        return response
+
+    def refresh(self, endpoint: str):
+        try:
+            self.fetch(endpoint)
+        except requests.RequestException as err:
+            LOG.warning('Cache refresh of %s failed: %s', endpoint, err)
+        finally:
+            with self.lock:
+                self.refreshing.discard(endpoint)
+
+    def store(self, endpoint: str, content: str):
+        with self.lock:
+            if endpoint in self.entries:
+                self.size -= body_size(self.entries.pop(endpoint)['c'])
+            self.entries[endpoint] = {'t': time(), 'c': content}
+            self.size += body_size(content)
+            while self.size > self.max_size and len(self.entries) > 1:
+                self.size -= body_size(self.entries.popitem(last=False)[1]['c'])
+            self.changed = True
+        if time() - self.flushed >= CACHE_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Writes the entries to the cache file if any were stored since it was last written."""
+        with self.file_lock:
+            with self.lock:
+                if not self.changed:
+                    return
+                content = json.dumps(self.entries)
+                self.changed, self.flushed = False, time()
+            with open(f'{self.path}.tmp', mode='w') as file:
+                file.write(content)
+            os.replace(f'{self.path}.tmp', self.path)
+
+    @staticmethod
+    def response(endpoint: str, content: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = f'{API_URL}{endpoint}'
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response._content = content.encode('utf-8')
+        return response
+
+
+CACHE = ResponseCache(CACHE_FILE, CACHE_SIZE)
+atexit.register(CACHE.flush)
+
+
+def cached_request(endpoint: str) -> requests.Response:
+    """GET request served from CACHE, with the ttl configured for the endpoint in CACHE_TTLS."""
+    ttl = max(((p, t) for p, t in CACHE_TTLS.items() if endpoint.startswith(p)), key=lambda x: len(x[0]), default=('', 0))[1]
+    return CACHE.get(endpoint, ttl)
 
 
 class Items:
     @staticmethod
     def avatar_items() -> requests.Response:
         """Returns all available avatar items, such as hats, shirts, etc."""
-        return generic_request('GET', 'items/avatarItems')
+        return cached_request('items/avatarItems')
 
     @staticmethod
     def avatar_item_sets() -> requests.Response:
         """Avatar item sets are collections of avatar items and are generally referred to as "outfits" or "skins"."""
-        return generic_request('GET', 'items/avatarItemSets')
+        return cached_request('items/avatarItemSets')
 
     @staticmethod
     def avatar_item_collections() -> requests.Response:
         """Returns all collections of single avatar items."""
-        return generic_request('GET', 'items/avatarItemCollections')
+        return cached_request('items/avatarItemCollections')
 
     @staticmethod
     def profile_icons() -> requests.Response:
         """Returns all available profile icons. Icons in-game are rendered using various icon fonts,
         in most cases Font Awesome."""
-        return generic_request('GET', 'items/profileIcons')
+        return cached_request('items/profileIcons')
 
     @staticmethod
     def emojis() -> requests.Response:
         """Returns all available emotes. The urlAnimation points to a lottie json file and contains the actual
         animation."""
-        return generic_request('GET', 'items/emojis')
+        return cached_request('items/emojis')
 
     @staticmethod
     def emoji_collections() -> requests.Response:
         """Returns all available emote collections."""
-        return generic_request('GET', 'items/emojiCollections')
+        return cached_request('items/emojiCollections')
 
     @staticmethod
     def backgrounds() -> requests.Response:
@@ -62,35 +314,35 @@ class Items:
         and backgroundColorNight to render the final image.\n
         imageDaySmall and imageNightSmall return the images used in-game. The other images are used for inventory,
         dashboard, etc. In-game images have a smaller resolution and fewer details."""
-        return generic_request('GET', 'items/backgrounds')
+        return cached_request('items/backgrounds')
 
     @staticmethod
     def loading_screens() -> requests.Response:
         """Returns all available loading screens."""
-        return generic_request('GET', 'items/loadingScreens')
+        return cached_request('items/loadingScreens')
 
     @staticmethod
     def role_icons() -> requests.Response:
         """Returns all available role icons."""
-        return generic_request('GET', 'items/roleIcons')
+        return cached_request('items/roleIcons')
 
     @staticmethod
     def advanced_role_card_offers() -> requests.Response:
         """Returns all available advanced role card offers. Offers might not be available in the shop and might not
         be purchasable."""
-        return generic_request('GET', 'items/advancedRoleCardOffers')
+        return cached_request('items/advancedRoleCardOffers')
 
     @staticmethod
     def roses() -> requests.Response:
         """Returns all available roses. SINGLE_ROSE is a single rose that can be sent between two players. SERVER_ROSE
         is a rose bouquet which will send one rose to all players in a game."""
-        return generic_request('GET', 'items/roses')
+        return cached_request('items/roses')
 
     @staticmethod
     def talismans() -> requests.Response:
         """Returns all available talismans. If a talisman is marked as deprecated that talisman can no longer
         be obtained."""
-        return generic_request('GET', 'items/talismans')
+        return cached_request('items/talismans')
 
     @staticmethod
     def redeem_api_hat() -> requests.Response:
@@ -104,14 +356,14 @@ class RoleRotations:
     def current_role_rotation() -> requests.Response:
         """Returns current live role rotations. Possible game modes are quick, sandbox, advanced, ranked-league-silver,
         ranked-league-gold and crazy-fun (limited event-like games)."""
-        return generic_request('GET', 'roleRotations')
+        return cached_request('roleRotations')
 
 
 class BattlePass:
     @staticmethod
     def current_season() -> requests.Response:
         """Returns the current battle pass season."""
-        return generic_request('GET', 'battlePass/season')
+        return cached_request('battlePass/season')
 
     @staticmethod
     def challenges() -> requests.Response:
@@ -280,7 +532,7 @@ class Clans:
     @staticmethod
     def all_quests() -> requests.Response:
         """Returns all clan quests, regardless of if they can be bought."""
-        return generic_request('GET', f'clans/quests/all')
+        return cached_request('clans/quests/all')
 
     @staticmethod
     def authorized() -> requests.Response:
@@ -289,14 +541,6 @@ class Clans:
         return generic_request('GET', f'clans/authorized')
 
 
-def str_to_dt(string: str) -> dt.datetime:
-    return dt.datetime.strptime(string, '%Y-%m-%dT%H:%M:%S.%fZ')
-
-
-def dt_to_str(date: dt.datetime) -> str:
-    return dt.datetime.strftime(date, '%Y-%m-%dT%H:%M:%S.%fZ')
-
-
 if __name__ == '__main__':
     from pprint import pprint
     pprint(Clans.available_quests('87c636c9-8e27-401d-a8bc-426aff2eceea').json())
@@ -0,0 +1,217 @@
+import asyncio
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import api_interface
+from api_interface import Items, RoleRotations, BattlePass, Shop, Players, Clans
+
+# Requests are run on the pooled keep-alive session of api_interface (with its retry policy), one worker thread per
+# pooled connection, so the amount of requests in flight never exceeds the size of the connection pool. Change the
+# pool size through this module's configure(), which resizes both.
+POOL_SIZE = api_interface.POOL_SIZE
+EXECUTOR = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='api')
+
+
+def configure(pool_size: int = None, **settings):
+    """Works like `api_interface.configure()`, but also resizes the worker pool. The previous pool isn't shut down, so
+    requests already submitted to it (even concurrently) complete, its threads exit once it's unreferenced."""
+    global POOL_SIZE, EXECUTOR
+    api_interface.configure(pool_size=pool_size, **settings)
+    if pool_size is not None and pool_size != POOL_SIZE:
+        POOL_SIZE = pool_size
+        EXECUTOR = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='api')
+
+
+async def run(endpoint, *args, **kwargs) -> requests.Response:
+    """Runs a synchronous endpoint method without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(EXECUTOR, partial(endpoint, *args, **kwargs))
+
+
+async def gather(*aws, limit: int = None, return_exceptions: bool = False) -> list:
+    """Works like `asyncio.gather()`, but no more than `limit` (the pool size by default) awaitables are awaited at
+    once. Results are returned in the order of the arguments."""
+    semaphore = asyncio.Semaphore(POOL_SIZE if limit is None else limit)
+
+    async def limited(aw):
+        async with semaphore:
+            return await aw
+    return await asyncio.gather(*(limited(aw) for aw in aws), return_exceptions=return_exceptions)
+
+
+def run_all(*aws, limit: int = None, return_exceptions: bool = False) -> list:
+    """Synchronous entry point: awaits all awaitables with bounded concurrency and returns their results in order."""
+    return asyncio.run(gather(*aws, limit=limit, return_exceptions=return_exceptions))
+
+
+class AsyncItems:
+    @staticmethod
+    async def avatar_items() -> requests.Response:
+        return await run(Items.avatar_items)
+
+    @staticmethod
+    async def avatar_item_sets() -> requests.Response:
+        return await run(Items.avatar_item_sets)
+
+    @staticmethod
+    async def avatar_item_collections() -> requests.Response:
+        return await run(Items.avatar_item_collections)
+
+    @staticmethod
+    async def profile_icons() -> requests.Response:
+        return await run(Items.profile_icons)
+
+    @staticmethod
+    async def emojis() -> requests.Response:
+        return await run(Items.emojis)
+
+    @staticmethod
+    async def emoji_collections() -> requests.Response:
+        return await run(Items.emoji_collections)
+
+    @staticmethod
+    async def backgrounds() -> requests.Response:
+        return await run(Items.backgrounds)
+
+    @staticmethod
+    async def loading_screens() -> requests.Response:
+        return await run(Items.loading_screens)
+
+    @staticmethod
+    async def role_icons() -> requests.Response:
+        return await run(Items.role_icons)
+
+    @staticmethod
+    async def advanced_role_card_offers() -> requests.Response:
+        return await run(Items.advanced_role_card_offers)
+
+    @staticmethod
+    async def roses() -> requests.Response:
+        return await run(Items.roses)
+
+    @staticmethod
+    async def talismans() -> requests.Response:
+        return await run(Items.talismans)
+
+    @staticmethod
+    async def redeem_api_hat() -> requests.Response:
+        return await run(Items.redeem_api_hat)
+
+
+class AsyncRoleRotations:
+    @staticmethod
+    async def current_role_rotation() -> requests.Response:
+        return await run(RoleRotations.current_role_rotation)
+
+
+class AsyncBattlePass:
+    @staticmethod
+    async def current_season() -> requests.Response:
+        return await run(BattlePass.current_season)
+
+    @staticmethod
+    async def challenges() -> requests.Response:
+        return await run(BattlePass.challenges)
+
+
+class AsyncShop:
+    @staticmethod
+    async def active_offers() -> requests.Response:
+        return await run(Shop.active_offers)
+
+
+class AsyncPlayers:
+    @staticmethod
+    async def by_id(player_id: str) -> requests.Response:
+        return await run(Players.by_id, player_id)
+
+    @staticmethod
+    async def by_username(username: str) -> requests.Response:
+        return await run(Players.by_username, username)
+
+
+class AsyncClans:
+    @staticmethod
+    async def search(name: str, join_type: str = None, language: str = None, not_full: bool = None,
+                     exact_name: bool = None, min_level_min: int = None, min_level_max: int = None,
+                     sort_by: str = None) -> requests.Response:
+        return await run(Clans.search, name, join_type, language, not_full, exact_name, min_level_min, min_level_max,
+                         sort_by)
+
+    @staticmethod
+    async def info(clan_id: str) -> requests.Response:
+        return await run(Clans.info, clan_id)
+
+    @staticmethod
+    async def members(clan_id: str) -> requests.Response:
+        return await run(Clans.members, clan_id)
+
+    @staticmethod
+    async def member(clan_id: str, member_id: str) -> requests.Response:
+        return await run(Clans.member, clan_id, member_id)
+
+    @staticmethod
+    async def set_participation(clan_id: str, member_id: str, new_value: bool) -> requests.Response:
+        return await run(Clans.set_participation, clan_id, member_id, new_value)
+
+    @staticmethod
+    async def chat(clan_id: str, last_date: str = None) -> requests.Response:
+        return await run(Clans.chat, clan_id, last_date)
+
+    @staticmethod
+    async def send_message(clan_id: str, message: str) -> requests.Response:
+        return await run(Clans.send_message, clan_id, message)
+
+    @staticmethod
+    async def ledger(clan_id: str) -> requests.Response:
+        return await run(Clans.ledger, clan_id)
+
+    @staticmethod
+    async def logs(clan_id: str) -> requests.Response:
+        return await run(Clans.logs, clan_id)
+
+    @staticmethod
+    async def available_quests(clan_id: str) -> requests.Response:
+        return await run(Clans.available_quests, clan_id)
+
+    @staticmethod
+    async def shuffle_quests(clan_id: str) -> requests.Response:
+        return await run(Clans.shuffle_quests, clan_id)
+
+    @staticmethod
+    async def buy_quest(quest_id: str, clan_id: str) -> requests.Response:
+        return await run(Clans.buy_quest, quest_id, clan_id)
+
+    @staticmethod
+    async def active_quest(clan_id: str) -> requests.Response:
+        return await run(Clans.active_quest, clan_id)
+
+    @staticmethod
+    async def skip_waiting(clan_id: str) -> requests.Response:
+        return await run(Clans.skip_waiting, clan_id)
+
+    @staticmethod
+    async def claim_more_time(clan_id: str) -> requests.Response:
+        return await run(Clans.claim_more_time, clan_id)
+
+    @staticmethod
+    async def cancel_quest(clan_id: str) -> requests.Response:
+        return await run(Clans.cancel_quest, clan_id)
+
+    @staticmethod
+    async def quest_history(clan_id: str) -> requests.Response:
+        return await run(Clans.quest_history, clan_id)
+
+    @staticmethod
+    async def all_quests() -> requests.Response:
+        return await run(Clans.all_quests)
+
+    @staticmethod
+    async def authorized() -> requests.Response:
+        return await run(Clans.authorized)
+
+
+if __name__ == '__main__':
+    from pprint import pprint
+    info, quest = run_all(AsyncClans.info('87c636c9-8e27-401d-a8bc-426aff2eceea'),
+                          AsyncClans.active_quest('87c636c9-8e27-401d-a8bc-426aff2eceea'))
+    pprint(info.json()); pprint(quest.json())
@@ -0,0 +1,169 @@
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timezone
+import clock
+from balances import LEGACY_TIMES
+from clock import SECOND, HOUR, DAY
+from storage import apply
+
+BASE_INTERVAL = HOUR  # between full snapshots, cycles in between are stored as deltas against the last one
+DELTA_RETENTION = DAY  # deltas are kept for, older bases can only be restored as they were when taken
+HOURLY_RETENTION = DAY  # every base is kept for
+DAILY_RETENTION = 30 * DAY  # the first base of every UTC day is kept for, older ones are deleted
+
+
+class BackupStore:
+    """
+    Compressed backups of the state.
+
+    A full gzip snapshot (base) is taken every BASE_INTERVAL, every cycle in between appends the journaled
+    operations of that cycle to the delta file of the current base. Bases are listed in index.json, so neither saving
+    nor retention needs to scan the directory. Any point covered by a base and its deltas can be restored.
+
+    Only the state dict is backed up. The balance history (balances.jsonl, or the balance_events table of state.db)
+    and the stat history (history.bin) are append-only stores kept next to it, see the module's `restore` for how
+    they relate to a restored state. Times are epoch milliseconds of the bot's clock.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index_path = f'{directory}/index.json'
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path, 'r') as file:
+                self.index = json.load(file)  # [{'t': base time, 'base': file name, 'delta': file name or None}]
+        except FileNotFoundError:
+            self.index = []
+        for entry in self.index:
+            entry['t'] = ms(entry['t'])
+
+    def add(self, data: dict, ops: list, now: int = None):
+        """Backs up a cycle, `ops` being the journal operations that cycle committed."""
+        now = clock.now() if now is None else now
+        if len(self.index) == 0 or now - self.index[-1]['t'] >= BASE_INTERVAL:
+            self.new_base(data, now)
+        elif len(ops) > 0:
+            with gzip.open(f'{self.directory}/{self.index[-1]["delta"]}', 'at') as file:  # one gzip member per cycle
+                file.write(json.dumps([now, ops]) + '\n')
+
+    def new_base(self, data: dict, now: int):
+        name = datetime.fromtimestamp(now / SECOND, timezone.utc).strftime('%Y-%m-%d-%H-%M-%S')
+        with gzip.open(f'{self.directory}/{name}.json.gz', 'wt') as file:
+            file.write(json.dumps(data))
+        self.index.append({'t': now, 'base': f'{name}.json.gz', 'delta': f'{name}.delta.gz'})
+        self.retain(now)
+        self.save_index()
+
+    def retain(self, now: int):
+        """Applies the retention policy: deltas for a day, every base for a day, one base per day for a month."""
+        kept, days = [], set()
+        for entry in self.index:
+            age = now - entry['t']
+            day = entry['t'] // DAY
+            keep = age < HOURLY_RETENTION or (age < DAILY_RETENTION and day not in days)
+            days.add(day)
+            if keep:
+                if age >= DELTA_RETENTION and entry['delta'] is not None:
+                    self.remove(entry['delta'])
+                    entry['delta'] = None
+                kept.append(entry)
+            else:
+                self.remove(entry['base'])
+                if entry['delta'] is not None:
+                    self.remove(entry['delta'])
+        self.index = kept
+
+    def remove(self, name: str):
+        try:
+            os.remove(f'{self.directory}/{name}')
+        except FileNotFoundError:
+            pass
+
+    def save_index(self):
+        with open(f'{self.index_path}.tmp', 'w') as file:
+            json.dump(self.index, file)
+        os.replace(f'{self.index_path}.tmp', self.index_path)
+
+    def points(self) -> list:
+        """Returns (base time, time of the latest delta) for every retained base."""
+        points = []
+        for entry in self.index:
+            last = entry['t']
+            for t, _ in self.deltas(entry):
+                last = t
+            points.append((entry['t'], last))
+        return points
+
+    def deltas(self, entry: dict):
+        if entry['delta'] is None:
+            return
+        try:
+            with gzip.open(f'{self.directory}/{entry["delta"]}', 'rt') as file:
+                for line in file:
+                    try:
+                        t, ops = json.loads(line)
+                    except ValueError:  # torn write of the last cycle
+                        return
+                    yield ms(t), ops
+        except (FileNotFoundError, EOFError):
+            return
+
+    def restore(self, t: int) -> dict:
+        """Rebuilds the state as it was at time `t` from the latest base taken before it and its deltas. The balance
+        and stat histories aren't part of it."""
+        entries = [entry for entry in self.index if entry['t'] <= t]
+        if len(entries) == 0:
+            raise ValueError('no backup that old is retained')
+        with gzip.open(f'{self.directory}/{entries[-1]["base"]}', 'rt') as file:
+            data = json.load(file)
+        for delta_t, ops in self.deltas(entries[-1]):
+            if delta_t > t:
+                break
+            apply(data, ops)
+        return data
+
+
+def ms(t):
+    """Returns a backup time in epoch milliseconds, converting the epoch seconds of older backups."""
+    return int(t * SECOND) if t < LEGACY_TIMES else t
+
+
+def restore(directory: str, t: int):
+    """Replaces the state of the clan in `directory` (the bot must be stopped) with its backup at time `t`, through the
+    clan's own storage. The balance events made after it are dropped along with the balances: balances.jsonl is
+    truncated to the restored `balancesSize`, or they are deleted from state.db. The stat history (history.bin) keeps
+    what happened after `t`."""
+    from main import Clan
+    from sqlite_storage import SqliteStorage
+    storage = Clan('', directory).storage
+    data = BackupStore(f'{directory}/backups').restore(t)
+    storage.load()
+    if isinstance(storage, SqliteStorage):
+        data.pop('balancesSize', None)
+        storage.connection.execute('DELETE FROM balance_events WHERE t > ?', (t, ))  # committed with the state
+    elif 'balancesSize' in data:
+        storage.ledger.truncate(data['balancesSize'])
+    storage.commit(data)
+
+
+def parse_time(string: str) -> int:
+    return clock.parse(f'{string}Z')
+
+
+def format_time(t: int) -> str:
+    return clock.format(t)[:19]
+
+
+if __name__ == '__main__':
+    # python backups.py list [clan directory, ../data by default, ../data/clans/<clan id> in supervisor mode]
+    # python backups.py restore YYYY-MM-DDTHH:MM:SS (UTC) [clan directory], with the bot stopped
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'restore':
+        restore(sys.argv[3] if len(sys.argv) > 3 else '../data', parse_time(sys.argv[2]))
+        print(f'State restored to {sys.argv[2]}, balance events made since were dropped, the stat history was kept')
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == 'list':
+        for start, end in BackupStore(f'{sys.argv[2] if len(sys.argv) > 2 else "../data"}/backups').points():
+            print(f'{format_time(start)} - {format_time(end)}')
+    else:
+        print('usage: backups.py list [directory] | backups.py restore YYYY-MM-DDTHH:MM:SS [directory]')
@@ -0,0 +1,142 @@
+import datetime as dt
+import json
+import os
+import re
+from bisect import bisect_left, bisect_right
+import clock
+
+# Balance events are records of (time, member id, gold, gems, reason, counterparty id or None), time being in epoch
+# milliseconds like every time of the bot (see clock). Reasons are short codes such as 'donate', 'quest', 'quest skip', 'weekly exp', 'voted quest
+# not joined', and 'to' / 'from' for transfers, whose counterparty is the other member.
+LEGACY_TIMES = 10**11  # times below this are the epoch seconds of older files, converted when they are loaded
+
+
+def legacy(event: tuple) -> tuple:
+    """Returns the event with its time in milliseconds, if it was stored in seconds."""
+    return (event[0] * clock.SECOND, ) + event[1:] if event[0] < LEGACY_TIMES else event
+
+
+class BalanceLedger:
+    """
+    Append-only history of balance changes, indexed by member and time.
+
+    Events are kept in memory per member in chronological order, so a member's history can be paged through or cut
+    by time without scanning anyone else's. Appended events are pending until `sync()` writes them to a JSON-lines
+    file, or `discard()` drops them along with the rest of a failed cycle. Without a path, nothing is persisted.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.file = None
+        self.load()
+
+    def load(self):
+        self.events = {}  # member id -> [event, ...], oldest first
+        self.times = {}  # member id -> [time of event, ...], parallel to events
+        self.pending = []
+        self.size = 0  # bytes of the file as of the last sync
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'rb') as file:
+                for line in file:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        self.index(legacy(tuple(json.loads(line))))
+                    except ValueError:  # torn write of the last events, everything after it is discarded
+                        break
+                    self.size += len(line)
+            if self.size != os.path.getsize(self.path):
+                os.truncate(self.path, self.size)
+        except FileNotFoundError:
+            pass
+        self.file = open(self.path, 'ab')
+
+    def index(self, event: tuple):
+        events, times = self.events.setdefault(event[1], []), self.times.setdefault(event[1], [])
+        i = bisect_right(times, event[0])
+        events.insert(i, event)
+        times.insert(i, event[0])
+
+    def append(self, member_id: str, gold: int, gems: int, reason: str, counterparty: str = None, t: float = None):
+        event = (clock.now() if t is None else int(t), member_id, gold, gems, reason, counterparty)
+        self.index(event)
+        self.pending.append(event)
+
+    def sync(self):
+        """Makes pending events durable."""
+        if self.file is not None and len(self.pending) > 0:
+            lines = ''.join(json.dumps(event) + '\n' for event in self.pending).encode('utf-8')
+            self.file.write(lines)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(lines)
+        self.pending = []
+
+    def truncate(self, size: int):
+        """Drops the events synced once the file was `size` bytes long, e.g. those of a cycle whose state wasn't
+        committed."""
+        if self.file is not None and size < self.size:
+            self.file.close()
+            os.truncate(self.path, size)
+            self.load()
+
+    def discard(self):
+        """Forgets pending events."""
+        for event in self.pending:
+            events, times = self.events[event[1]], self.times[event[1]]
+            i = events.index(event)
+            del events[i], times[i]
+        self.pending = []
+
+    def history(self, member_id: str, page: int = 1, per_page: int = 10, since: float = None,
+                until: float = None) -> list:
+        """Returns a page of a member's events, newest first, optionally limited to the time range [since, until)."""
+        events, times = self.events.get(member_id, []), self.times.get(member_id, [])
+        start = 0 if since is None else bisect_left(times, since)
+        end = len(events) if until is None else bisect_left(times, until)
+        end = max(start, end - (page - 1) * per_page)
+        return events[max(start, end - per_page):end][::-1]
+
+    def count(self, member_id: str) -> int:
+        return len(self.events.get(member_id, []))
+
+
+LEGACY_ENTRY = re.compile(r'^(\d\d)\.(\d\d) (?:0|(?:(-?\d+) gold)?(?: and )?(?:(-?\d+) gems)?) (.*)$')
+
+
+def last_activity(data: dict) -> int:
+    """Returns the newest time the state records (epoch milliseconds, after clock.migrate_times), the clock's time if
+    it records none."""
+    times = [data.get(key) for key in ('lastChatUpdate', 'availableQuestsLastUpdate', 'lastWeeklyExpCheck')]
+    times.append(data.get('qm', {}).get('since'))
+    times = [t for t in times if isinstance(t, int)]
+    return max(times) if len(times) > 0 else clock.now()
+
+
+def migrate_history(data: dict, ledger: BalanceLedger, now: int = None):
+    """Moves the old 10-entry string histories ('03.24 -500 gold quest') of data['b'] into the ledger. The year of
+    those entries isn't known, the latest one not after `now` (the state's last activity by default) is assumed."""
+    now = dt.datetime.utcfromtimestamp((last_activity(data) if now is None else now) // clock.SECOND)
+    for m_id in data['b']:
+        if 'hi' not in data['b'][m_id]:
+            continue
+        for entry in data['b'][m_id]['hi'][::-1]:
+            match = LEGACY_ENTRY.match(entry)
+            if match is None:
+                continue
+            month, day, gold, gems, comment = match.groups()
+            try:
+                date = dt.datetime(now.year, int(month), int(day))
+                if date > now:
+                    date = date.replace(year=now.year - 1)
+            except ValueError:  # 29th of February
+                date = dt.datetime(now.year, int(month), 28)
+            counterparty = None
+            if comment.startswith(('to :P_ID:', 'from :P_ID:')):
+                comment, counterparty = comment.split(' :P_ID:')
+            ledger.append(m_id, int(gold or 0), int(gems or 0), comment, counterparty,
+                          int(date.replace(tzinfo=dt.timezone.utc).timestamp()) * clock.SECOND)
+        del data['b'][m_id]['hi']
+        data.touch('b', m_id)
@@ -0,0 +1,157 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import tempfile
+import tracemalloc
+from time import perf_counter, sleep
+import api_interface
+import clock
+import logs
+from api_interface import RequestBudget, ResponseCache
+from clock import ManualClock, SECOND, DAY
+from main import Clan
+from mock_api import MockClan, MockServer, synthetic
+
+# Replays simulated days of a clan through Clan.step (main's loop without the sleeping) against a local mock API
+# driven by a ManualClock, and reports what the bot costs: requests, wall time, bytes, memory and persistence I/O.
+# Run from the source directory (the mock API takes any key, no ../data/api_key.txt is needed):
+#   python benchmark.py [--days 7] [--members 45] [--chat-rate 20] [--donation-rate 4] [--activity 0.5]
+#                       [--fixture file] [--storage json|sqlite] [--trace-memory] [--json report file]
+
+START = clock.parse('2024-01-01T00:00:00.000Z')  # a Monday, so that every weekday of a week is replayed
+
+
+class Discard:
+    """Stdout replacement swallowing what the bot still prints, which would otherwise add to wall time and I/O."""
+
+    def write(self, text: str) -> int:
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def process_io() -> dict:
+    """Returns the bytes and calls the process wrote through write(), which the bot only uses for persistence while its
+    logs are discarded (Linux only, empty elsewhere)."""
+    try:
+        with open('/proc/self/io', 'r') as file:
+            return {k: int(v) for k, v in (line.split(': ') for line in file)}
+    except OSError:
+        return {}
+
+
+def directory_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def benchmark(fixture: dict, days: float = 7, storage: str = 'json', trace_memory: bool = False) -> dict:
+    directory = tempfile.mkdtemp(prefix='clan-benchmark-')
+    manual = ManualClock(START)
+    clock.use(manual)
+    server = MockServer(MockClan(fixture))
+    server.start()
+    api_interface.API_URL = server.url
+    api_interface.configure(api_key='benchmark')
+    api_interface.CACHE = ResponseCache(f'{directory}/api_cache.json', api_interface.CACHE_SIZE)
+    if storage == 'sqlite':
+        open(f'{directory}/state.db', 'w').close()  # Clan uses SqliteStorage if there is a state.db
+    clan = Clan(fixture['clan']['id'], directory)
+    clan.outbox.budget = RequestBudget(1000, 1000)  # the chat rate limit is real time, which isn't simulated
+    logs.start(None, console=False)  # records are still queued, so the cycles pay what logging costs the bot
+    if trace_memory:
+        tracemalloc.start()
+    io_before, requests, durations, failures = process_io(), [], [], 0
+    start = perf_counter()
+    with contextlib.redirect_stdout(Discard()):
+        clan.start()
+        while manual.now() < START + days * DAY:
+            before, cycle_start = server.total(), perf_counter()
+            delay = clan.step()
+            failures += clan.failures > 0
+            durations.append(perf_counter() - cycle_start)
+            requests.append(server.total() - before)
+            manual.advance(int(delay * SECOND))
+        while len(clan.outbox.pending) > 0 and perf_counter() - start < 3600:
+            sleep(0.01)
+        logs.stop()
+    wall = perf_counter() - start
+    io_after = process_io()
+    report = {
+        'days': days, 'storage': storage, 'members': len(fixture['members']), 'rates': fixture['rates'],
+        'cycles': len(requests),
+        'failed cycles': failures,
+        'requests': server.total(),
+        'requests per cycle': {'mean': server.total() / max(1, len(requests)), 'p50': percentile(requests, 0.5),
+                               'p95': percentile(requests, 0.95), 'max': max(requests, default=0)},
+        'requests by endpoint': dict(sorted(server.requests.items(), key=lambda x: -x[1])),
+        'wall seconds': wall,
+        'cycle milliseconds': {'mean': 1000 * sum(durations) / max(1, len(durations)),
+                               'p50': 1000 * percentile(durations, 0.5), 'p95': 1000 * percentile(durations, 0.95),
+                               'max': 1000 * max(durations, default=0)},
+        'bytes received': server.sent,
+        'bytes sent': server.received,
+        'peak rss kilobytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # mock server included
+        'persistence': {'bytes written': io_after.get('wchar', 0) - io_before.get('wchar', 0),
+                        'write calls': io_after.get('syscw', 0) - io_before.get('syscw', 0),
+                        'bytes on disk': directory_size(directory)},
+    }
+    if trace_memory:
+        report['peak traced bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    server.shutdown()
+    shutil.rmtree(directory, ignore_errors=True)
+    return report
+
+
+def render(report: dict) -> str:
+    per_cycle, cycle_ms, persistence = report['requests per cycle'], report['cycle milliseconds'], report['persistence']
+    lines = [
+        f"{report['days']} days of a {report['members']}-member clan ({report['storage']} storage), rates: {report['rates']}",
+        f"cycles: {report['cycles']}, failed: {report['failed cycles']}",
+        f"requests: {report['requests']}, per cycle: mean {per_cycle['mean']:.2f}, p50 {per_cycle['p50']}, "
+        f"p95 {per_cycle['p95']}, max {per_cycle['max']}",
+        f"wall time: {report['wall seconds']:.2f} s, per cycle: mean {cycle_ms['mean']:.2f} ms, p50 {cycle_ms['p50']:.2f} ms, "
+        f"p95 {cycle_ms['p95']:.2f} ms, max {cycle_ms['max']:.2f} ms",
+        f"bytes received: {report['bytes received']}, sent: {report['bytes sent']}",
+        f"peak rss: {report['peak rss kilobytes']} kB" +
+        (f", peak traced: {report['peak traced bytes']} B" if 'peak traced bytes' in report else ''),
+        f"persistence: {persistence['bytes written']} B in {persistence['write calls']} writes, "
+        f"{persistence['bytes on disk']} B on disk",
+        'requests by endpoint:',
+    ]
+    lines += [f'  {count:8d} {endpoint}' for endpoint, count in report['requests by endpoint'].items()]
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays simulated days of a clan against a local mock API.')
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--members', type=int, default=45)
+    parser.add_argument('--chat-rate', type=float, default=20, help='chat messages per hour')
+    parser.add_argument('--donation-rate', type=float, default=4, help='donations per hour')
+    parser.add_argument('--activity', type=float, default=0.5, help='games per member per hour')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixture', help='recorded fixture (see mock_api.py record) instead of a synthetic clan')
+    parser.add_argument('--storage', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--trace-memory', action='store_true', help='also trace peak Python memory (slower)')
+    parser.add_argument('--json', help='file to write the report to, e.g. as a baseline to compare later runs with')
+    args = parser.parse_args()
+    if args.fixture is not None:
+        with open(args.fixture, 'r') as fixture_file:
+            clan_fixture = json.load(fixture_file)
+    else:
+        clan_fixture = synthetic(args.members, args.chat_rate, args.donation_rate, args.activity, args.seed)
+    result = benchmark(clan_fixture, args.days, args.storage, args.trace_memory)
+    print(render(result))
+    if args.json is not None:
+        with open(args.json, 'w') as report_file:
+            json.dump(result, report_file, indent=2)
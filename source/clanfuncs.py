@@ -1,123 +1,356 @@
-from api_interface import Clans, Players, str_to_dt, dt_to_str
-from myfuncs import dmerge, plist
+from api_interface import Clans, Players
+from async_api_interface import AsyncPlayers, AsyncClans, run_all
+from commands import command, handle, Arg, CommandError, INT, STR, TEXT
+from myfuncs import plist, chunks
+from diff import merge, publish, subscribe, UPDATED, REMOVED
+from storage import SPLIT_SECTIONS
+from events import EventBus, handles, DonationReceived, QuestShuffled, QuestBought, AvailableQuestsChanged, QuestStarted, \
+    QuestFinished, TierStarted, TierFinished, MemberJoined, ChatCommand
+from names import NameIndex
+from balances import BalanceLedger
+from timeseries import TimeSeries
+from leaderboards import Leaderboards, WINDOWS, BOARDS, RANKED_STATS, amounts
+from outbox import Outbox
 import datetime as dt
+import requests
+from contextlib import contextmanager
+from bisect import bisect_left
+from logging import DEBUG, INFO
+import clock
+import logs
+from clock import SECOND, MINUTE, HOUR, DAY, WEEK
 
+PROFILE_WORKERS = 8  # maximum amount of player profiles fetched at once
+HISTORY_PAGE = 10  # balance history entries per page of /balance_history
+CHAT_BATCH = 20  # chat messages handled between two checkpoints of the chat cursor
+LEDGER_OVERLAP = 5 * MINUTE  # ledger entries this much older than the ledger cursor are still told apart by id
+TOP_SIZE = 5  # members listed by /top
+NEVER = float('inf')  # deadline of a stage that has nothing to do until an event wakes it
+PARTICIPATION_WORKERS = 8  # maximum amount of quest participation changes sent at once
+PARTICIPATION_ATTEMPTS = 3  # times an unconfirmed quest participation change is sent
 
-def log(msg: str):
-    print(f'{dt.datetime.utcnow()} {msg}')
 
+class ParticipationError(Exception):
+    pass
 
-def clan_checkup(data: dict, clan_id: str):
-    data['nicks_updated'] = False
+
+CLAN, STATS, QUEST, BALANCE, CHAT = (logs.get(c) for c in ('clan', 'stats', 'quest', 'balance', 'chat'))
+
+
+def log_change(logger, level: int, owner, stat: str, change, **fields):
+    """Logs a Change of `owner`'s stat (the clan's if None), as a difference if the values are numbers."""
+    if not logger.isEnabledFor(level):
+        return
+    subject, old, new = 'Clan' if owner is None else f'{owner}\'s', change.old, change.new
+    fields = {**fields, 'stat': stat, 'old': old, 'new': new}
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)) and not isinstance(new, bool):
+        logger.log(level, '%s %s changed by %s (now %s)', subject, stat, new - old, new, extra={'fields': fields})
+    else:
+        logger.log(level, '%s %s changed from %s to %s', subject, stat, old, new, extra={'fields': fields})
+
+
+def start_cycle(data: dict):
     data['request_counter'] = 0
-    data['new_ledger_entries'] = []
 
-    update_info(data, clan_id)
-    update_chat(data)
-    if 'currentQuest' not in data or not ('code' in data['currentQuest'] and 'code' == 404):
-        update_current_quest(data)
-    if 'availableQuests' not in data or (dt.datetime.utcnow().weekday() == 1 and str_to_dt(data['availableQuestsLastUpdate']).date() != dt.datetime.utcnow().date()):
-        update_available_quests(data, shuffled=False)
-    quest_management(data)
-    joining_fees(data)
-    weekly_exp(data)
 
-    del data['new_ledger_entries']
-    del data['nicks_updated']
+STAGES = {}  # name -> (stage, deadline), in the order they are run
+
+
+def stage(name: str, deadline):
+    """Registers the decorated function as a stage of the clan management. `manage` runs it once an event handler
+    woke it (see wake) or once `deadline(data)` came, the next moment at which it has something to do on its own."""
+    def register(run):
+        STAGES[name] = (run, deadline)
+        return run
+    return register
+
+
+def due_stages(data: dict) -> dict:
+    """Returns when every stage is due (name -> time), all of them right away once the state was (re)loaded."""
+    if 'stages' not in data.derived:
+        data.derived['stages'] = {name: 0 for name in STAGES}
+    return data.derived['stages']
+
+
+def wake(data: dict, name: str, at: int = 0):
+    """Makes a stage run no later than `at`, on the next tick by default."""
+    due = due_stages(data)
+    due[name] = min(due[name], at)
+
+
+def manage(data: dict):
+    if 'participation' in data:  # a participation change was interrupted by a crash
+        restore_participation(data)
+    due = due_stages(data)
+    for name, (run, deadline) in STAGES.items():
+        if due[name] <= clock.now():
+            due[name] = NEVER  # wakes by the events of the run are kept
+            run(data)
+            due[name] = min(due[name], deadline(data))
+
+
+def next_deadline(data: dict):
+    """Returns the earliest moment at which `manage` has something to do without anything being polled."""
+    return min(due_stages(data).values())
+
+
+def resume(data: dict):
+    """Emits the events that happened before the state was loaded and are still waited for, i.e. a finished quest tier."""
+    quest = data.get('currentQuest', {})
+    if quest.get('tierFinished'):
+        emit(data, TierFinished(quest['tier'], clock.parse(quest['tierEndTime'])))
+
+
+@subscribe('**')
+def touch_changed(data: dict, changes: list):
+    """Marks the storage units of the changes as touched."""
+    for change in changes:
+        data.touch(*change.path[:2 if change.path[0] in SPLIT_SECTIONS else 1])
+
+
+@subscribe('**')
+def log_clan_change(data: dict, changes: list):
+    for change in changes:
+        if change.kind == UPDATED and change.path[0] not in ('m', 'currentQuest'):  # those have loggers of their own
+            log_change(CLAN, INFO, None, change.key, change)
+
+
+@subscribe('m.*.**')
+def log_member_change(data: dict, changes: list):
+    if not STATS.isEnabledFor(DEBUG):
+        return
+    for change in changes:
+        if change.kind == UPDATED:
+            m_id, stat = change.path[1], change.path[2:]
+            label = f'"{stat[3]}" role points' if stat[:3] == ('p', 'gameStats', 'achievements') else stat[-1]
+            log_change(STATS, DEBUG, data['m'][m_id]['username'], label, change, member=m_id)
+
+
+def leaves(path: tuple, value):
+    """Yields the paths and values of the leaves of a value at `path`, the value itself if it's not a dict."""
+    if not isinstance(value, dict):
+        yield path, value
+        return
+    for key, nested in value.items():
+        yield from leaves(path + (key, ), nested)
+
+
+@subscribe('m.*.**')
+def record_member_stats(data: dict, changes: list):
+    """Records the changed xp, level and game stats of members in the stat history, and ranks them."""
+    snapshots = {}  # member id -> {stat: value}
+    for change in changes:
+        if change.kind == REMOVED:
+            continue
+        for path, value in leaves(change.path, change.new):
+            m_id, stat = path[1], path[2:]
+            if stat[:2] == ('p', 'gameStats'):
+                stat = '.'.join(stat[1:])
+            elif stat in (('xp', ), ('level', )):
+                stat = stat[0]
+            else:
+                continue
+            if isinstance(value, int) and not isinstance(value, bool):
+                snapshots.setdefault(m_id, {})[stat] = value
+    for m_id, values in snapshots.items():
+        rank(data, m_id, stat_history(data).record(m_id, values))
+
+
+@subscribe('currentQuest.**')
+def log_quest_change(data: dict, changes: list):
+    quest = data['currentQuest']
+    for change in changes:
+        if change.kind != UPDATED:
+            continue
+        stat = '.'.join(change.path[1:])
+        if stat == 'tierEndTime':
+            QUEST.info('Current quest\'s tierEndTime was reduced by %s, time left: %s', clock.duration(clock.parse(change.old)-clock.parse(change.new)), clock.duration(clock.parse(quest['tierEndTime'])-clock.now()))
+        elif stat == 'xp':
+            xp, progress = change.new-change.old, quest['xp']-quest['xpPerReward']*quest['tier']
+            QUEST.info('Current quest\'s xp was changed by %s (%s%%), quest progress - %s/%s (%s%%)', xp, round(xp/quest['xpPerReward']*100, 2), progress, quest['xpPerReward'], round(progress/quest['xpPerReward']*100, 2))
+        else:
+            QUEST.info('Current quest\'s %s changed from %s to %s', stat, change.old, change.new)
 
 
 def update_info(data: dict, clan_id: str):
-    changes = dmerge(data, Clans.info(clan_id).json()); data['request_counter'] += 1
-    for stat in changes['upd']:
-        try: log(f'Clan {stat} changed by {changes["upd"][stat]["new"]-changes["upd"][stat]["old"]} (now {changes["upd"][stat]["new"]})')
-        except TypeError: log(f'Clan {stat} changed from {changes["upd"][stat]["old"]} to {changes["upd"][stat]["new"]}')
-        if stat in ('xp', 'memberCount'):
-            update_members(data)
-        elif stat in ('gold', 'gems'):
-            update_ledger(data)
+    changes = publish(data, merge(data, Clans.info(clan_id).json())); data['request_counter'] += 1
+    changed = {change.path[0] for change in changes if change.kind == UPDATED}
+    if changed & {'xp', 'memberCount'}:
+        update_members(data)
+    if changed & {'gold', 'gems'}:
+        update_ledger(data)
+    return len(changes) > 0
 
 
 def update_members(data: dict):
     if 'm' not in data:
         data['m'] = {}
     new = {m['playerId']: m for m in Clans.members(data['id']).json() if m['status'] == 'ACCEPTED'}; data['request_counter'] += 1
+    refresh = []  # members whose profiles have to be updated, in the order of the members list
     for m_id in list(data['m']):  # Member removal
         if m_id not in new:
-            log(f'{data["m"][m_id]["username"]} ({m_id}) has been removed from the clan')
-            del data['m'][m_id]
+            CLAN.info('%s (%s) has been removed from the clan', data['m'][m_id]['username'], m_id, extra={'fields': {'member': m_id}})
+            if 'leaderboards' in data.derived: data.derived['leaderboards'].remove(m_id)
+            names(data).remove(m_id); data.touch('fn')
+            del data['m'][m_id]; data.touch('m', m_id)
     for m_id in new:
         for stat in list(new[m_id]):  # removing unwanted data from request before saving
             if stat not in ("participateInClanQuests", "username", "xp", "level", ):
                 del new[m_id][stat]
         if m_id not in data['m']:  # Member addition
-            data['m'][m_id] = new[m_id]
-            data['m'][m_id]['unpaid_joining_fee'] = {'since': dt_to_str(dt.datetime.utcnow()), 'paid': 0}
-            log(f'{new[m_id]["username"]} ({m_id}) has been added to the clan')
+            publish(data, merge(data['m'], {m_id: new[m_id]}, ('m', )))
+            names(data).add(m_id, new[m_id]['username']); data.touch('fn')
+            CLAN.info('%s (%s) has been added to the clan', new[m_id]['username'], m_id, extra={'fields': {'member': m_id}})
+            emit(data, MemberJoined(m_id))
         else:  # Member update
-            changes = dmerge(data['m'][m_id], new[m_id])
-            for stat in changes['upd']:
-                try: log(f'{new[m_id]["username"]}\'s {stat} changed by {changes["upd"][stat]["new"]-changes["upd"][stat]["old"]} (now {changes["upd"][stat]["new"]})')
-                except TypeError: log(f'{new[m_id]["username"]}\'s {stat} changed from {changes["upd"][stat]["old"]} to {changes["upd"][stat]["new"]}')
-                if stat == 'xp':
-                    update_player(data, m_id)
-    data['nicks_updated'] = True
+            changed = {change.path[2] for change in publish(data, merge(data['m'][m_id], new[m_id], ('m', m_id)))}
+            if 'username' in changed: names(data).add(m_id, new[m_id]['username'])
+            if 'xp' in changed: refresh.append(m_id)
+    if len(refresh) > 0:  # profiles are fetched concurrently, but merged and logged one by one in a stable order
+        profiles = run_all(*(AsyncPlayers.by_id(m_id) for m_id in refresh), limit=PROFILE_WORKERS); data['request_counter'] += len(refresh)
+        for m_id, profile in zip(refresh, profiles):
+            update_player(data, m_id, profile.json())
 
 
-def update_player(data: dict, player_id: str):
+def update_player(data: dict, player_id: str, new: dict = None):
     if 'p' not in data['m'][player_id]:
-        data['m'][player_id]['p'] = {'gameStats': {'achievements': {}}}
-    new = Players.by_id(player_id).json(); data['request_counter'] += 1
-    if 'gameStats' in data['m'][player_id]['p']:
-        new['gameStats']['achievements'] = {a['roleId']: a['points'] for a in new['gameStats']['achievements'] if a['level'] != 9}  # removing unwanted data from request before saving
-        changes = dmerge(data['m'][player_id]['p']['gameStats']['achievements'], new['gameStats']['achievements'])
-        for stat in changes['upd']:  # Tracking player achievement changes
-            log(f'{data["m"][player_id]["username"]}\'s "{stat}" role points changed by {changes["upd"][stat]["new"] - changes["upd"][stat]["old"]} (now {changes["upd"][stat]["new"]})')
-        changes = dmerge(data['m'][player_id]['p']['gameStats'], new['gameStats'])
-        for stat in changes['upd']:  # Tracking player game stats changes
-            if stat != 'achievements':
-                log(f'{data["m"][player_id]["username"]}\'s {stat} changed by {changes["upd"][stat]["new"] - changes["upd"][stat]["old"]} (now {changes["upd"][stat]["new"]})')
-    for stat in list(new):  # removing unwanted data from request before saving
-        if stat not in ('gameStats', ):
-            del new[stat]
-    changes = dmerge(data['m'][player_id]['p'], new)
-    for stat in changes['upd']:  # Tracking player changes
-        if stat not in ('gameStats',):
-            try: log(f'{data["m"][player_id]["username"]}\'s {stat} changed by {changes["upd"][stat]["new"] - changes["upd"][stat]["old"]} (now {changes["upd"][stat]["new"]})')
-            except TypeError: log(f'{data["m"][player_id]["username"]}\'s {stat} changed from {changes["upd"][stat]["old"]} to {changes["upd"][stat]["new"]}')
+        data['m'][player_id]['p'] = {}; data.touch('m', player_id)
+    if new is None:
+        new = Players.by_id(player_id).json(); data['request_counter'] += 1
+    new = {'gameStats': new['gameStats']} if 'gameStats' in new else {}  # removing unwanted data from request before saving
+    if 'gameStats' in new:  # roles at the last level don't earn points anymore
+        new['gameStats']['achievements'] = {a['roleId']: a['points'] for a in new['gameStats']['achievements'] if a['level'] != 9}
+    publish(data, merge(data['m'][player_id]['p'], new, ('m', player_id, 'p'), prune=True))
+
+
+def ledger_time(entry: dict) -> int:
+    return clock.parse(entry['creationTime'])
+
+
+def unprocessed(page: list, since: int, seen: set) -> tuple:
+    """Returns the entries of a ledger page (newest first) that weren't processed yet, and whether the page reaches
+    back to the ledger cursor. Entries older than the cursor by more than LEDGER_OVERLAP count as processed, the
+    others unless their ids were recorded."""
+    for i, entry in enumerate(page):
+        if ledger_time(entry) < since - LEDGER_OVERLAP:
+            return [e for e in page[:i] if e['id'] not in seen], True
+    return [e for e in page if e['id'] not in seen], len(page) > 0 and ledger_time(page[-1]) <= since
+
+
+def seek_ledger(data: dict, page: list):
+    """Puts the ledger cursor of a first run at the newest entry of the page, which is taken as processed as a whole.
+    The id cursor of older states is put at the time of its entry, or at the newest one if it isn't on the page."""
+    ids = [entry['id'] for entry in page]
+    cursor = data.get('lastLedgerUpdate')
+    if cursor in ids:
+        processed = page[ids.index(cursor):]
+    else:
+        if cursor is not None:
+            BALANCE.warning('Ledger entry %s isn\'t on the ledger page anymore, the page is taken as processed', cursor)
+        processed = page
+    newest = ledger_time(processed[0])
+    data['ledgerSeen'] = [[entry['id'], ledger_time(entry)] for entry in processed if ledger_time(entry) >= newest - LEDGER_OVERLAP]
+    data['lastLedgerUpdate'] = newest
 
 
 def update_ledger(data: dict):
-    ledger = Clans.ledger(data['id']).json(); data['request_counter'] += 1
-    if 'lastLedgerUpdate' not in data: data['lastLedgerUpdate'] = ledger[1]['id']
-    for entry in ledger:
-        if entry['id'] != data['lastLedgerUpdate']: data['new_ledger_entries'].append(entry)
-        else: break
-    data['lastLedgerUpdate'] = ledger[0]['id']
-    for entry in data['new_ledger_entries'][::-1]:
-        if entry['type'] == 'DONATE': change_balance(data, entry['playerId'], 'donate', entry['gold'], entry['gems'])
-        elif entry['type'] == 'CLAN_QUEST': update_current_quest(data)
-        elif entry['type'] == 'CLAN_QUEST_SHUFFLE': update_available_quests(data, shuffled=True)
+    """Processes the ledger entries made since the ledger cursor, each of them exactly once: the cursor and the ids of
+    the entries around it are saved along with what the entries changed."""
+    page = Clans.ledger(data['id']).json(); data['request_counter'] += 1
+    if len(page) == 0:
+        return False
+    if not isinstance(data.get('lastLedgerUpdate'), int):
+        seek_ledger(data, page)
+    since = data['lastLedgerUpdate']
+    entries, reached = unprocessed(page, since, {entry_id for entry_id, _ in data.get('ledgerSeen', [])})
+    if not reached:
+        BALANCE.warning('The ledger page doesn\'t reach back to its cursor (%s), entries made before %s were missed',
+                        clock.format(since), clock.format(ledger_time(page[-1])))
+    if len(entries) == 0:
+        return False
+    newest = max(since, max(ledger_time(entry) for entry in entries))
+    data.mark()
+    seen = [[entry['id'], ledger_time(entry)] for entry in entries] + data.get('ledgerSeen', [])
+    data['ledgerSeen'] = [[entry_id, t] for entry_id, t in seen if t >= newest - LEDGER_OVERLAP]
+    data['lastLedgerUpdate'] = newest
+    events = []
+    for entry in entries[::-1]:
+        if entry['type'] == 'DONATE': events.append(DonationReceived(entry['id'], entry['playerId'], entry['gold'], entry['gems']))
+        elif entry['type'] == 'CLAN_QUEST': events.append(QuestBought())
+        elif entry['type'] == 'CLAN_QUEST_SHUFFLE': events.append(QuestShuffled())
+    emit(data, *events)
+    data.checkpoint()  # donations are never credited twice nor skipped after a crash
+    return True
+
+
+@handles(QuestBought)
+def quest_bought(data: dict, event: QuestBought):
+    update_current_quest(data)
+
+
+@handles(QuestShuffled)
+def quests_shuffled(data: dict, event: QuestShuffled):
+    update_available_quests(data, shuffled=True)
+
+
+@handles(QuestStarted, QuestFinished, TierStarted, TierFinished, AvailableQuestsChanged, DonationReceived)
+def wake_quest_management(data: dict, event):
+    """Besides its deadlines, the quest management acts upon quest progress, other available quests and gold (which
+    decides whether the wait of a finished tier is skipped)."""
+    wake(data, 'quest')
+
+
+def message_id(entry: dict) -> tuple:
+    return entry['date'], entry.get('playerId'), entry.get('msg')
+
+
+def unread(page: list, since: int, seen: set):
+    """Returns the messages of a chat page (newest first) that weren't handled yet, and whether the page reaches the
+    chat cursor. Messages sent at the cursor's time are told apart by their identity, all of them count as handled
+    if their identities weren't recorded (`seen` is None)."""
+    for i, entry in enumerate(page):
+        date = clock.parse(entry['date'])
+        if date < since or (date == since and (seen is None or message_id(entry) in seen)):
+            return page[:i], True
+    return page, False
+
+
+def chat_stream(data: dict, since: int, seen: set):
+    """Yields unread chat messages, oldest first. The chat can only be paged backwards, so it's paged back to the
+    cursor remembering only where the pages start, and the pages are then fetched again from the oldest one. Only a
+    page at a time is held besides the newest one, and backlogs that fit into a page cost no extra requests."""
+    newest = Clans.chat(data['id']).json(); data['request_counter'] += 1
+    starts = [None]  # 'oldest' parameter of every page back to the cursor, None for the newest one
+    page = newest
+    entries, reached = unread(page, since, seen)
+    while not reached and len(entries) > 0:
+        starts.append(page[-1]['date'])
+        page = Clans.chat(data['id'], starts[-1]).json(); data['request_counter'] += 1
+        entries, reached = unread(page, since, seen)
+    yield from reversed(entries)
+    for start in starts[-2::-1]:  # newer pages are unread as a whole
+        if start is None: page = newest
+        else: page = Clans.chat(data['id'], start).json(); data['request_counter'] += 1
+        yield from reversed(page)
 
 
 def update_chat(data: dict):
     if 'lastChatUpdate' not in data:
-        data['lastChatUpdate'] = dt_to_str(dt.datetime.utcnow())
-        return 1
-    unread_entries = []
-    chat = Clans.chat(data['id']).json(); data['request_counter'] += 1
-    while True:
-        if len(chat) > 0:
-            for entry in chat:
-                if str_to_dt(entry['date']) > str_to_dt(data['lastChatUpdate']):
-                    unread_entries.append(entry)
-                else: break
-            else:
-                chat = Clans.chat(data['id'], chat[-1]['date']).json(); data['request_counter'] += 1
-                continue
-        break
-    if len(unread_entries) > 0:
-        data['lastChatUpdate'] = unread_entries[0]['date']
-        for entry in unread_entries[::-1]: message_handler(data, entry)
+        data['lastChatUpdate'] = clock.now()
+        return 0
+    since = data['lastChatUpdate']
+    seen = set(map(tuple, data['chatSeen'])) if 'chatSeen' in data else None
+    handled = 0
+    for batch in chunks(chat_stream(data, since, seen), CHAT_BATCH):
+        data.mark()
+        for entry in batch: message_handler(data, entry)
+        last = clock.parse(batch[-1]['date'])
+        ids = [list(message_id(entry)) for entry in batch if entry['date'] == batch[-1]['date']]
+        data['chatSeen'] = ids + (data.get('chatSeen', []) if last == data['lastChatUpdate'] else [])
+        data['lastChatUpdate'] = last
+        data.checkpoint()  # handled commands are never replayed nor skipped after a crash
+        handled += len(batch)
+    return handled
 
 
 def update_current_quest(data: dict):
@@ -126,37 +359,48 @@ def update_current_quest(data: dict):
         del quest['participants'], quest['claimedTime'], quest['tierStartTime'], quest['quest']['rewards'], quest['quest']['promoImagePrimaryColor'], quest['quest']['promoImageUrl'], quest['quest']['id']
         if 'currentQuest' not in data: data['currentQuest'] = quest
         elif 'code' in data['currentQuest'] and data['currentQuest']['code'] == 404:
-            log('Quest was started')
+            QUEST.info('Quest was started')
             data['currentQuest'] = quest
+            emit(data, QuestStarted())
         elif 'quest' in data['currentQuest']:
-            changes = dmerge(data['currentQuest'], quest)
-            for stat in changes['upd']:
-                if stat == 'tierEndTime':
-                    log(f'Current quest\'s tierEndTime was reduced by {str_to_dt(changes["upd"][stat]["old"])-str_to_dt(changes["upd"][stat]["new"])}, time left: {dt.timedelta(seconds=(str_to_dt(quest["tierEndTime"])-dt.datetime.utcnow()).seconds)}')
-                    continue
-                elif stat == 'xp':
-                    log(f'Current quest\'s xp was changed by {changes["upd"][stat]["new"]-changes["upd"][stat]["old"]} ({round((changes["upd"][stat]["new"]-changes["upd"][stat]["old"])/quest["xpPerReward"]*100, 2)}%), quest progress - {quest["xp"]-quest["xpPerReward"]*quest["tier"]}/{quest["xpPerReward"]} ({round((quest["xp"]-quest["xpPerReward"]*quest["tier"])/quest["xpPerReward"]*100, 2)}%)')
-                    continue
-                log(f'Current quest\'s {stat} changed from {changes["upd"][stat]["old"]} to {changes["upd"][stat]["new"]}')
+            changes = publish(data, merge(data['currentQuest'], quest, ('currentQuest', )))
+            if len(changes) == 0: return False
+            changed = {change.path[1] for change in changes}
+            if quest['tierFinished'] and changed & {'tierFinished', 'tierEndTime'}:
+                emit(data, TierFinished(quest['tier'], clock.parse(quest['tierEndTime'])))
+            elif changed & {'tier', 'tierFinished'}:
+                emit(data, TierStarted(quest['tier']))
     elif 'code' in quest and quest['code'] == 404:
         if 'currentQuest' not in data: data['currentQuest'] = quest
         elif 'quest' in data['currentQuest']:
-            log('Quest was finished')
+            QUEST.info('Quest was finished')
             data['currentQuest'] = quest
+            emit(data, QuestFinished())
+        else: return False
+    return True
 
 
 def update_available_quests(data: dict, shuffled: bool):
     quests = Clans.available_quests(data['id']).json(); data['request_counter'] += 1
     quests = {quest['promoImageUrl'].split('/')[-1].split('.')[0]: {'id': quest['id'], 'purchasableWithGems': quest['purchasableWithGems']} for quest in quests}
-    if 'availableQuests' not in data:
-        data['availableQuests'] = quests
-        data['availableQuestsLastUpdate'] = dt_to_str(dt.datetime.utcnow())
-        return
-    if shuffled or list(quests) != list(data['availableQuests']):
-        data['availableQuestsLastUpdate'] = dt_to_str(dt.datetime.utcnow())
-        data['availableQuests'] = quests
+    if 'availableQuests' in data and not shuffled and list(quests) == list(data['availableQuests']):
+        return False
+    data['availableQuests'] = quests
+    data['availableQuestsLastUpdate'] = clock.now()
+    emit(data, AvailableQuestsChanged())
+    return True
+
+
+def quest_deadline(data: dict):
+    """Quest vote and quest start reminders and ends, else the next UTC midnight (no votes on Mondays, nor on Tuesdays
+    before the quests shuffle)."""
+    qm = data.get('qm', {'state': 'quest'})
+    if qm['state'] in ('vote', 'wait'):
+        return qm['since'] + (12-3*qm['reminders']) * HOUR if qm['reminders'] > 0 else qm['since'] + 12*HOUR
+    return clock.midnight(clock.now()) + DAY
 
 
+@stage('quest', quest_deadline)
 def quest_management(data: dict):
     if 'qm' not in data: data['qm'] = {'state': 'quest'}
     if data['qm']['state'] == 'quest':
@@ -165,20 +409,19 @@ def quest_management(data: dict):
         if (('code' in data['currentQuest'] and data['currentQuest']['code'] == 404) or
             (data['currentQuest']['tier'] == 5 and not data['currentQuest']['quest']['purchasableWithGems'] or
              data['currentQuest']['tier'] == 7 and data['currentQuest']['quest']['purchasableWithGems']) and
-                not data['currentQuest']['tierFinished']) and dt.datetime.utcnow().weekday() != 0:
+                not data['currentQuest']['tierFinished']) and clock.weekday(clock.now()) != 0:
             # IF IT'S TUESDAY, MAKE SURE QUESTS ARE ALREADY UPDATED
-            if dt.datetime.utcnow().weekday() != 1 or str_to_dt(data['availableQuestsLastUpdate']).date() == dt.datetime.utcnow().date():
+            if clock.weekday(clock.now()) != 1 or clock.midnight(data['availableQuestsLastUpdate']) == clock.midnight(clock.now()):
                 start_vote(data)
     elif data['qm']['state'] == 'vote':
-        count_votes(data)
-        if dt.datetime.utcnow() - str_to_dt(data["qm"]["since"]) >= dt.timedelta(hours=12-3*(data['qm']['reminders'])) and data['qm']['reminders'] > 0:
+        if clock.now() - data['qm']['since'] >= (12-3*data['qm']['reminders']) * HOUR and data['qm']['reminders'] > 0:
             vote_reminder(data)
-        if dt.datetime.utcnow() - str_to_dt(data["qm"]["since"]) >= dt.timedelta(hours=12):
+        if clock.now() - data['qm']['since'] >= 12*HOUR:
             finish_vote(data)
     elif data['qm']['state'] == 'wait':
-        if dt.datetime.utcnow() - str_to_dt(data["qm"]["since"]) >= dt.timedelta(hours=12-3*(data['qm']['reminders'])) and data['qm']['reminders'] > 0:
+        if clock.now() - data['qm']['since'] >= (12-3*data['qm']['reminders']) * HOUR and data['qm']['reminders'] > 0:
             quest_reminder(data)
-        if dt.datetime.utcnow() - str_to_dt(data["qm"]["since"]) >= dt.timedelta(hours=12):
+        if clock.now() - data['qm']['since'] >= 12*HOUR:
             start_quest(data)
 
 
@@ -189,9 +432,9 @@ def waiting_skipper(data: dict):
         bottom_limit_of_time_left_to_skip_in_hours = 36 - (18 * data['gold'] / 100000)
     else:
         bottom_limit_of_time_left_to_skip_in_hours = 48 - (24 * data['gold'] / 100000)
-    time_left = str_to_dt(data['currentQuest']['tierEndTime']) - dt.datetime.utcnow()
-    if time_left >= dt.timedelta(hours=bottom_limit_of_time_left_to_skip_in_hours):
-        Clans.skip_waiting(data['id'])
+    time_left = clock.parse(data['currentQuest']['tierEndTime']) - clock.now()
+    if time_left >= bottom_limit_of_time_left_to_skip_in_hours * HOUR:
+        Clans.skip_waiting(data['id']); data['request_counter'] += 1
         send_message(data, 'Quest waiting time has been skipped')
 
 
@@ -201,25 +444,26 @@ def start_vote(data: dict):
           'To vote for option N - donate N gold\n' \
           f'{options}\nVoting for a gem quest obliges you to join it'
     send_message(data, msg)
-    data['qm'] = {'state': 'vote', 'since': dt_to_str(dt.datetime.utcnow()), 'votes': {}, 'reminders': 3}
+    data['qm'] = {'state': 'vote', 'since': clock.now(), 'votes': {}, 'reminders': 3}
 
 
 def vote_reminder(data: dict):
     options = f'\n1. none, shuffle if wins\n'+'\n'.join([str(i+2)+'. '+q+(' (GEM)' if data['availableQuests'][q]['purchasableWithGems'] else '') for i, q in enumerate(list(data['availableQuests']))])+'\n'
-    msg = f'Quest vote ends in {dt.timedelta(seconds=(dt.timedelta(hours=12) - (dt.datetime.utcnow() - str_to_dt(data["qm"]["since"]))).seconds)}\n' \
+    msg = f'Quest vote ends in {clock.duration(data["qm"]["since"] + 12*HOUR - clock.now())}\n' \
           'To vote for option N - donate N gold\n' \
           f'{options}\nVoting for a gem quest obliges you to join it'
-    send_message(data, msg)
-    data['qm']['reminders'] -= 1
+    send_message(data, msg, key='vote reminder')
+    data['qm']['reminders'] -= 1; data.touch('qm')
 
 
-def count_votes(data: dict):
-    for entry in data['new_ledger_entries']:
-        if entry['type'] == 'DONATE':
-            if 1 < entry['gold'] < len(data['availableQuests'])+2:
-                data['qm']['votes'][entry['playerId']] = list(data['availableQuests'])[entry['gold']-2]
-            elif entry['gold'] == 1:
-                data['qm']['votes'][entry['playerId']] = 'none'
+@handles(DonationReceived)
+def count_vote(data: dict, event: DonationReceived):
+    if data.get('qm', {}).get('state') != 'vote':
+        return
+    if 1 < event.gold < len(data['availableQuests'])+2:
+        data['qm']['votes'][event.member_id] = list(data['availableQuests'])[event.gold-2]; data.touch('qm')
+    elif event.gold == 1:
+        data['qm']['votes'][event.member_id] = 'none'; data.touch('qm')
 
 
 def finish_vote(data: dict):
@@ -229,8 +473,8 @@ def finish_vote(data: dict):
         msg = f'Quest "{winner}" won the vote, the quest will be started in 12 hours'
         if data['availableQuests'][winner]['purchasableWithGems']: msg += f'\n{plist([id_to_nick(data, m_id) for m_id in voters])} voted for the quest and will either join it or lose 1000 gold from their balances'
         send_message(data, msg)
-        data['qm'] = {'state': 'wait', 'since': dt_to_str(dt.datetime.utcnow()), 'voters': voters, 'winner': winner, 'reminders': 3}
-    elif dt.datetime.utcnow().weekday() != 0:
+        data['qm'] = {'state': 'wait', 'since': clock.now(), 'voters': voters, 'winner': winner, 'reminders': 3}
+    elif clock.weekday(clock.now()) != 0:
         send_message(data, '"none" won the vote, quests will be shuffled and vote restarted')
         data['qm'] = {'state': 'quest'}
         shuffle_quests(data)
@@ -240,14 +484,72 @@ def finish_vote(data: dict):
 
 
 def shuffle_quests(data: dict):
-    disabled = []
-    for m_id in data['m']:
-        if data['m'][m_id]['participateInClanQuests']:
-            Clans.set_participation(data['id'], m_id, False); data['request_counter'] += 1
-            disabled.append(m_id)
-    Clans.shuffle_quests(data['id']); data['request_counter'] += 1
-    for m_id in disabled:
-        Clans.set_participation(data['id'], m_id, True); data['request_counter'] += 1
+    with participation(data, {m_id: False for m_id in data['m']}, temporary=True):
+        response = Clans.shuffle_quests(data['id']); data['request_counter'] += 1
+        response.raise_for_status()
+
+
+def confirmed(response, value: bool) -> bool:
+    """Tells whether a participation change request succeeded, the response being the changed member."""
+    if not isinstance(response, requests.Response) or not response.ok:
+        return False
+    try: return response.json().get('participateInClanQuests', value) == value
+    except ValueError: return True
+
+
+def apply_participation(data: dict, values: dict) -> list:
+    """Sends quest participation changes ({member id: participates}) concurrently, resending unconfirmed ones up to
+    PARTICIPATION_ATTEMPTS times. Confirmed values are stored in the members, returns the ids of the unconfirmed."""
+    todo = dict(values)
+    for _ in range(PARTICIPATION_ATTEMPTS):
+        if len(todo) == 0: break
+        ids = list(todo)
+        responses = run_all(*(AsyncClans.set_participation(data['id'], m_id, todo[m_id]) for m_id in ids), limit=PARTICIPATION_WORKERS, return_exceptions=True); data['request_counter'] += len(ids)
+        for m_id, response in zip(ids, responses):
+            if confirmed(response, todo[m_id]):
+                if m_id in data['m']:
+                    data['m'][m_id]['participateInClanQuests'] = todo[m_id]; data.touch('m', m_id)
+                del todo[m_id]
+    return list(todo)
+
+
+def restore_participation(data: dict):
+    """Sets everyone's participation back to what it was before the recorded participation change."""
+    failed = apply_participation(data, data['participation']['original'])
+    if len(failed) > 0:
+        QUEST.warning('Quest participation of %s couldn\'t be restored', plist([id_to_nick(data, m_id) for m_id in failed]))
+    del data['participation']
+
+
+@contextmanager
+def participation(data: dict, values: dict, temporary: bool = False):
+    """
+    Changes quest participation of members ({member id: participates}) for a with block.
+
+    The original and intended participation are recorded in the state (and checkpointed) before anything is sent, so
+    that an interrupted change is undone even after a crash. If any change can't be confirmed (ParticipationError) or
+    the with block fails, everyone's original participation is restored and the exception fails the cycle: nothing is
+    checkpointed then, the record left by the first checkpoint makes the next cycle restore it again. With `temporary`,
+    it's restored when the block ends in any case.
+    """
+    values = {m_id: v for m_id, v in values.items() if data['m'][m_id]['participateInClanQuests'] != v}
+    if len(values) == 0:
+        yield
+        return
+    data.mark()
+    data['participation'] = {'original': {m_id: not v for m_id, v in values.items()}, 'intended': values}
+    data.checkpoint()
+    try:
+        failed = apply_participation(data, values)
+        if len(failed) > 0:
+            raise ParticipationError(f'quest participation of {plist([id_to_nick(data, m_id) for m_id in failed])} couldn\'t be changed')
+        yield
+    except BaseException:
+        restore_participation(data)
+        raise
+    if temporary: restore_participation(data)
+    else: del data['participation']
+    data.checkpoint()
 
 
 def vote_result(data: dict):
@@ -266,7 +568,7 @@ def vote_result(data: dict):
 
 def quest_reminder(data: dict):
     okj, oks, off, kick = quest_check(data)
-    msg = f'Quest "{data["qm"]["winner"]}" will be started in {dt.timedelta(seconds=(dt.timedelta(hours=12) - (dt.datetime.utcnow() - str_to_dt(data["qm"]["since"]))).seconds)}'
+    msg = f'Quest "{data["qm"]["winner"]}" will be started in {clock.duration(data["qm"]["since"] + 12*HOUR - clock.now())}'
     disabled = []
     kicked = []
     for m_id in data['m']:
@@ -284,44 +586,59 @@ def quest_reminder(data: dict):
             if m_id not in okj: must_join_but_unpaid.append(data['m'][m_id]['username'])
         if len(must_join_but_unpaid) > 0:
             msg += f'\n\n{plist(must_join_but_unpaid)} voted for the gem quest but have yet to pay for joining or enable participation.'
-    send_message(data, msg)
-    data['qm']['reminders'] -= 1
+    send_message(data, msg, key='quest reminder')
+    data['qm']['reminders'] -= 1; data.touch('qm')
 
 
 def start_quest(data: dict):
+    """Buys the winning quest and charges the members for it. The purchase, the charges and the end of the vote are
+    checkpointed together right after it, so that the next cycle never buys the quest again. A 4xx
+    response while the winner is already the active quest (bought by a cycle that failed later on) counts as bought."""
     okj, oks, off, kick = quest_check(data)
-    qt = 'go' if not data['availableQuests'][data["qm"]["winner"]]['purchasableWithGems'] else 'ge'
-    msg = f'Quest "{data["qm"]["winner"]}" was started'
-    disabled = []
-    kicked = []
-    for m_id in data['m']:
-        if m_id in off:
-            disabled.append(data['m'][m_id]['username'])
-            change_balance(data, m_id, 'quest skip', -1*data['qc']['s'][qt][0], -1*data['qc']['s'][qt][1])
-            Clans.set_participation(data['id'], m_id, False); data['request_counter'] += 1
-        elif m_id in kick:
-            kicked.append(data['m'][m_id]['username'])
-            change_balance(data, m_id, 'quest skip', -1*data['qc']['s'][qt][0], -1*data['qc']['s'][qt][1])
-            Clans.set_participation(data['id'], m_id, False); data['request_counter'] += 1
-        elif m_id in okj:
-            change_balance(data, m_id, 'quest', -1*data['qc']['j'][qt][0], -1*data['qc']['j'][qt][1])
-        elif m_id in oks:
-            change_balance(data, m_id, 'quest skip', -1*data['qc']['s'][qt][0], -1*data['qc']['s'][qt][1])
-    if len(disabled) > 0:
-        msg += f'\n\n{plist(disabled)} couldn\'t afford joining and had their quest participation disabled.'
-    if len(kicked) > 0:
-        msg += f'\n\n{plist(kicked)} couldn\'t afford skipping nor joining and should now be kicked.'
-    if data['availableQuests'][data["qm"]["winner"]]['purchasableWithGems']:
-        must_join_but_unpaid = []
-        for m_id in data['qm']['voters']:
-            if m_id not in okj:
-                must_join_but_unpaid.append(data['m'][m_id]['username'])
-                change_balance(data, m_id, 'voted quest not joined', -1000)
-        if len(must_join_but_unpaid) > 0:
-            msg += f'\n\n{plist(must_join_but_unpaid)} voted for the gem quest but didn\'t join it and lost 1000 gold from their balances.'
-    Clans.buy_quest(data['availableQuests'][data["qm"]["winner"]]['id'], data['id'])
-    send_message(data, msg)
-    data['qm'] = {'state': 'quest'}
+    quest = data['availableQuests'][data["qm"]["winner"]]
+    qt = 'go' if not quest['purchasableWithGems'] else 'ge'
+    data.mark()
+    with participation(data, {m_id: False for m_id in off + kick}):  # before any balance changes
+        response = Clans.buy_quest(quest['id'], data['id']); data['request_counter'] += 1
+        if 400 <= response.status_code < 500 and active_quest_id(data) == quest['id']:
+            QUEST.warning('Quest "%s" was already bought', data["qm"]["winner"])
+        else:
+            response.raise_for_status()  # restores participation and fails the cycle before anyone is charged
+        msg = f'Quest "{data["qm"]["winner"]}" was started'
+        disabled = []
+        kicked = []
+        for m_id in data['m']:
+            if m_id in off:
+                disabled.append(data['m'][m_id]['username'])
+                change_balance(data, m_id, 'quest skip', -1*data['qc']['s'][qt][0], -1*data['qc']['s'][qt][1])
+            elif m_id in kick:
+                kicked.append(data['m'][m_id]['username'])
+                change_balance(data, m_id, 'quest skip', -1*data['qc']['s'][qt][0], -1*data['qc']['s'][qt][1])
+            elif m_id in okj:
+                change_balance(data, m_id, 'quest', -1*data['qc']['j'][qt][0], -1*data['qc']['j'][qt][1])
+            elif m_id in oks:
+                change_balance(data, m_id, 'quest skip', -1*data['qc']['s'][qt][0], -1*data['qc']['s'][qt][1])
+        if len(disabled) > 0:
+            msg += f'\n\n{plist(disabled)} couldn\'t afford joining and had their quest participation disabled.'
+        if len(kicked) > 0:
+            msg += f'\n\n{plist(kicked)} couldn\'t afford skipping nor joining and should now be kicked.'
+        if data['availableQuests'][data["qm"]["winner"]]['purchasableWithGems']:
+            must_join_but_unpaid = []
+            for m_id in data['qm']['voters']:
+                if m_id not in okj:
+                    must_join_but_unpaid.append(data['m'][m_id]['username'])
+                    change_balance(data, m_id, 'voted quest not joined', -1000)
+            if len(must_join_but_unpaid) > 0:
+                msg += f'\n\n{plist(must_join_but_unpaid)} voted for the gem quest but didn\'t join it and lost 1000 gold from their balances.'
+        send_message(data, msg)
+        data['qm'] = {'state': 'quest'}
+    data.checkpoint()
+
+
+def active_quest_id(data: dict):
+    """Returns the id of the clan's active quest, None if there is none."""
+    quest = Clans.active_quest(data['id']).json(); data['request_counter'] += 1
+    return quest['quest']['id'] if 'quest' in quest else None
 
 
 def quest_check(data: dict):
@@ -344,51 +661,140 @@ def quest_check(data: dict):
     return okj, oks, off, kick
 
 
+@handles(MemberJoined)
+def charge_joining_fee(data: dict, event: MemberJoined):
+    data['m'][event.member_id]['unpaid_joining_fee'] = {'since': clock.now(), 'paid': 0}; data.touch('m', event.member_id)
+    wake(data, 'fees', clock.now() + HOUR)
+
+
+@handles(DonationReceived)
+def pay_joining_fee(data: dict, event: DonationReceived):
+    if event.member_id in data['m'] and 'unpaid_joining_fee' in data['m'][event.member_id]:
+        fee = data['m'][event.member_id]['unpaid_joining_fee']
+        fee['paid'] += event.gold; data.touch('m', event.member_id)
+        if fee['paid'] >= data['qc']['j']['go'][0]:
+            del data['m'][event.member_id]['unpaid_joining_fee']
+            if 'kick_announced' in fee:
+                send_message(data, f'{id_to_nick(data, event.member_id)} paid for joining 1 gold quest and is not to be kicked anymore', key=f'joining fee {event.member_id}')
+
+
+def fee_deadline(data: dict):
+    """The first hour after joining of a member who didn't pay the joining fee ends."""
+    return min((member['unpaid_joining_fee']['since'] + HOUR for member in data['m'].values()
+                if 'unpaid_joining_fee' in member and 'kick_announced' not in member['unpaid_joining_fee']), default=NEVER)
+
+
+@stage('fees', fee_deadline)
 def joining_fees(data: dict):
-    for entry in data['new_ledger_entries']:
-        if entry['type'] == 'DONATE':
-            if entry['playerId'] in data['m'] and 'unpaid_joining_fee' in data['m'][entry['playerId']]:
-                data['m'][entry['playerId']]['unpaid_joining_fee']['paid'] += entry['gold']
-                if data['m'][entry['playerId']]['unpaid_joining_fee']['paid'] >= data['qc']['j']['go'][0]:
-                    del data['m'][entry['playerId']]['unpaid_joining_fee']
     for m_id in data['m']:
-        if 'unpaid_joining_fee' in data['m'][m_id]:
-            if 'kick_announced' not in data['m'][m_id]['unpaid_joining_fee']:
-                if dt.datetime.utcnow() - str_to_dt(data['m'][m_id]['unpaid_joining_fee']['since']) > dt.timedelta(hours=1):
-                    data['m'][m_id]['unpaid_joining_fee']['kick_announced'] = True
-                    send_message(data, f'{id_to_nick(data, m_id)} failed to prepay for joining 1 gold quest within 1 hour of joining the clan and should now be kicked')
-            elif data['m'][m_id]['unpaid_joining_fee']['paid'] >= data['qc']['j']['go'][0]:
-                del data['m'][m_id]['unpaid_joining_fee']
-                send_message(data, f'{id_to_nick(data, m_id)} paid for joining 1 gold quest and is not to be kicked anymore')
+        if 'unpaid_joining_fee' in data['m'][m_id] and 'kick_announced' not in data['m'][m_id]['unpaid_joining_fee']:
+            if clock.now() - data['m'][m_id]['unpaid_joining_fee']['since'] >= HOUR:
+                data['m'][m_id]['unpaid_joining_fee']['kick_announced'] = True; data.touch('m', m_id)
+                send_message(data, f'{id_to_nick(data, m_id)} failed to prepay for joining 1 gold quest within 1 hour of joining the clan and should now be kicked', key=f'joining fee {m_id}')
+
+
+def exp_deadline(data: dict):
+    return data['lastWeeklyExpCheck'] + WEEK if 'lastWeeklyExpCheck' in data else 0
 
 
+@stage('exp', exp_deadline)
 def weekly_exp(data: dict):
     if 'lastWeeklyExpCheck' not in data:
-        data['lastWeeklyExpCheck'] = dt_to_str(dt.datetime.utcnow())
+        data['lastWeeklyExpCheck'] = clock.now()
         for m_id in data['m']:
-            data['m'][m_id]['expDuringLastWeeklyCheck'] = data['m'][m_id]['xp']
-    if dt.datetime.utcnow() - str_to_dt(data['lastWeeklyExpCheck']) >= dt.timedelta(weeks=1):
-        data['lastWeeklyExpCheck'] = dt_to_str(dt.datetime.utcnow())
+            data['m'][m_id]['expDuringLastWeeklyCheck'] = data['m'][m_id]['xp']; data.touch('m', m_id)
+    if clock.now() - data['lastWeeklyExpCheck'] >= WEEK:
+        data['lastWeeklyExpCheck'] = clock.now()
         punished = []
         for m_id in data['m']:
             if 'expDuringLastWeeklyCheck' in data['m'][m_id]:
                 if data['m'][m_id]['xp'] - data['m'][m_id]['expDuringLastWeeklyCheck'] < data['minWeeklyExp']:
                     change_balance(data, m_id, 'weekly exp', -500)
                     punished.append(id_to_nick(data, m_id))
-            data['m'][m_id]['expDuringLastWeeklyCheck'] = data['m'][m_id]['xp']
+            data['m'][m_id]['expDuringLastWeeklyCheck'] = data['m'][m_id]['xp']; data.touch('m', m_id)
         if len(punished) > 0:
             send_message(data, f'Weekly experience has been controlled, player{"s" if len(punished) != 1 else ""}, who failed to meet the requirement:\n{plist(punished)}\nPunishment is 500 gold deduction from balance.')
         else:
             send_message(data, 'Weekly experience has been controlled, everyone scored enough to avoid punishment.')
 
 
-def change_balance(data: dict, player_id: str, comment: str, gold: int = 0, gems: int = 0):
+@handles(DonationReceived)
+def credit_donation(data: dict, event: DonationReceived):
+    change_balance(data, event.member_id, 'donate', event.gold, event.gems)
+
+
+def change_balance(data: dict, player_id: str, reason: str, gold: int = 0, gems: int = 0, counterparty: str = None):
     if gold != 0 or gems != 0:
-        if player_id not in data['b']: data['b'][player_id] = {'go': 0, 'ge': 0, 'hi': []}
+        if player_id not in data['b']: data['b'][player_id] = {'go': 0, 'ge': 0}
         data['b'][player_id]['go'] += gold; data['b'][player_id]['ge'] += gems
-        data['b'][player_id]['hi'].insert(0, f'{dt.datetime.utcnow().strftime("%m.%d")} {curr_to_str(gold, gems)} {comment}')
-        if len(data['b'][player_id]['hi']) > 10: data['b'][player_id]['hi'] = data['b'][player_id]['hi'][:10]
-    log(f'{id_to_nick(data, player_id)}\'s balance changed by {curr_to_str(gold, gems)} ({comment})')
+        balance_ledger(data).append(player_id, gold, gems, reason, counterparty)
+        data.touch('b', player_id)
+        if reason == 'donate' and 'leaderboards' in data.derived: data.derived['leaderboards'].add(player_id, {'gold': gold, 'gems': gems})
+    if BALANCE.isEnabledFor(INFO):
+        BALANCE.info('%s\'s balance changed by %s (%s%s)', id_to_nick(data, player_id), curr_to_str(gold, gems), reason,
+                     '' if counterparty is None else ' ' + id_to_nick(data, counterparty),
+                     extra={'fields': {'member': player_id, 'gold': gold, 'gems': gems, 'reason': reason, 'counterparty': counterparty}})
+
+
+def balance_ledger(data: dict) -> BalanceLedger:
+    """Returns the balance ledger attached to the state, a memory-only one is attached if there is none."""
+    if 'ledger' not in data.stores:
+        data.stores['ledger'] = BalanceLedger()
+    return data.stores['ledger']
+
+
+def stat_history(data: dict) -> TimeSeries:
+    """Returns the member stat history attached to the state, a memory-only one is attached if there is none."""
+    if 'history' not in data.stores:
+        data.stores['history'] = TimeSeries()
+    return data.stores['history']
+
+
+def leaderboards(data: dict) -> Leaderboards:
+    """Returns the leaderboards of the members, built from their stat and balance histories on first use and kept up
+    to date by rank() and change_balance() from then on."""
+    if 'leaderboards' not in data.derived:
+        boards = Leaderboards()
+        since = clock.now() // SECOND - max(WINDOWS.values())
+        for m_id in data['m']:
+            for stat in RANKED_STATS:
+                times, values = stat_history(data).get(m_id, stat)
+                for i in range(max(1, bisect_left(times, since)), len(times)):
+                    boards.add(m_id, amounts({stat: values[i] - values[i-1]}), times[i])
+            ledger = balance_ledger(data)
+            for t, _, gold, gems, reason, _ in ledger.history(m_id, per_page=ledger.count(m_id), since=since * SECOND):
+                if reason == 'donate':
+                    boards.add(m_id, {'gold': gold, 'gems': gems}, t // SECOND)
+        data.derived['leaderboards'] = boards
+    return data.derived['leaderboards']
+
+
+def rank(data: dict, member_id: str, differences: dict):
+    """Adds the stat differences recorded for a member to the leaderboards, if they were built already."""
+    if 'leaderboards' in data.derived:
+        data.derived['leaderboards'].add(member_id, amounts(differences))
+
+
+def emit(data: dict, *events):
+    """Delivers events to their handlers through the event bus attached to the state, one is attached if there is none."""
+    if 'events' not in data.stores:
+        data.stores['events'] = EventBus()
+    data.stores['events'].emit(data, *events)
+
+
+def outbox(data: dict) -> Outbox:
+    """Returns the chat outbox attached to the state, a memory-only one is attached and started if there is none."""
+    if 'outbox' not in data.stores:
+        data.stores['outbox'] = Outbox(data['id'])
+        data.stores['outbox'].start()
+    return data.stores['outbox']
+
+
+def render_history(data: dict, events: list) -> str:
+    """Renders balance events as '03.24 -500 gold quest' lines, resolving each counterparty's name once."""
+    nicks = {c: id_to_nick(data, c) for c in {e[5] for e in events if e[5] is not None}}
+    return '\n'.join(f'{dt.datetime.utcfromtimestamp(t // SECOND).strftime("%m.%d")} {curr_to_str(gold, gems)} {reason}{"" if c is None else " " + nicks[c]}'
+                     for t, _, gold, gems, reason, c in events)
 
 
 def curr_to_str(gold: int = 0, gems: int = 0):
@@ -398,175 +804,141 @@ def curr_to_str(gold: int = 0, gems: int = 0):
             ) if gold or gems else '0'
 
 
+def names(data: dict) -> NameIndex:
+    """Returns the name index of the clan, built from the members on first use."""
+    if 'names' not in data.derived:
+        data.derived['names'] = NameIndex(data['m'], data.setdefault('fn', {}))
+    return data.derived['names']
+
+
 def id_to_nick(data: dict, member_id: str):
-    if not data['nicks_updated']:
-        update_members(data)
-        data['request_counter'] += 1
-    if member_id in data['m']:
-        return data['m'][member_id]['username']
+    nick = names(data).nick(member_id)
+    if nick is not None:
+        return nick
     return f'NOT-CLAN-MEMBER'
 
 
-def nick_to_id(data: dict, nick: str):
-    if not data['nicks_updated']:
-        update_members(data)
-        data['request_counter'] += 1
-    for m_id in data['m']:
-        if data['m'][m_id]['username'] == nick:
-            return m_id
-    return None
+def nick_to_id(data: dict, nick: str, prefix: bool = False):
+    return names(data).id(nick, prefix)
 
 
 def message_handler(data: dict, msg: dict):
-    response = ''
     if not msg['isSystem'] and 'playerId' in msg and 'msg' in msg:
-        log(f"{id_to_nick(data, msg['playerId'])} says '{msg['msg']}'")
-        for submessage in msg['msg'].split(';'):
-            submessage = submessage.strip()
-
-            if submessage.split(' ')[0] == '/help':
-                if len(submessage.split(' ')) == 1:
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, available commands are:\n" \
-                                f"/help (/command), /status, /votes, /balance (nick),\n" \
-                                f"/balance_history (nick), /transfer [nick] [gold] [gems],\n" \
-                                f"/exp (nick)"
-                elif len(submessage.split(' ')) == 2:
-                    if submessage.split(' ')[1] == '/status':
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, shows clan quest status, whether vote is in progress or quest is already selected and soon to be started\n"
-                    elif submessage.split(' ')[1] == '/votes':
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, counts current votes if quest vote is in progress\n"
-                    elif submessage.split(' ')[1] == '/balance':
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, shows your balance in bare \"/balance\" form, or (nick)\'s balance if given. Balance is how much clan owes you, it\'s paid off in form of paid services that are listed in clan description and accumulated with your donations\n"
-                    elif submessage.split(' ')[1] == '/balance_history':
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, shows history of changes to your or (nick)\'s balance, maxed at 10 entries\n"
-                    elif submessage.split(' ')[1] == '/transfer':
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, transfers [gold] gold and [gems] gems to [nick], gold and gems amounts can be 0\n"
-                    elif submessage.split(' ')[1] == '/exp':
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, shows how much clan exp you have earned since the last time it was controlled, how much you have yet to earn and when is the next weekly check\n"
-                    else: response += f"⚞{id_to_nick(data, msg['playerId'])}, no info on \"{submessage.split(' ')[1]}\" available\n"
-                else: response += f"⚞{id_to_nick(data, msg['playerId'])}, syntax error\n"
-
-            elif submessage.split(' ')[0] == '/balance':
-                if len(submessage.split(' ')) == 1:  # own balance
-                    if msg['playerId'] in data['b']: balance = curr_to_str(data['b'][msg['playerId']]['go'], data['b'][msg['playerId']]['ge'])
-                    else: balance = curr_to_str()
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, your balance is {balance}\n"
-                elif len(submessage.split(' ')) == 2:  # someone's else balance
-                    player_id = nick_to_id(data, submessage.split(' ')[1])
-                    if player_id is not None:
-                        if player_id in data['b']: balance = curr_to_str(data['b'][player_id]['go'], data['b'][player_id]['ge'])
-                        else: balance = curr_to_str()
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, {submessage.split(' ')[1]}\'s balance is {balance}\n"
-                    else: response += f"⚞{id_to_nick(data, msg['playerId'])}, member \"{submessage.split(' ')[1]}\" not found\n"
-                else: response += f"⚞{id_to_nick(data, msg['playerId'])}, syntax error\n"
-
-            elif submessage.split(' ')[0] == '/balance_history':
-                if len(submessage.split(' ')) == 1:  # own balance history
-                    if msg['playerId'] in data['b']: history = '\n'+'\n'.join(data['b'][msg['playerId']]['hi'])
-                    else: history = ' empty'
-                    while ":P_ID:" in history:
-                        index = history.index(":P_ID:")
-                        history = history[:index] + id_to_nick(data, history[index+6:index+42]) + history[index+42:]
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, your balance history:{history}\n"
-                elif len(submessage.split(' ')) == 2:  # someone's else balance history
-                    player_id = nick_to_id(data, submessage.split(' ')[1])
-                    if player_id is not None:
-                        if player_id in data['b']: history = '\n'+'\n'.join(data['b'][player_id]['hi'])
-                        else: history = ' empty'
-                        while ":P_ID:" in history:
-                            index = history.index(":P_ID:")
-                            history = history[:index] + id_to_nick(data, history[index+6:index+42]) + history[index+42:]
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, {submessage.split(' ')[1]}\'s balance history:{history}\n"
-                    else: response += f"⚞{id_to_nick(data, msg['playerId'])}, member \"{submessage.split(' ')[1]}\" not found\n"
-                else: response += f"⚞{id_to_nick(data, msg['playerId'])}, syntax error\n"
-
-            elif submessage.split(' ')[0] == '/transfer':
-                if len(submessage.split(' ')) == 4:
-                    receiver_id = nick_to_id(data, submessage.split(' ')[1])
-                    if receiver_id is not None:
-                        if receiver_id != msg["playerId"]:
-                            try:
-                                gold, gems = int(submessage.split(' ')[2]), int(submessage.split(' ')[3])
-                                if (gold < 0 or gems < 0) and not msg['playerId'] == data["leaderId"]:
-                                    response += f"⚞{id_to_nick(data, msg['playerId'])}, can\'t transfer negative values\n"
-                                elif (msg['playerId'] not in data['b'] or (gold != 0 and gold > data['b'][msg['playerId']]['go']) or (gems != 0 and gems > data['b'][msg['playerId']]['ge'])) and not msg['playerId'] == data["leaderId"]:
-                                    response += f"⚞{id_to_nick(data, msg['playerId'])}, insufficient balance\n"
-                                else:
-                                    change_balance(data, msg['playerId'], f'to :P_ID:{receiver_id}', -1*gold, -1*gems)
-                                    change_balance(data, receiver_id, f'from :P_ID:{msg["playerId"]}', gold, gems)
-                                    response += f"⚞{id_to_nick(data, msg['playerId'])}, transferred {curr_to_str(gold, gems)} from your balance to {submessage.split(' ')[1]}\'s\n"
-                            except ValueError:
-                                response += f"⚞{id_to_nick(data, msg['playerId'])}, invalid values\n"
-                        else: response += f"⚞{id_to_nick(data, msg['playerId'])}, can\'t transfer to yourself\n"
-                    else: response += f"⚞{id_to_nick(data, msg['playerId'])}, member \"{submessage.split(' ')[1]}\" not found\n"
-                else: response += f"⚞{id_to_nick(data, msg['playerId'])}, syntax error\n"
-
-            elif submessage.split(' ')[0] == '/status':
-                if data['qm']['state'] == 'wait':
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, waiting for \"{data['qm']['winner']}\" quest to start, time left - {dt.timedelta(seconds=(dt.timedelta(hours=12) - (dt.datetime.utcnow() - str_to_dt(data['qm']['since']))).seconds)}\n"
-                elif data['qm']['state'] == 'quest':
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, waiting until a new vote can be started\n"
-                elif data['qm']['state'] == 'vote':
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, voting for the next quest, time left - {dt.timedelta(seconds=(dt.timedelta(hours=12) - (dt.datetime.utcnow() - str_to_dt(data['qm']['since']))).seconds)}\n"
-
-            elif submessage.split(' ')[0] == '/exp':
-                secs_left = round((dt.timedelta(weeks=1) - (dt.datetime.utcnow() - str_to_dt(data["lastWeeklyExpCheck"]))).total_seconds(), 0)
-                days, reminder = divmod(secs_left, 86400)
-                hours, reminder = divmod(reminder, 3600)
-                minutes, seconds = divmod(reminder, 60)
-                until_next = f'{int(days)} days, {int(hours)}:{int(minutes)}:{int(seconds)}'
-                if len(submessage.split(' ')) == 1:  # own exp
-                    if 'expDuringLastWeeklyCheck' in data['m'][msg['playerId']]:
-                        xp = data['m'][msg['playerId']]['xp'] - data['m'][msg['playerId']]['expDuringLastWeeklyCheck']
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, your exp since last weekly check: {xp}/{data['minWeeklyExp']} ({round(xp/data['minWeeklyExp']*100, 2)}%), time left: {until_next}\n"
-                    else:
-                        response += f"⚞{id_to_nick(data, msg['playerId'])}, you won\'t be controlled on the next weekly exp check, time left: {until_next}\n"
-                elif len(submessage.split(' ')) == 2:  # someone's else exp
-                    player_id = nick_to_id(data, submessage.split(' ')[1])
-                    if player_id is not None:
-                        if 'expDuringLastWeeklyCheck' in data['m'][player_id]:
-                            xp = data['m'][player_id]['xp'] - data['m'][player_id]['expDuringLastWeeklyCheck']
-                            response += f"⚞{id_to_nick(data, msg['playerId'])}, {submessage.split(' ')[1]}\'s exp since last weekly check: {xp}/{data['minWeeklyExp']} ({round(xp/data['minWeeklyExp']*100, 2)}%), time left: {until_next}\n"
-                        else:
-                            response += f"⚞{id_to_nick(data, msg['playerId'])}, {submessage.split(' ')[1]} won\'t be controlled on the next weekly exp check, time left: {until_next}\n"
-                    else: response += f"⚞{id_to_nick(data, msg['playerId'])}, member \"{submessage.split(' ')[1]}\" not found\n"
-                else: response += f"⚞{id_to_nick(data, msg['playerId'])}, syntax error\n"
-
-            elif submessage.split(' ')[0] == '/votes':
-                if data['qm']['state'] == 'vote':
-                    votes = {}
-                    for quest in data['qm']['votes'].values():
-                        if quest in votes: votes[quest] += 1
-                        else: votes[quest] = 1
-                    votes = sorted(votes.items(), key=lambda x: x[1], reverse=True)
-                    conclusion = ''
-                    for quest, vote_amount in votes:
-                        conclusion += f'{vote_amount} vote{"s" if vote_amount > 1 else ""} for "{quest}"\n'
-                    conclusion = conclusion.strip('\n')
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, \n{conclusion}\n"
-                else:
-                    response += f"⚞{id_to_nick(data, msg['playerId'])}, no vote in progress\n"
-
-            # Leader-only commands
-            elif msg['playerId'] == data["leaderId"]:
-
-                if submessage.split(' ')[0] == '/clear_chat':
-                    space = "\n"*250
-                    for _ in range(30):
-                        send_message(data, space)
-
-                elif submessage.split(' ')[0] == '/execute':
-                    exec(submessage[9:])
-
-    if len(response) > 0:
-        response = response.strip('\n')
-        send_message(data, response)
-
-
-def send_message(data: dict, message: str):
-    while len(message) > 250:
-        Clans.send_message(data['id'], message[:247]+'...'); data['request_counter'] += 1
-        log(f'Sending "{message[:247]+"..."}"')
-        message = "..." + message[247:]
-    Clans.send_message(data['id'], message); data['request_counter'] += 1
-    log(f'Sending "{message}"')
+        nick = id_to_nick(data, msg['playerId'])
+        CHAT.info("%s says '%s'", nick, msg['msg'], extra={'fields': {'member': msg['playerId']}})
+        if any(part.strip().startswith('/') for part in msg['msg'].split(';')):
+            emit(data, ChatCommand(msg['playerId'], msg['msg']))
+
+
+@handles(ChatCommand)
+def run_commands(data: dict, event: ChatCommand):
+    replies = handle(data, event.sender_id, event.text, lambda n, prefix: nick_to_id(data, n, prefix), event.sender_id == data["leaderId"])
+    if len(replies) > 0:
+        nick = id_to_nick(data, event.sender_id)
+        send_message(data, '\n'.join(f"⚞{nick}, {reply}" for reply in replies))
+
+
+@command('/status', description='shows clan quest status, whether vote is in progress or quest is already selected and soon to be started')
+def status_command(data: dict, sender_id: str):
+    if data['qm']['state'] == 'wait':
+        return f"waiting for \"{data['qm']['winner']}\" quest to start, time left - {clock.duration(data['qm']['since'] + 12*HOUR - clock.now())}"
+    elif data['qm']['state'] == 'quest':
+        return "waiting until a new vote can be started"
+    elif data['qm']['state'] == 'vote':
+        return f"voting for the next quest, time left - {clock.duration(data['qm']['since'] + 12*HOUR - clock.now())}"
+
+
+@command('/votes', description='counts current votes if quest vote is in progress')
+def votes_command(data: dict, sender_id: str):
+    if data['qm']['state'] != 'vote':
+        return "no vote in progress"
+    votes = {}
+    for quest in data['qm']['votes'].values():
+        if quest in votes: votes[quest] += 1
+        else: votes[quest] = 1
+    votes = sorted(votes.items(), key=lambda x: x[1], reverse=True)
+    return '\n' + '\n'.join(f'{vote_amount} vote{"s" if vote_amount > 1 else ""} for "{quest}"' for quest, vote_amount in votes)
+
+
+@command('/balance', Arg('nick', optional=True, prefix=True), description='shows your balance in bare "/balance" form, or (nick)\'s balance if given. Balance is how much clan owes you, it\'s paid off in form of paid services that are listed in clan description and accumulated with your donations')
+def balance_command(data: dict, sender_id: str, player_id: str = None):
+    owner = 'your' if player_id is None else f"{id_to_nick(data, player_id)}\'s"
+    player_id = sender_id if player_id is None else player_id
+    if player_id in data['b']: balance = curr_to_str(data['b'][player_id]['go'], data['b'][player_id]['ge'])
+    else: balance = curr_to_str()
+    return f"{owner} balance is {balance}"
+
+
+@command('/balance_history', Arg('nick', optional=True, prefix=True), Arg('page', INT, optional=True), description='shows history of changes to your or (nick)\'s balance, 10 entries per (page), newest first')
+def balance_history_command(data: dict, sender_id: str, player_id: str = None, page: int = None):
+    owner = 'your' if player_id is None else f"{id_to_nick(data, player_id)}\'s"
+    player_id = sender_id if player_id is None else player_id
+    page = 1 if page is None or page < 1 else page
+    events = balance_ledger(data).history(player_id, page=page, per_page=HISTORY_PAGE)
+    pages = -(-balance_ledger(data).count(player_id) // HISTORY_PAGE)
+    if len(events) == 0:
+        return f"{owner} balance history{'' if page == 1 else f' page {page}'}: empty"
+    return f"{owner} balance history (page {page}/{pages}):\n{render_history(data, events)}"
+
+
+@command('/transfer', Arg('nick'), Arg('gold', INT), Arg('gems', INT), description='transfers [gold] gold and [gems] gems to [nick], gold and gems amounts can be 0')
+def transfer_command(data: dict, sender_id: str, receiver_id: str, gold: int, gems: int):
+    if receiver_id == sender_id:
+        return "can\'t transfer to yourself"
+    if (gold < 0 or gems < 0) and not sender_id == data["leaderId"]:
+        return "can\'t transfer negative values"
+    elif (sender_id not in data['b'] or (gold != 0 and gold > data['b'][sender_id]['go']) or (gems != 0 and gems > data['b'][sender_id]['ge'])) and not sender_id == data["leaderId"]:
+        return "insufficient balance"
+    change_balance(data, sender_id, 'to', -1*gold, -1*gems, counterparty=receiver_id)
+    change_balance(data, receiver_id, 'from', gold, gems, counterparty=sender_id)
+    return f"transferred {curr_to_str(gold, gems)} from your balance to {id_to_nick(data, receiver_id)}\'s"
+
+
+@command('/exp', Arg('nick', optional=True, prefix=True), description='shows how much clan exp you have earned since the last time it was controlled, how much you have yet to earn and when is the next weekly check')
+def exp_command(data: dict, sender_id: str, player_id: str = None):
+    secs_left = (data['lastWeeklyExpCheck'] + WEEK - clock.now()) // SECOND
+    days, reminder = divmod(secs_left, 86400)
+    hours, reminder = divmod(reminder, 3600)
+    minutes, seconds = divmod(reminder, 60)
+    until_next = f'{int(days)} days, {int(hours)}:{int(minutes)}:{int(seconds)}'
+    owner = 'your' if player_id is None else f"{id_to_nick(data, player_id)}\'s"
+    player_id = sender_id if player_id is None else player_id
+    if player_id in data['m'] and 'expDuringLastWeeklyCheck' in data['m'][player_id]:
+        xp = data['m'][player_id]['xp'] - data['m'][player_id]['expDuringLastWeeklyCheck']
+        return f"{owner} exp since last weekly check: {xp}/{data['minWeeklyExp']} ({round(xp/data['minWeeklyExp']*100, 2)}%), time left: {until_next}"
+    return f"{'you' if player_id == sender_id else id_to_nick(data, player_id)} won\'t be controlled on the next weekly exp check, time left: {until_next}"
+
+
+@command('/top', Arg('board', STR), Arg('period', STR, optional=True), description=f'shows the {TOP_SIZE} members who earned the most [board] ({", ".join(BOARDS)}) over the last (period) ({", ".join(WINDOWS)}, 7d by default)')
+def top_command(data: dict, sender_id: str, board: str, period: str = None):
+    period = '7d' if period is None else period
+    if board not in BOARDS or period not in WINDOWS:
+        raise CommandError(f'usage: /top [{"|".join(BOARDS)}] ({"|".join(WINDOWS)})')
+    top = leaderboards(data).top(board, period, TOP_SIZE)
+    if len(top) == 0:
+        return f"nobody is on the {board} leaderboard of the last {period}"
+    if board == 'donations': scores = [curr_to_str(gold, gems) for _, (gold, gems) in top]
+    elif board == 'winrate': scores = [f'{round(rate*100, 1)}% of {games} games' for _, (rate, games) in top]
+    else: scores = [str(score) for _, score in top]
+    return f"top {board} of the last {period}:\n" + '\n'.join(f'{i}. {id_to_nick(data, m_id)} - {score}' for i, ((m_id, _), score) in enumerate(zip(top, scores), 1))
+
+
+# Leader-only commands
+@command('/clear_chat', leader_only=True)
+def clear_chat_command(data: dict, sender_id: str):
+    space = "\n"*250
+    for _ in range(30):
+        send_message(data, space)
+
+
+@command('/execute', Arg('code', TEXT), leader_only=True)
+def execute_command(data: dict, sender_id: str, code: str):
+    """Runs Python code with the module's functions, `data` (the state) and `msg` (the command's chat message,
+    {'playerId': sender id, 'msg': text}) in scope. Names it defines don't outlive it."""
+    exec(code, {**globals(), 'data': data, 'msg': {'playerId': sender_id, 'msg': f'/execute {code}'}}); data.touch()
+
+
+def send_message(data: dict, message: str, key: str = None):
+    """Queues a message to the clan chat, replacing the pending one queued with the same `key` if there is one."""
+    outbox(data).put(message, key)
+    CHAT.info('Queued "%s"', message)
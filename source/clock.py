@@ -0,0 +1,91 @@
+import datetime as dt
+from time import time
+
+# Times are kept as integer epoch milliseconds (UTC), as in the state and everywhere time is compared.
+SECOND = 1000
+MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+
+class SystemClock:
+    """The real time."""
+
+    @staticmethod
+    def now() -> int:
+        return int(time() * SECOND)
+
+
+class ManualClock:
+    """A clock that only moves when told to, so that time-dependent logic can be tested and benchmarked without
+    waiting for it."""
+
+    def __init__(self, t: int = 0):
+        self.t = t
+
+    def now(self) -> int:
+        return self.t
+
+    def advance(self, ms: int):
+        self.t += ms
+
+
+CLOCK = SystemClock()
+
+
+def use(clock):
+    """Makes `clock` (anything with a `now()` returning epoch milliseconds) the time source of the bot."""
+    global CLOCK
+    CLOCK = clock
+
+
+def now() -> int:
+    return CLOCK.now()
+
+
+def parse(string: str) -> int:
+    """Returns the epoch milliseconds of a UTC ISO-8601 timestamp 'YYYY-MM-DDTHH:MM:SS[.fraction]Z', such as the
+    API's '2023-03-28T14:22:27.409Z' or the microsecond ones the state used to keep. Only the fixed positions of
+    the fields are read, which makes it about 3 times faster than strptime."""
+    y, m = int(string[0:4]), int(string[5:7])
+    y -= m <= 2  # days from civil, years starting in March so that leap days come last
+    era = y // 400
+    yoe = y - era * 400
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + (153 * (m - 3 if m > 2 else m + 9) + 2) // 5 + int(string[8:10]) - 1
+    days = era * 146097 + doe - 719468
+    t = ((days * 24 + int(string[11:13])) * 60 + int(string[14:16])) * 60 + int(string[17:19])
+    ms = int((string[20:-1] + '00')[:3]) if string[19] == '.' else 0
+    return t * SECOND + ms
+
+
+def format(t: int) -> str:
+    """Returns a timestamp in the API's format."""
+    return dt.datetime.fromtimestamp(t / SECOND, dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def weekday(t: int) -> int:
+    """Returns the UTC day of the week, Monday being 0."""
+    return (t // DAY + 3) % 7
+
+
+def midnight(t: int) -> int:
+    """Returns the start of the UTC day."""
+    return t - t % DAY
+
+
+def duration(ms: int) -> str:
+    """Renders a duration as 'H:MM:SS' (with days if there are any), negative ones as 0:00:00."""
+    return str(dt.timedelta(seconds=max(0, ms) // SECOND))
+
+
+def migrate_times(data: dict):
+    """Converts the timestamp strings kept by older states into epoch milliseconds."""
+    for key in ('lastChatUpdate', 'availableQuestsLastUpdate', 'lastWeeklyExpCheck'):
+        if isinstance(data.get(key), str):
+            data[key] = parse(data[key])
+    if 'qm' in data and isinstance(data['qm'].get('since'), str):
+        data['qm']['since'] = parse(data['qm']['since']); data.touch('qm')
+    for m_id, member in data.get('m', {}).items():
+        if 'unpaid_joining_fee' in member and isinstance(member['unpaid_joining_fee']['since'], str):
+            member['unpaid_joining_fee']['since'] = parse(member['unpaid_joining_fee']['since']); data.touch('m', m_id)
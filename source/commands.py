@@ -0,0 +1,138 @@
+MEMBER = 'member'  # nick of a clan member, passed to the handler as the member's id
+INT = 'int'
+STR = 'str'
+TEXT = 'text'  # the rest of the submessage as is, only valid as the last argument
+
+
+class CommandError(Exception):
+    """Raised by argument validation and handlers, its message is sent back as the reply."""
+
+
+class Arg:
+    def __init__(self, name: str, kind: str = MEMBER, optional: bool = False, prefix: bool = False):
+        self.name = name
+        self.kind = kind
+        self.optional = optional
+        self.prefix = prefix  # whether a member may be given by a unique prefix of their nick, never for moving balances
+
+
+class Command:
+    def __init__(self, name: str, handler, args: tuple, description: str, leader_only: bool):
+        self.name = name
+        self.handler = handler
+        self.args = args
+        self.description = description
+        self.leader_only = leader_only
+        self.usage = ' '.join([name] + [f'({a.name})' if a.optional else f'[{a.name}]' for a in args])
+        self.required = sum(not a.optional for a in args)
+
+
+COMMANDS = {}  # name -> Command
+
+
+def command(name: str, *args: Arg, description: str = '', leader_only: bool = False):
+    """Registers the decorated function as the handler of a chat command.\n
+    The handler is called as handler(data, sender_id, *argument values) and returns the reply or None."""
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, args, description, leader_only)
+        return handler
+    return register
+
+
+def number(token: str) -> bool:
+    try:
+        int(token)
+        return True
+    except ValueError:
+        return False
+
+
+def bind(cmd: Command, submessage: str, tokens: list, resolve_member) -> list:
+    """Validates the tokens against the command's arguments and converts them. An optional member given as a number
+    that isn't a nick is left out when a later argument takes a number, e.g. '/balance_history 2' is page 2 of the
+    sender's history."""
+    takes_text = len(cmd.args) > 0 and cmd.args[-1].kind == TEXT
+    if len(tokens) - 1 < cmd.required or (len(tokens) - 1 > len(cmd.args) and not takes_text):
+        raise CommandError('syntax error')
+    values = []
+    j = 1  # next token
+    for i, arg in enumerate(cmd.args):
+        if j >= len(tokens):
+            if not arg.optional:
+                raise CommandError('syntax error')
+            values.append(None)
+        elif arg.kind == TEXT:
+            values.append(submessage[len(cmd.name):].strip())
+            break
+        elif arg.kind == MEMBER:
+            member_id = resolve_member(tokens[j], arg.prefix)
+            if member_id is None and arg.optional and number(tokens[j]) and len(tokens) - j < len(cmd.args) - i and \
+                    any(a.kind == INT for a in cmd.args[i+1:]):
+                values.append(None)
+                continue
+            if member_id is None:
+                raise CommandError(f'member "{tokens[j]}" not found')
+            values.append(member_id)
+        elif arg.kind == INT:
+            if not number(tokens[j]):
+                raise CommandError('invalid values')
+            values.append(int(tokens[j]))
+        else:
+            values.append(tokens[j])
+        j += 1
+    return values
+
+
+def handle(data: dict, sender_id: str, text: str, resolve_member, is_leader: bool) -> list:
+    """
+    Runs every ;-separated command of a chat message.
+
+    Every submessage is tokenized once and dispatched by its first token, unknown commands and leader-only commands
+    sent by others are ignored.
+
+    :param data: The state, passed to the handlers
+    :param sender_id: Id of the player who sent the message
+    :param text: The message
+    :param resolve_member: Function returning the id of the member with the given nick, or with the only nick starting
+        with it if its second argument is set, or None
+    :param is_leader: Whether the sender may use leader-only commands
+    :return: The replies, in the order of the commands
+    """
+    replies = []
+    for submessage in text.split(';'):
+        submessage = submessage.strip()
+        tokens = submessage.split()
+        if len(tokens) == 0 or tokens[0] not in COMMANDS:
+            continue
+        cmd = COMMANDS[tokens[0]]
+        if cmd.leader_only and not is_leader:
+            continue
+        try:
+            reply = cmd.handler(data, sender_id, *bind(cmd, submessage, tokens, resolve_member))
+        except CommandError as err:
+            reply = str(err)
+        if reply is not None:
+            replies.append(reply)
+    return replies
+
+
+def help_text(width: int = 50) -> str:
+    """Lists the usage of every command available to everyone, wrapped into lines of about `width` characters."""
+    lines, line = [], ''
+    for cmd in COMMANDS.values():
+        if cmd.leader_only:
+            continue
+        if line and len(line) + len(cmd.usage) + 2 > width:
+            lines.append(line + ',')
+            line = ''
+        line += (', ' if line else '') + cmd.usage
+    return '\n'.join(lines + [line])
+
+
+@command('/help', Arg('/command', kind=STR, optional=True), description='shows the list of commands, or what (/command) does')
+def help_command(data: dict, sender_id: str, name: str = None):
+    if name is None:
+        return f'available commands are:\n{help_text()}'
+    if name in COMMANDS and not COMMANDS[name].leader_only:
+        return COMMANDS[name].description
+    return f'no info on "{name}" available'
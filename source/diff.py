@@ -0,0 +1,103 @@
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+
+
+class Change:
+    """A value added, updated or removed at a path of the state, e.g. ('m', <id>, 'p', 'gameStats', 'totalWinCount')."""
+
+    __slots__ = ('kind', 'path', 'old', 'new')
+
+    def __init__(self, kind: str, path: tuple, old, new):
+        self.kind = kind
+        self.path = path
+        self.old = old  # None if added
+        self.new = new  # None if removed
+
+    @property
+    def key(self) -> str:
+        """The path as a dotted string, e.g. 'm.<id>.p.gameStats.totalWinCount'."""
+        return '.'.join(self.path)
+
+    def __repr__(self):
+        return f'Change({self.kind}, {self.key}, {self.old!r}, {self.new!r})'
+
+
+def merge(target: dict, source: dict, path: tuple = (), prune: bool = False) -> list:
+    """
+    Recursively merges `source` into `target` and returns the changes, the paths of which are prefixed with `path`.
+
+    Dicts present on both sides are merged key by key, other values are replaced as a whole. Subtrees that are equal
+    on both sides are skipped after a single comparison, so the cost follows what changed rather than the size of the
+    dicts. Like dict.update, keys missing from `source` are kept, unless `prune` is set: they are then removed from
+    the nested dicts (never from `target` itself).
+
+    :param target: The dict that will be updated
+    :param source: The dict that contains the new values
+    :param path: The path of `target` in the state
+    :param prune: Whether keys missing from nested dicts of `source` are removed
+    :return: The changes, as a list of Change
+
+    :Example:
+    merge({'a': 1, 'b': {'c': 2, 'd': 3}}, {'a': 1, 'b': {'c': 4}, 'e': 5}, ('x', ))\n
+    [Change(updated, x.b.c, 2, 4), Change(added, x.e, None, 5)]
+    """
+    changes = []
+    merge_into(target, source, path, prune, False, changes)
+    return changes
+
+
+def merge_into(target: dict, source: dict, path: tuple, prune: bool, nested: bool, changes: list):
+    for k, v in source.items():
+        if k not in target:
+            target[k] = v
+            changes.append(Change(ADDED, path + (k, ), None, v))
+            continue
+        old = target[k]
+        if old is v or old == v:
+            continue
+        if isinstance(old, dict) and isinstance(v, dict):
+            merge_into(old, v, path + (k, ), prune, True, changes)
+        else:
+            target[k] = v
+            changes.append(Change(UPDATED, path + (k, ), old, v))
+    if prune and nested:
+        for k in [k for k in target if k not in source]:
+            changes.append(Change(REMOVED, path + (k, ), target.pop(k), None))
+
+
+SUBSCRIBERS = []  # (pattern, handler)
+
+
+def subscribe(pattern: str):
+    """
+    Registers the decorated function as a subscriber to the changes whose path matches `pattern`.
+
+    Patterns are dotted paths in which '*' matches any single key and a trailing '**' any number of keys, e.g.
+    'm.*.xp' or 'm.*.p.gameStats.**'. The subscriber is called as handler(data, changes) with the matching changes of
+    every published list, if there are any.
+    """
+    def register(handler):
+        SUBSCRIBERS.append((tuple(pattern.split('.')), handler))
+        return handler
+    return register
+
+
+def matches(pattern: tuple, path: tuple) -> bool:
+    if len(pattern) > 0 and pattern[-1] == '**':
+        pattern = pattern[:-1]
+        if len(path) < len(pattern):
+            return False
+    elif len(path) != len(pattern):
+        return False
+    return all(p == '*' or p == k for p, k in zip(pattern, path))
+
+
+def publish(data: dict, changes: list) -> list:
+    """Hands the changes to their subscribers in the order they subscribed, returns the changes."""
+    if len(changes) > 0:
+        for pattern, handler in SUBSCRIBERS:
+            matching = [change for change in changes if matches(pattern, change.path)]
+            if len(matching) > 0:
+                handler(data, matching)
+    return changes
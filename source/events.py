@@ -0,0 +1,113 @@
+from collections import deque
+
+
+class Event:
+    """Something that happened to the clan. Events are equal if they are of the same type and carry the same values."""
+
+    def __eq__(self, other):
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({", ".join(f"{k}={v!r}" for k, v in vars(self).items())})'
+
+
+class DonationReceived(Event):
+    def __init__(self, entry_id: str, member_id: str, gold: int, gems: int):
+        self.entry_id = entry_id  # of the ledger entry
+        self.member_id = member_id
+        self.gold = gold
+        self.gems = gems
+
+
+class QuestShuffled(Event):
+    """The available quests were shuffled, by the bot or by the weekly shuffle."""
+
+
+class QuestBought(Event):
+    """A quest was bought, by the bot or by hand."""
+
+
+class AvailableQuestsChanged(Event):
+    """Other quests can be bought, after a shuffle or on the first fetch."""
+
+
+class QuestStarted(Event):
+    pass
+
+
+class QuestFinished(Event):
+    pass
+
+
+class TierStarted(Event):
+    def __init__(self, tier: int):
+        self.tier = tier
+
+
+class TierFinished(Event):
+    """The current tier's goal was reached, the next tier starts at `tier_end` (epoch ms) unless the wait is skipped."""
+
+    def __init__(self, tier: int, tier_end: int):
+        self.tier = tier
+        self.tier_end = tier_end
+
+
+class MemberJoined(Event):
+    def __init__(self, member_id: str):
+        self.member_id = member_id
+
+
+class ChatCommand(Event):
+    def __init__(self, sender_id: str, text: str):
+        self.sender_id = sender_id
+        self.text = text  # the whole message, which may hold several ;-separated commands
+
+
+HANDLERS = {}  # event type -> [handler, ...]
+
+
+def handles(*event_types: type):
+    """Registers the decorated function as a handler of events of the given types.\n
+    The handler is called as handler(data, event), in the order handlers were registered."""
+    def register(handler):
+        for event_type in event_types:
+            HANDLERS.setdefault(event_type, []).append(handler)
+        return handler
+    return register
+
+
+class EventBus:
+    """
+    Delivers every emitted event once to the handlers of its type.
+
+    Events are delivered in the order they were emitted: one emitted by a handler waits until the current event was
+    delivered to every handler, so handlers never run nested. An event equal to one that is still waiting is dropped,
+    so e.g. several shuffle entries of a ledger page cause a single refresh of the quests. If a handler fails, the
+    waiting events are dropped along with the rest of the cycle.
+    """
+
+    def __init__(self, handlers: dict = None):
+        self.handlers = HANDLERS if handlers is None else handlers
+        self.waiting = deque()
+        self.delivering = False
+
+    def emit(self, data: dict, *events: Event):
+        """Delivers the events, unless a handler is being run: they are then delivered once it returns."""
+        for event in events:
+            if event not in self.waiting:
+                self.waiting.append(event)
+        if not self.delivering:
+            self.deliver(data)
+
+    def deliver(self, data: dict):
+        self.delivering = True
+        try:
+            while len(self.waiting) > 0:
+                event = self.waiting.popleft()
+                for handler in self.handlers.get(type(event), ()):
+                    handler(data, event)
+        except Exception:
+            self.waiting.clear()
+            raise
+        finally:
+            self.delivering = False
@@ -0,0 +1,86 @@
+import json
+import os
+from balances import BalanceLedger
+from state import State
+from storage import Storage, apply
+
+COMPACT_SIZE = 4 * 2**20  # journal size in bytes after which it's compacted into the snapshot
+
+
+class Journal(Storage):
+    """
+    Write-ahead journal of state changes on top of a snapshot.
+
+    Every `commit()` appends the units changed since the previous one as a single line of operations and fsyncs it,
+    so the cost of a cycle depends on what changed, not on the size of the state. Once the journal grows past
+    COMPACT_SIZE, the next full commit writes the state to the snapshot and truncates the journal (a checkpoint would
+    snapshot the unsaved rest of its cycle too). Operations set whole units, so replaying a journal that was already
+    compacted into the snapshot (crash between the two) is harmless.
+
+    The balance ledger is synced before the commit, whose operations record its size as 'balancesSize'. Loading
+    truncates it back to that size, so the events of a cycle that wasn't committed (crash between the two) are
+    dropped along with the rest of the cycle instead of being appended again when it's retried.
+    """
+
+    def __init__(self, directory: str, compact_size: int = COMPACT_SIZE):
+        super().__init__()
+        self.snapshot_path = f'{directory}/data.json'
+        self.journal_path = f'{directory}/data.journal'
+        self.compact_size = compact_size
+        self.ledger = BalanceLedger(f'{directory}/balances.jsonl')
+
+    def load(self) -> dict:
+        """Reads the snapshot and replays the journal on top of it, returns an empty dict if there is no state yet."""
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = {}
+        valid = 0
+        try:
+            with open(self.journal_path, 'rb') as file:
+                for line in file:
+                    try:
+                        apply(data, json.loads(line))
+                    except ValueError:  # torn write of the last cycle, everything after it is discarded
+                        break
+                    valid += len(line)
+            if valid != os.path.getsize(self.journal_path):
+                os.truncate(self.journal_path, valid)
+        except FileNotFoundError:
+            pass
+        if 'balancesSize' in data:
+            self.ledger.truncate(data['balancesSize'])
+        self.track(data)
+        return data
+
+    def commit(self, data: dict, paths: set = None) -> list:
+        """Durably journals the changes made since the last commit (only those of `paths` for a checkpoint) and
+        returns them."""
+        if data.get('balancesSize') != self.ledger.size:
+            data['balancesSize'] = self.ledger.size
+            paths = None if paths is None else paths | {('balancesSize', )}
+        ops = self.changes(data, paths)
+        if isinstance(data, State) and paths is None:
+            data.clean()
+        if len(ops) == 0:
+            return ops
+        line = json.dumps(ops) + '\n'
+        with open(self.journal_path, 'a') as file:
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+        self.persist(ops)
+        if paths is None and os.path.getsize(self.journal_path) > self.compact_size:  # never a half-finished cycle
+            self.compact(data)
+        return ops
+
+    def compact(self, data: dict):
+        """Writes the whole state into the snapshot and empties the journal."""
+        with open(f'{self.snapshot_path}.tmp', 'w') as file:
+            file.write(json.dumps(data))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f'{self.snapshot_path}.tmp', self.snapshot_path)
+        with open(self.journal_path, 'w') as file:
+            os.fsync(file.fileno())
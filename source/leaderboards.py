@@ -0,0 +1,118 @@
+import heapq
+from bisect import bisect_left, insort
+from itertools import count
+import clock
+
+WINDOWS = {'24h': clock.DAY // clock.SECOND, '7d': clock.WEEK // clock.SECOND, '30d': 30 * clock.DAY // clock.SECOND}
+MIN_GAMES = 5  # games a member has to play within a window to be ranked by win rate
+RANKED_STATS = {  # recorded stat (see timeseries) -> metrics its increases count towards
+    'xp': ('xp', ),
+    'gameStats.totalWinCount': ('wins', 'games'),
+    'gameStats.totalLoseCount': ('games', ),
+    'gameStats.totalTieCount': ('games', ),
+}
+BOARDS = {  # board -> score of a member's totals in a window, None to leave the member out of the board
+    'xp': lambda totals: totals.get('xp') or None,
+    'donations': lambda totals: (totals.get('gold', 0), totals.get('gems', 0)) if totals.get('gold') or totals.get('gems') else None,
+    'winrate': lambda totals: (totals.get('wins', 0) / totals['games'], totals['games']) if totals.get('games', 0) >= MIN_GAMES else None,
+}
+
+
+def amounts(differences: dict) -> dict:
+    """Returns the metrics (metric -> amount) of stat differences (stat -> difference), as returned by TimeSeries.record."""
+    metrics = {}
+    for stat, difference in differences.items():
+        for metric in RANKED_STATS.get(stat, ()):
+            metrics[metric] = metrics.get(metric, 0) + difference
+    return metrics
+
+
+class Ranking:
+    """Members sorted by score, so that the top k are a slice of the list."""
+
+    def __init__(self):
+        self.sorted = []  # (score, member id), lowest first
+        self.scores = {}  # member id -> score
+
+    def update(self, member_id: str, score):
+        if member_id in self.scores:
+            del self.sorted[bisect_left(self.sorted, (self.scores.pop(member_id), member_id))]
+        if score is not None:
+            self.scores[member_id] = score
+            insort(self.sorted, (score, member_id))
+
+    def top(self, k: int) -> list:
+        """Returns the (member id, score) of the k best members, best first."""
+        return [(member_id, score) for score, member_id in self.sorted[:-k-1:-1]]
+
+
+class Window:
+    """Per-member totals of the amounts added during the last `length` seconds, with a ranking of every board."""
+
+    def __init__(self, length: int):
+        self.length = length
+        self.expiring = []  # heap of (time, order, member id, amounts) still counted in the totals
+        self.order = count()  # breaks ties between amounts added at the same time
+        self.totals = {}  # member id -> {metric: total}
+        self.rankings = {board: Ranking() for board in BOARDS}
+
+    def change(self, member_id: str, amounts: dict, sign: int):
+        totals = self.totals.setdefault(member_id, {})
+        for metric, amount in amounts.items():
+            totals[metric] = totals.get(metric, 0) + sign * amount
+        for board, score in BOARDS.items():
+            self.rankings[board].update(member_id, score(totals))
+
+    def add(self, t: int, member_id: str, amounts: dict, now: int):
+        self.expire(now)
+        if t > now - self.length:
+            heapq.heappush(self.expiring, (t, next(self.order), member_id, amounts))
+            self.change(member_id, amounts, 1)
+
+    def expire(self, now: int):
+        while len(self.expiring) > 0 and self.expiring[0][0] <= now - self.length:
+            _, _, member_id, amounts = heapq.heappop(self.expiring)
+            self.change(member_id, amounts, -1)
+
+    def remove(self, member_id: str):
+        self.expiring = [entry for entry in self.expiring if entry[2] != member_id]
+        heapq.heapify(self.expiring)
+        self.totals.pop(member_id, None)
+        for ranking in self.rankings.values():
+            ranking.update(member_id, None)
+
+
+class Leaderboards:
+    """
+    Rolling per-member totals (xp, donated gold and gems, games and wins) over every window of WINDOWS, updated as
+    amounts are added and as they get older than their window, and ranked on every board of BOARDS.
+
+    Adding, expiring and ranking an amount costs O(log n + m) for n amounts in a window and m members, so a top k is
+    read in O(k) without going through members or history. Times are in seconds.
+    """
+
+    def __init__(self):
+        self.windows = {name: Window(length) for name, length in WINDOWS.items()}
+
+    def add(self, member_id: str, amounts: dict, t: int = None):
+        """Adds amounts (metric -> number) earned by a member at a time, now by default."""
+        now = clock.now() // clock.SECOND
+        amounts = {metric: amount for metric, amount in amounts.items() if amount != 0}
+        if len(amounts) > 0:
+            for window in self.windows.values():
+                window.add(now if t is None else t, member_id, amounts, now)
+
+    def remove(self, member_id: str):
+        """Leaves a member out of every window, e.g. after they left the clan."""
+        for window in self.windows.values():
+            window.remove(member_id)
+
+    def top(self, board: str, window: str, k: int) -> list:
+        """Returns the (member id, score) of the k best members of a board over a window, best first."""
+        self.windows[window].expire(clock.now() // clock.SECOND)
+        return self.windows[window].rankings[board].top(k)
+
+    def totals(self, member_id: str, window: str) -> dict:
+        """Returns a member's totals over a window."""
+        self.windows[window].expire(clock.now() // clock.SECOND)
+        return dict(self.windows[window].totals.get(member_id, {}))
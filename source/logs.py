@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import clock
+
+# Logging of the bot, built on the standard logging module. Every category has its own logger, e.g.
+#   STATS = logs.get('stats'); STATS.debug('%s\'s %s changed by %s', name, stat, delta)
+# Messages are %-formatted only once a record passed its level and sampling, and only in the listener thread: the
+# caller merely puts the record into a bounded queue, from which it's written to a rotating JSON-lines file and the
+# console. Arguments must therefore not be mutated after being logged.
+
+LOG_FILE = '../data/logs/bot.jsonl'
+MAX_BYTES = 16 * 2**20  # size at which the log file is rotated
+BACKUP_COUNT = 5  # rotated log files kept
+QUEUE_SIZE = 10000  # records waiting to be written, more are dropped instead of blocking the caller
+CONSOLE_LEVEL = logging.INFO  # DEBUG records (e.g. every member stat change) only go to the file
+CATEGORIES = {  # category -> level, DEBUG for everything, MUTED for nothing
+    'clan': logging.INFO,  # clan info and membership changes
+    'stats': logging.DEBUG,  # member and player stat changes, the bulk of the records
+    'quest': logging.INFO,
+    'balance': logging.INFO,
+    'chat': logging.INFO,  # messages read and sent
+    'api': logging.INFO,  # retried requests
+    'bot': logging.INFO,  # failed checkups
+}
+MUTED = logging.CRITICAL + 1
+ROOT = logging.getLogger('bot')
+ROOT.propagate = False  # records only reach the handlers of start, not whatever the root logger has
+
+
+def get(category: str) -> logging.Logger:
+    """Returns the logger of a category."""
+    return ROOT.getChild(category)
+
+
+class Sampler(logging.Filter):
+    """Keeps a random share of the records of the categories it has a rate for."""
+
+    def __init__(self):
+        super().__init__()
+        self.rates = {}  # logger name -> share of records kept, 0 < rate < 1
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+SAMPLER = Sampler()
+
+
+def set_level(category: str, level: int):
+    """Changes the level of a category, MUTED to mute it. A record below its category's level costs a level check: it's
+    neither created nor formatted."""
+    get(category).setLevel(level)
+
+
+def sample(category: str, rate: float):
+    """Keeps only a random share `rate` of a category's records, 0 mutes it and 1 keeps all of them."""
+    name = get(category).name
+    SAMPLER.rates.pop(name, None)
+    if rate <= 0:
+        set_level(category, MUTED)
+        return
+    if get(category).level == MUTED:
+        set_level(category, CATEGORIES.get(category, logging.INFO))
+    if rate < 1:
+        SAMPLER.rates[name] = rate
+
+
+class Enqueuer(QueueHandler):
+    """Puts records into the queue as they are: unlike QueueHandler, it leaves their formatting to the listener."""
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.t = clock.now()  # the bot's clock rather than record.created, so that simulated time is logged
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, category, clan, message and the record's `fields` extra if it has one."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'t': clock.format(record.t), 'level': record.levelname, 'category': record.name[len(ROOT.name)+1:],
+                 'clan': None if record.threadName == 'MainThread' else record.threadName, 'msg': record.getMessage()}
+        if hasattr(record, 'fields'):
+            entry.update(record.fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        # in supervisor mode, every clan runs in a thread named after its id
+        thread = '' if record.threadName == 'MainThread' else f'[{record.threadName}] '
+        message = f'{clock.format(record.t)} {thread}{record.getMessage()}'
+        if record.exc_info:
+            message += '\n' + self.formatException(record.exc_info)
+        return message
+
+
+class Console(logging.Handler):
+    """Prints records to whatever sys.stdout is at the time, so that redirecting stdout redirects the logs too."""
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            print(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+LISTENER = None  # QueueListener writing the records, None until start
+
+
+def start(path: str = LOG_FILE, console: bool = True):
+    """Starts writing the records into the rotating file `path` (None for no file) and the console from a background
+    thread. Records logged before are dropped, except warnings and errors, which the logging module prints to stderr."""
+    global LISTENER
+    if LISTENER is not None:
+        stop()
+    for category, level in CATEGORIES.items():
+        if get(category).level == logging.NOTSET:
+            set_level(category, level)
+    handlers = []
+    if path is not None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        handlers.append(RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding='utf-8'))
+        handlers[-1].setFormatter(JsonFormatter())
+    if console:
+        handlers.append(Console(CONSOLE_LEVEL))
+        handlers[-1].setFormatter(ConsoleFormatter())
+    records = queue.Queue(QUEUE_SIZE)
+    enqueuer = Enqueuer(records)
+    enqueuer.addFilter(SAMPLER)
+    ROOT.handlers = [enqueuer]
+    ROOT.setLevel(logging.DEBUG)
+    LISTENER = QueueListener(records, *handlers, respect_handler_level=True)
+    LISTENER.start()
+
+
+def stop():
+    """Writes the records still queued and stops the background thread."""
+    global LISTENER
+    if LISTENER is not None:
+        LISTENER.stop()
+        for handler in LISTENER.handlers:
+            handler.close()
+        LISTENER = None
+    ROOT.handlers = []
@@ -1,54 +1,164 @@
-import json
-from time import sleep
-from clanfuncs import clan_checkup
-from datetime import datetime
 import os
+import sys
+import threading
+from time import monotonic, sleep
+from api_interface import API_KEY, Clans, configure
+from journal import Journal
+from sqlite_storage import SqliteStorage
+from backups import BackupStore
+from state import State
+from balances import migrate_history
+from clock import migrate_times
+from scheduler import ClanScheduler
+from outbox import Outbox
+from timeseries import TimeSeries
+from metrics import METRICS
+import logs
 
-with open('../data/clan_id.txt', 'r') as clidfile:
-    clan_id = clidfile.read()
-data = {}
+REQUESTS_PER_SECOND = 5  # request budget of the bot, shared by all clans in supervisor mode
+MAX_FAILURE_DELAY = 300  # seconds, upper bound of the delay after consecutive failed checkups of a clan
+RESTART_DELAY = 10  # seconds before the thread of a clan that died is restarted, doubled for every quick restart
+SUPERVISE_INTERVAL = 5  # seconds between checks of the clan threads
+METRICS_PORT = 9464  # local port serving request metrics as Prometheus text at /metrics, None to disable
+METRICS_FILE = '../data/metrics.json'  # periodic JSON dump of the same metrics
+METRICS_INTERVAL = 60  # seconds between dumps
+LOG = logs.get('bot')
 
 
-def load_data():
-    try:
-        with open('../data/data.json', 'r') as loadfile:
-            global data; data = json.load(loadfile)
-    except FileNotFoundError:
-        data['m'] = {}
-        data['b'] = {}
-        data['qc'] = {'j': {'go': [500, 0], 'ge': [0, 180]}, 's': {'go': [100, 0], 'ge': [0, 0]}}
+class Clan:
+    """A clan managed by the bot, with its own state, storage, backups, stat history and chat outbox. The state is kept in the directory's
+    state.db if there is one (see sqlite_storage.migrate), in the JSON journal otherwise."""
 
+    def __init__(self, clan_id: str, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.id = clan_id
+        if os.path.exists(f'{directory}/state.db'):
+            self.storage = SqliteStorage(f'{directory}/state.db')
+        else:
+            self.storage = Journal(directory)
+        self.backups = BackupStore(f'{directory}/backups')
+        self.outbox = Outbox(clan_id, f'{directory}/outbox.json')
+        self.history = TimeSeries(f'{directory}/history.bin')
+        self.checkpointed = []  # operations committed by the checkpoints of the current cycle, not backed up yet
+        self.data = State()
 
-def backup():
-    with open(f'../data/backups/{(datetime.utcnow()).strftime("%m-%d-%Y-%H-%M-%S")}.json', 'w') as backupfile:
-        backupfile.write(json.dumps(data))
-    if len(os.listdir('../data/backups')) > 1000:
-        do = True
-        for file in os.listdir('../data/backups'):
-            if do:
-                os.remove('../data/backups/' + file)
-                do = False
-            elif not do:
-                do = True
+    def load_data(self):
+        self.storage.ledger.discard()
+        self.history.discard()
+        self.data = State(self.storage.load())
+        self.data.stores['ledger'] = self.storage.ledger
+        self.data.stores['outbox'] = self.outbox
+        self.data.stores['history'] = self.history
+        self.data.saver = self.save_data
+        self.data.setdefault('m', {})
+        self.data.setdefault('b', {})
+        self.data.setdefault('qc', {'j': {'go': [500, 0], 'ge': [0, 180]}, 's': {'go': [100, 0], 'ge': [0, 0]}})
+        migrate_times(self.data)
+        migrate_history(self.data, self.storage.ledger)  # after migrate_times, its year comes from the state's times
 
+    def save_data(self, paths: set = None):
+        """Saves the cycle, or only the given paths of the state for a checkpoint in the middle of it. The operations of
+        a cycle's checkpoints are backed up along with the rest of the cycle, as a single delta."""
+        self.storage.ledger.sync()  # before the state, so that committed balances never lack their history
+        if paths is not None:
+            self.checkpointed += self.storage.commit(self.data, paths)
+            return
+        self.history.sync()
+        self.backups.add(self.data, self.checkpointed + self.storage.commit(self.data))
+        self.checkpointed = []
 
-def save_data():
-    with open('../data/data.json', 'w') as savefile:
-        savefile.write(json.dumps(data))
+    def start(self):
+        self.outbox.start()
+        self.scheduler = ClanScheduler(self.id)
+        self.failures = 0
+        self.stale = True  # the state is (re)loaded by the next step
 
+    def step(self) -> float:
+        """Runs a tick of the clan's scheduler and saves it, returns how many seconds to wait before the next one. A
+        failed tick is retried with a growing delay, its changes are discarded by reloading the last saved state. So is
+        a failed load (e.g. a corrupt journal or a locked state.db)."""
+        try:
+            if self.stale:
+                self.load_data()
+                self.stale = False
+            delay = self.scheduler.tick(self.data)
 
-if __name__ == '__main__':
-    while True:
+            self.save_data()
+
+            self.failures = 0
+            return delay
+        except Exception:
+            self.failures += 1
+            self.stale = True
+            LOG.exception('im dead (%s)', self.id)
+            return min(MAX_FAILURE_DELAY, (3+self.data.get('request_counter', 0)) * 2**(self.failures-1))
+
+    def run(self):
+        """Runs the clan forever, unless something outside of its cycles fails, which `supervise` restarts."""
         try:
-            load_data()
+            self.start()
+            while True:
+                sleep(self.step())
+        except Exception:
+            LOG.exception('Clan %s stopped', self.id)
+
 
-            clan_checkup(data, clan_id)
+def supervise(clan_ids: list):
+    """Runs every clan in its own thread, in its own directory, all of them sharing one request budget. The thread of
+    a clan that died is restarted after RESTART_DELAY, doubled for every restart of a thread that lived shorter than
+    MAX_FAILURE_DELAY."""
+    configure(requests_per_second=REQUESTS_PER_SECOND)
+    clans = {clan_id: Clan(clan_id, f'../data/clans/{clan_id}') for clan_id in clan_ids}
+    threads, started, restarts, due = {}, {}, {clan_id: 0 for clan_id in clan_ids}, {}
 
-            save_data()
+    def launch(clan_id: str):
+        threads[clan_id] = threading.Thread(target=clans[clan_id].run, name=clan_id, daemon=True)
+        threads[clan_id].start()
+        started[clan_id] = monotonic()
 
-            backup()
+    for clan_id in clan_ids:
+        launch(clan_id)
+    while True:
+        sleep(SUPERVISE_INTERVAL)
+        for clan_id, thread in threads.items():
+            if thread.is_alive():
+                continue
+            if clan_id not in due:
+                if monotonic() - started[clan_id] >= MAX_FAILURE_DELAY:
+                    restarts[clan_id] = 0
+                delay = min(MAX_FAILURE_DELAY, RESTART_DELAY * 2**restarts[clan_id])
+                restarts[clan_id] += 1
+                LOG.error('The thread of %s died, restarting it in %d seconds', clan_id, delay)
+                due[clan_id] = monotonic() + delay
+            elif monotonic() >= due[clan_id]:
+                del due[clan_id]
+                launch(clan_id)
 
-            sleep(1+data['request_counter'])
-        except Exception as err:
-            print('im dead', err)
-            sleep(3+data['request_counter'])
+
+def expose_metrics():
+    """Starts serving request metrics on METRICS_PORT and dumping them into METRICS_FILE."""
+    if METRICS_PORT is not None:
+        try:
+            METRICS.serve(METRICS_PORT)
+        except OSError as err:
+            LOG.warning('Metrics are not served on port %s: %s', METRICS_PORT, err)
+    METRICS.dump_periodically(METRICS_FILE, METRICS_INTERVAL)
+
+
+if __name__ == '__main__':
+    if API_KEY is None:
+        sys.exit('Put the bot\'s API key into ../data/api_key.txt')
+    logs.start()
+    expose_metrics()
+    if len(sys.argv) > 1 and sys.argv[1] == 'supervise':
+        # clans are read from clan_ids.txt (one per line) or, if there is no such file, all clans the bot is added to
+        try:
+            with open('../data/clan_ids.txt', 'r') as clidsfile:
+                ids = [line.strip() for line in clidsfile if line.strip()]
+        except FileNotFoundError:
+            ids = [clan['id'] for clan in Clans.authorized().json()]
+        supervise(ids)
+    else:
+        configure(requests_per_second=REQUESTS_PER_SECOND)
+        with open('../data/clan_id.txt', 'r') as clidfile:
+            Clan(clidfile.read(), '../data').run()
@@ -0,0 +1,151 @@
+import json
+import os
+import re
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+import logs
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds, upper bounds of the latency histogram
+ID = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+LOG = logs.get('bot')
+
+
+def endpoint_pattern(endpoint: str) -> str:
+    """Returns the endpoint with ids replaced by '{id}' and without query, e.g. 'clans/{id}/members/{id}'."""
+    return '/'.join('{id}' if ID.match(part) else part for part in endpoint.split('?')[0].strip('/').split('/'))
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.statuses = {}  # status code, or name of the exception raised instead of a response -> count
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # per bucket, not cumulative, the last one being +Inf
+        self.latency = 0.  # sum of the latencies of all attempts, seconds
+        self.bytes = 0  # of response bodies
+        self.cache_hits = 0
+
+    def snapshot(self) -> dict:
+        return {'calls': self.calls, 'retries': self.retries, 'statuses': dict(self.statuses),
+                'latency': {'buckets': dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'], self.buckets)),
+                            'sum': self.latency, 'count': sum(self.buckets)},
+                'bytes': self.bytes, 'cacheHits': self.cache_hits}
+
+
+class Metrics:
+    """
+    Request metrics of the API transport, per method and endpoint pattern.
+
+    A call is a request as the bot makes it, an attempt every time it's actually sent, so a call that was retried
+    twice counts 3 attempts: each of them has its own status and latency. Cache hits never reach the transport and
+    are counted separately.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}  # (method, endpoint pattern) -> EndpointMetrics
+
+    def get(self, method: str, endpoint: str) -> EndpointMetrics:
+        key = (method.upper(), endpoint_pattern(endpoint))
+        if key not in self.endpoints:
+            self.endpoints[key] = EndpointMetrics()
+        return self.endpoints[key]
+
+    def call(self, method: str, endpoint: str, attempts: int):
+        with self.lock:
+            metrics = self.get(method, endpoint)
+            metrics.calls += 1
+            metrics.retries += attempts - 1
+
+    def attempt(self, method: str, endpoint: str, status, seconds: float, size: int = 0):
+        """Records an attempt, `status` being the response's status code or the exception raised instead."""
+        with self.lock:
+            metrics = self.get(method, endpoint)
+            status = status if isinstance(status, int) else type(status).__name__
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            metrics.latency += seconds
+            metrics.bytes += size
+
+    def cache_hit(self, endpoint: str):
+        with self.lock:
+            self.get('GET', endpoint).cache_hits += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {f'{method} {endpoint}': m.snapshot() for (method, endpoint), m in sorted(self.endpoints.items())}
+
+    def prometheus(self) -> str:
+        """Renders the metrics in the Prometheus text exposition format."""
+        series = {'calls': [], 'retries': [], 'statuses': [], 'latency': [], 'bytes': [], 'cache_hits': []}
+        with self.lock:
+            for (method, endpoint), m in sorted(self.endpoints.items()):
+                labels = f'method="{method}",endpoint="{endpoint}"'
+                series['calls'].append(f'wolvesville_api_calls_total{{{labels}}} {m.calls}')
+                series['retries'].append(f'wolvesville_api_retries_total{{{labels}}} {m.retries}')
+                for status, count in sorted(m.statuses.items(), key=str):
+                    series['statuses'].append(f'wolvesville_api_responses_total{{{labels},status="{status}"}} {count}')
+                cumulative = 0
+                for bound, count in zip([*map(str, LATENCY_BUCKETS), '+Inf'], m.buckets):
+                    cumulative += count
+                    series['latency'].append(f'wolvesville_api_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                series['latency'].append(f'wolvesville_api_latency_seconds_sum{{{labels}}} {m.latency}')
+                series['latency'].append(f'wolvesville_api_latency_seconds_count{{{labels}}} {cumulative}')
+                series['bytes'].append(f'wolvesville_api_response_bytes_total{{{labels}}} {m.bytes}')
+                series['cache_hits'].append(f'wolvesville_api_cache_hits_total{{{labels}}} {m.cache_hits}')
+        headers = {
+            'calls': ('wolvesville_api_calls_total', 'counter', 'Requests made by the bot.'),
+            'retries': ('wolvesville_api_retries_total', 'counter', 'Requests sent again after a failed attempt.'),
+            'statuses': ('wolvesville_api_responses_total', 'counter', 'Attempts by response status or exception.'),
+            'latency': ('wolvesville_api_latency_seconds', 'histogram', 'Latency of attempts.'),
+            'bytes': ('wolvesville_api_response_bytes_total', 'counter', 'Bytes of response bodies.'),
+            'cache_hits': ('wolvesville_api_cache_hits_total', 'counter', 'GET requests served by the response cache.'),
+        }
+        lines = []
+        for key, (name, kind, description) in headers.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}', *series[key]]
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int):
+        """Serves the Prometheus text on http://127.0.0.1:<port>/metrics from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                payload = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+    def dump(self, path: str):
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(self.snapshot(), file, indent=1)
+        os.replace(f'{path}.tmp', path)
+
+    def dump_periodically(self, path: str, interval: float):
+        """Writes the metrics as JSON into `path` every `interval` seconds, from a background thread."""
+        def run():
+            while True:
+                sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError as err:
+                    LOG.warning('Metrics dump failed: %s', err)
+        threading.Thread(target=run, name='metrics dump', daemon=True).start()
+
+
+METRICS = Metrics()
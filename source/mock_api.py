@@ -0,0 +1,316 @@
+import json
+import random
+import sys
+import threading
+import uuid
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import clock
+from clock import HOUR, DAY
+
+# Local stand-in for the parts of the Wolvesville API used by api_interface, for benchmarks and manual testing. Its
+# clan lives on clock.now(), so with a ManualClock a week passes as fast as the bot can poll it.
+
+CHAT_PAGE = 30  # messages per page of clans/{id}/chat
+LEDGER_SIZE = 100  # entries returned by clans/{id}/ledger
+TIER_PROGRESS = 12 * HOUR  # time a quest tier takes to be finished
+TIER_WAIT = 12 * HOUR  # waiting time after a finished tier, can be skipped
+LAST_TIER = {False: 5, True: 7}  # last tier of gold and gem quests
+QUESTS = ('error404', 'darkeaster', 'evilchicken', 'hamster', 'pirates', 'winter', 'spooky', 'lunar')
+CHAT_LINES = ('hi', 'gg', 'lol', 'anyone up for a game?', '/balance', '/exp', '/status', '/votes', '/balance_history',
+              '/help')
+
+
+def synthetic(members: int = 45, chat_rate: float = 20, donation_rate: float = 4, activity: float = 0.5,
+              seed: int = 0) -> dict:
+    """Returns a fixture of a clan of `members` members, which send `chat_rate` chat messages and `donation_rate`
+    donations per hour, and each of whom plays `activity` games per hour, all of them on average."""
+    rng = random.Random(seed)
+    ids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(members)]
+    fixture = {
+        'clan': {'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)), 'name': 'Mock Clan', 'description': '',
+                 'xp': 0, 'language': 'GB', 'icon': '', 'iconColor': '#ffffff', 'tag': 'MC', 'joinType': 'PUBLIC',
+                 'leaderId': ids[0], 'questHistoryCount': 0, 'minLevel': 0, 'memberCount': members,
+                 'gold': 100000, 'gems': 10000, 'creationTime': '2020-01-01T00:00:00.000Z', 'minWeeklyExp': 7000},
+        'members': [{'playerId': m_id, 'username': f'player{i}', 'xp': rng.randint(0, 10**6), 'level': rng.randint(1, 500),
+                     'status': 'ACCEPTED', 'participateInClanQuests': rng.random() < 0.8} for i, m_id in enumerate(ids)],
+        'players': {m_id: {'id': m_id, 'gameStats': {
+            'achievements': [{'roleId': role, 'points': rng.randint(0, 5000), 'level': rng.randint(1, 9)}
+                             for role in ('seer', 'doctor', 'werewolf', 'jester')],
+            'totalWinCount': rng.randint(0, 10**4), 'totalLoseCount': rng.randint(0, 10**4), 'totalTieCount': 0,
+            'totalPlayTimeInMinutes': rng.randint(0, 10**5)}} for m_id in ids},
+        'chat': [],
+        'ledger': [],
+        'rates': {'chat': chat_rate, 'donations': donation_rate, 'activity': activity},
+        'seed': seed,
+    }
+    fixture['clan']['xp'] = sum(m['xp'] for m in fixture['members'])
+    return fixture
+
+
+def record(clan_id: str) -> dict:
+    """Returns a fixture of a real clan as it is now, its rates being estimated from its recent chat and ledger."""
+    from api_interface import Clans, Players
+    info = Clans.info(clan_id).json()
+    members = [m for m in Clans.members(clan_id).json() if m['status'] == 'ACCEPTED']
+    chat, ledger = Clans.chat(clan_id).json(), Clans.ledger(clan_id).json()
+
+    def rate(entries: list, key: str) -> float:  # entries per hour, newest first
+        if len(entries) < 2:
+            return 0.
+        return (len(entries) - 1) * HOUR / max(1, clock.parse(entries[0][key]) - clock.parse(entries[-1][key]))
+    donations = [e for e in ledger if e['type'] == 'DONATE']
+    return {'clan': info, 'members': members, 'players': {m['playerId']: Players.by_id(m['playerId']).json() for m in members},
+            'chat': chat[::-1], 'ledger': ledger[::-1],
+            'rates': {'chat': rate(chat, 'date'), 'donations': rate(donations, 'creationTime'), 'activity': 0.5},
+            'seed': 0}
+
+
+class MockClan:
+    """The simulated clan. Events (chat messages, donations, games played) are generated lazily up to the current
+    time whenever the clan is looked at, at the fixture's rates."""
+
+    def __init__(self, fixture: dict):
+        self.lock = threading.Lock()
+        self.rng = random.Random(fixture.get('seed', 0))
+        self.info = fixture['clan']
+        self.members = {m['playerId']: m for m in fixture['members']}
+        self.players = fixture['players']
+        self.chat = sorted(fixture['chat'], key=lambda m: m['date'])  # oldest first
+        self.chat_times = [clock.parse(m['date']) for m in self.chat]
+        self.ledger = fixture['ledger']  # oldest first
+        self.rates = fixture['rates']
+        self.available = [self.quest(name) for name in self.rng.sample(QUESTS, 4)]
+        self.active = None  # {'quest': available quest, 'claimed': time, 'skipped': time skipped}
+        self.history = []
+        self.t = clock.now()
+        while len(self.ledger) < 2:
+            self.donate(self.rng.choice(list(self.members)), 100, self.t - HOUR)
+
+    def quest(self, name: str) -> dict:
+        return {'id': str(uuid.UUID(int=self.rng.getrandbits(128), version=4)), 'rewards': [],
+                'promoImageUrl': f'https://cdn.wolvesville.com/promos/{name}.png', 'promoImagePrimaryColor': '#000000',
+                'purchasableWithGems': self.rng.random() < 0.25}
+
+    def events(self, rate: float, start: int, end: int) -> list:
+        expected = rate * (end - start) / HOUR
+        n = int(expected) + (self.rng.random() < expected % 1)
+        return sorted(self.rng.randint(start + 1, end) for _ in range(n))
+
+    def post(self, message: dict):
+        t = clock.parse(message['date'])
+        i = bisect_left(self.chat_times, t + 1)
+        self.chat.insert(i, message)
+        self.chat_times.insert(i, t)
+
+    def shuffle(self, t: int):
+        self.available = [self.quest(name) for name in self.rng.sample(QUESTS, 4)]
+        self.ledger.append({'id': str(uuid.UUID(int=self.rng.getrandbits(128), version=4)), 'playerId': None,
+                            'gold': 0, 'gems': 0, 'type': 'CLAN_QUEST_SHUFFLE', 'creationTime': clock.format(t)})
+
+    def donate(self, player_id: str, gold: int, t: int, gems: int = 0):
+        self.ledger.append({'id': str(uuid.UUID(int=self.rng.getrandbits(128), version=4)), 'playerId': player_id,
+                            'playerUsername': self.members[player_id]['username'], 'gold': gold, 'gems': gems,
+                            'type': 'DONATE', 'creationTime': clock.format(t)})
+        self.info['gold'] += gold
+        self.info['gems'] += gems
+
+    def advance(self):
+        now = clock.now()
+        if now <= self.t:
+            return
+        ids = list(self.members)
+        for t in self.events(self.rates['chat'], self.t, now):
+            self.post({'date': clock.format(t), 'playerId': self.rng.choice(ids), 'msg': self.rng.choice(CHAT_LINES),
+                       'isSystem': False})
+        for t in self.events(self.rates['donations'], self.t, now):  # mostly quest votes and joining fees
+            self.donate(self.rng.choice(ids), self.rng.choice((1, 2, 3, 4, 5, 500, 1000)), t)
+        for t in self.events(self.rates['activity'] * len(ids), self.t, now):
+            m_id = self.rng.choice(ids)
+            xp = self.rng.randint(20, 400)
+            self.members[m_id]['xp'] += xp
+            self.info['xp'] += xp
+            stats = self.players[m_id]['gameStats']
+            stats['totalWinCount' if self.rng.random() < 0.5 else 'totalLoseCount'] += 1
+            stats['totalPlayTimeInMinutes'] += self.rng.randint(5, 20)
+        tuesday = clock.midnight(now) - (clock.weekday(now) - 1) % 7 * DAY  # quests are shuffled every Tuesday
+        if self.t < tuesday <= now:
+            self.shuffle(tuesday)
+        if self.active is not None and self.tier()[0] > LAST_TIER[self.active['quest']['purchasableWithGems']]:
+            self.history.append(self.active)
+            self.info['questHistoryCount'] += 1
+            self.active = None
+        self.t = now
+
+    def tier(self):
+        """Returns the active quest's tier, whether it's finished and when it ends."""
+        elapsed = clock.now() - self.active['claimed'] + self.active['skipped']
+        tier, rest = divmod(elapsed, TIER_PROGRESS + TIER_WAIT)
+        end = clock.now() - rest + TIER_PROGRESS + TIER_WAIT
+        return tier, rest >= TIER_PROGRESS, end
+
+    def active_quest(self):
+        if self.active is None:
+            return 404, {'code': 404, 'message': 'HTTP 404 Not Found'}
+        tier, finished, end = self.tier()
+        quest = self.active['quest']
+        return 200, {'quest': dict(quest), 'xp': tier * 10000, 'xpPerReward': 10000, 'tier': tier,
+                     'tierFinished': finished, 'tierEndTime': clock.format(end), 'participants': [],
+                     'claimedTime': clock.format(self.active['claimed']),
+                     'tierStartTime': clock.format(end - TIER_PROGRESS - TIER_WAIT)}
+
+    def handle(self, method: str, path: list, query: dict, body: dict):
+        """Returns the status and JSON body of a request to the endpoint `path` (split on slashes)."""
+        with self.lock:
+            self.advance()
+            if path[0] == 'items' or path[0] in ('roleRotations', 'battlePass', 'shop'):
+                return 200, []
+            if path[0] == 'players':
+                if path[1] == 'search':
+                    matches = [m for m in self.members.values() if m['username'] == query.get('username', [''])[0]]
+                    return (200, self.players[matches[0]['playerId']]) if matches else (404, {'code': 404})
+                return (200, self.players[path[1]]) if path[1] in self.players else (404, {'code': 404})
+            if path[:2] == ['clans', 'authorized']:
+                return 200, [self.info]
+            if path[:3] == ['clans', 'quests', 'all']:
+                return 200, self.available
+            if len(path) < 3 or path[1] != self.info['id']:
+                return 404, {'code': 404}
+            endpoint = '/'.join(path[2:])
+            if endpoint == 'info':
+                return 200, self.info
+            if endpoint == 'members':
+                return 200, list(self.members.values())
+            if path[2] == 'members' and len(path) > 3 and path[3] not in self.members:
+                return 404, {'code': 404}
+            if path[2] == 'members' and len(path) == 4:
+                return 200, self.members[path[3]]
+            if path[2] == 'members' and path[4:] == ['participateInQuests']:
+                self.members[path[3]]['participateInClanQuests'] = body['participateInQuests']
+                return 200, self.members[path[3]]
+            if endpoint == 'chat' and method == 'POST':
+                self.post({'date': clock.format(clock.now()), 'msg': body['message'], 'isSystem': False})
+                return 204, None
+            if endpoint == 'chat':
+                oldest = query.get('oldest', [None])[0]
+                end = len(self.chat) if oldest is None else bisect_left(self.chat_times, clock.parse(oldest))
+                return 200, self.chat[max(0, end - CHAT_PAGE):end][::-1]
+            if endpoint == 'ledger':
+                return 200, self.ledger[:-LEDGER_SIZE-1:-1]
+            if endpoint == 'logs':
+                return 200, []
+            if endpoint == 'quests/available':
+                return 200, self.available
+            if endpoint == 'quests/available/shuffle':
+                self.shuffle(clock.now())
+                return 200, self.available
+            if endpoint == 'quests/claim':
+                quest = next((q for q in self.available if q['id'] == body['questId']), None)
+                if quest is None or self.active is not None:
+                    return 400, {'code': 400}
+                self.active = {'quest': quest, 'claimed': clock.now(), 'skipped': 0}
+                return 200, self.active_quest()[1]
+            if endpoint == 'quests/active':
+                return self.active_quest()
+            if endpoint == 'quests/active/skipWaitingTime' and self.active is not None:
+                tier, finished, end = self.tier()
+                if finished:
+                    self.active['skipped'] += end - clock.now()
+                return 200, None
+            if endpoint in ('quests/active/claimTime', 'quests/active/cancel'):
+                if endpoint.endswith('cancel'):
+                    self.active = None
+                return 200, None
+            if endpoint == 'quests/history':
+                return 200, [h['quest'] for h in self.history]
+            return 404, {'code': 404}
+
+
+class MockServer(ThreadingHTTPServer):
+    """HTTP server of a MockClan, counting the requests it serves and the bytes it receives and sends."""
+
+    daemon_threads = True
+
+    def __init__(self, clan: MockClan, port: int = 0):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.clan = clan
+        self.stats_lock = threading.Lock()
+        self.requests = {}  # 'METHOD endpoint pattern' -> count
+        self.received = 0
+        self.sent = 0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def total(self) -> int:
+        with self.stats_lock:
+            return sum(self.requests.values())
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='mock api', daemon=True).start()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the API
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def respond(self, method: str):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length) if length > 0 else b''
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            body = None
+        path = [p for p in url.path.split('/') if p]
+        status, content = self.server.clan.handle(method, path, parse_qs(url.query), body)
+        payload = b'' if content is None else json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        pattern = '/'.join('{id}' if len(p) == 36 and p.count('-') == 4 else p for p in path)
+        with self.server.stats_lock:
+            key = f'{method} {pattern}'
+            self.server.requests[key] = self.server.requests.get(key, 0) + 1
+            self.server.received += len(self.requestline) + len(str(self.headers)) + len(raw)
+            self.server.sent += len(payload)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def do_PUT(self):
+        self.respond('PUT')
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    # python mock_api.py serve [port, 8080 by default] [fixture file, a synthetic clan by default]
+    #   put http://127.0.0.1:<port>/ into ../data/api_url.txt to run the bot against it
+    # python mock_api.py record <fixture file>, records the clan in ../data/clan_id.txt from the real API
+    if len(sys.argv) > 2 and sys.argv[1] == 'record':
+        with open('../data/clan_id.txt', 'r') as clidfile:
+            recorded = record(clidfile.read().strip())
+        with open(sys.argv[2], 'w') as fixture_file:
+            json.dump(recorded, fixture_file)
+        print(f'Recorded {len(recorded["members"])} members, {len(recorded["chat"])} chat messages and '
+              f'{len(recorded["ledger"])} ledger entries into {sys.argv[2]}')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        if len(sys.argv) > 3:
+            with open(sys.argv[3], 'r') as fixture_file:
+                mock_fixture = json.load(fixture_file)
+        else:
+            mock_fixture = synthetic()
+        server = MockServer(MockClan(mock_fixture), int(sys.argv[2]) if len(sys.argv) > 2 else 8080)
+        print(f'Serving clan {mock_fixture["clan"]["id"]} at {server.url}')
+        server.serve_forever()
+    else:
+        print('usage: mock_api.py serve [port] [fixture file] | mock_api.py record <fixture file>')
@@ -0,0 +1,68 @@
+from bisect import bisect_left, insort
+
+FORMER_NAMES = 500  # amount of former members whose names are remembered
+
+
+class NameIndex:
+    """
+    Index of member names in both directions, kept up to date by the code that changes the members.
+
+    Nick lookups are case-insensitive and can fall back to a unique prefix match. Names of former members are kept in
+    `former` (a dict of id -> nick, oldest first, persisted with the state) so their ids can still be rendered, but
+    nicks are only ever resolved to current members.
+    """
+
+    def __init__(self, members: dict, former: dict):
+        self.nicks = {}  # id -> nick
+        self.ids = {}  # lowercase nick -> id
+        self.sorted = []  # lowercase nicks, sorted, for prefix lookups
+        self.former = former
+        for m_id, member in members.items():
+            self.add(m_id, member['username'])
+
+    def add(self, member_id: str, nick: str):
+        if member_id in self.nicks:
+            self.remove(member_id, keep=False)
+        self.nicks[member_id] = nick
+        if nick.lower() not in self.ids:  # taken over from a member who was renamed but isn't updated yet otherwise
+            insort(self.sorted, nick.lower())
+        self.ids[nick.lower()] = member_id
+        self.former.pop(member_id, None)
+
+    def remove(self, member_id: str, keep: bool = True):
+        """Removes a member, remembering their name among the former members' ones unless `keep` is False."""
+        nick = self.nicks.pop(member_id, None)
+        if nick is None:
+            return
+        if self.ids.get(nick.lower()) == member_id:
+            del self.ids[nick.lower()]
+            self.sorted.pop(bisect_left(self.sorted, nick.lower()))
+        if keep:
+            self.former[member_id] = nick
+            while len(self.former) > FORMER_NAMES:
+                del self.former[next(iter(self.former))]
+
+    def nick(self, member_id: str):
+        """Returns the nick of a current or former member, None if the id is unknown."""
+        if member_id in self.nicks:
+            return self.nicks[member_id]
+        return self.former.get(member_id)
+
+    def id(self, nick: str, prefix: bool = False):
+        """Returns the id of the current member with the given nick (any case), or with `prefix` the one with the only
+        nick starting with it. None if there is no such member or the prefix is ambiguous."""
+        nick = nick.lower()
+        if nick in self.ids or not prefix:
+            return self.ids.get(nick)
+        matches = self.prefixed(nick, limit=2)
+        return matches[0] if len(matches) == 1 else None
+
+    def prefixed(self, prefix: str, limit: int = None) -> list:
+        """Returns ids of current members whose nicks start with `prefix` (any case), in alphabetical order."""
+        prefix = prefix.lower()
+        ids = []
+        i = bisect_left(self.sorted, prefix)
+        while i < len(self.sorted) and self.sorted[i].startswith(prefix) and (limit is None or len(ids) < limit):
+            ids.append(self.ids[self.sorted[i]])
+            i += 1
+        return ids
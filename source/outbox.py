@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+from time import sleep
+import requests
+from api_interface import Clans, RequestBudget, never_sent
+import clock
+from clock import HOUR
+import logs
+
+MESSAGE_LIMIT = 250  # characters per chat message
+SEND_RATE = 0.5  # chat messages per second, per clan
+SEND_BURST = 3
+RETRY_DELAY = 30  # seconds before a message that never reached the API (refused connection, connect timeout or 429) is tried again
+STALE_AFTER = HOUR  # messages that couldn't be sent for this long are dropped
+CHAT = logs.get('chat')
+
+
+def split(text: str):
+    """Cuts a text too long for a single message at its last line break that fits, or at the limit with '...' marks if
+    there is none, returns the head and the rest."""
+    cut = text.rfind('\n', 0, MESSAGE_LIMIT + 1)
+    if cut <= 0:
+        return text[:MESSAGE_LIMIT-3] + '...', '...' + text[MESSAGE_LIMIT-3:]
+    return text[:cut], text[cut+1:]
+
+
+class Outbox:
+    """
+    Queue of a clan's chat messages, sent by a background thread so that the checkup loop never waits for the chat.
+
+    Adjacent messages are merged into as few chat messages as fit into MESSAGE_LIMIT characters, longer ones are split
+    on line boundaries. Sending is limited to SEND_RATE messages per second. Pending messages are kept in a file and
+    survive restarts, those that stayed unsent for STALE_AFTER are dropped. A message queued with a `key` replaces the
+    pending one with the same key, e.g. an outdated reminder.
+    """
+
+    def __init__(self, clan_id: str, path: str = None, rate: float = SEND_RATE):
+        self.clan_id = clan_id
+        self.path = path
+        self.budget = RequestBudget(rate, SEND_BURST)
+        self.condition = threading.Condition()
+        self.pending = []  # [{'t': time queued, 'text': text, 'key': key or None}], oldest first
+        self.thread = None
+        if path is None:
+            return
+        try:
+            with open(path, 'r') as file:
+                self.pending = json.load(file)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def put(self, text: str, key: str = None):
+        with self.condition:
+            if key is not None:
+                self.pending = [m for m in self.pending if m['key'] != key]
+            self.pending.append({'t': clock.now(), 'text': text, 'key': key})
+            self.save()
+            self.condition.notify()
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(f'{self.path}.tmp', 'w') as file:
+            json.dump(self.pending, file)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=f'{threading.current_thread().name} chat', daemon=True)
+            self.thread.start()
+
+    def next(self):
+        """Waits for pending messages, returns the next chat message and the pending messages it covers, the last
+        of which is only covered up to the returned remainder (None if it's covered whole)."""
+        with self.condition:
+            while True:
+                now = clock.now()
+                stale = [m for m in self.pending if now - m['t'] >= STALE_AFTER]
+                if len(stale) > 0:
+                    self.pending = [m for m in self.pending if now - m['t'] < STALE_AFTER]
+                    self.save()
+                    CHAT.warning('Dropped %d stale chat message(s) of %s', len(stale), self.clan_id)
+                if len(self.pending) > 0:
+                    break
+                self.condition.wait()
+            text, used = self.pending[0]['text'], [self.pending[0]]
+            if len(text) > MESSAGE_LIMIT:
+                head, rest = split(text)
+                return head, used, rest
+            for m in self.pending[1:]:
+                if len(text) + 1 + len(m['text']) > MESSAGE_LIMIT:
+                    break
+                text += '\n' + m['text']
+                used.append(m)
+            return text, used, None
+
+    def done(self, used: list, rest: str):
+        with self.condition:
+            if rest is not None:
+                used[-1]['text'] = rest
+                used = used[:-1]
+            self.pending = [m for m in self.pending if all(m is not u for u in used)]
+            self.save()
+
+    def run(self):
+        while True:
+            message, used, rest = self.next()
+            self.budget.acquire()
+            try:
+                status = Clans.send_message(self.clan_id, message).status_code
+            except requests.RequestException as err:
+                status = err
+            if status == 429 or (isinstance(status, Exception) and never_sent(status)):
+                CHAT.warning('Sending a chat message to %s failed (%s), retrying in %d seconds', self.clan_id, status, RETRY_DELAY)
+                sleep(RETRY_DELAY)
+                continue
+            # any other failure may have been sent all the same, it's dropped rather than risking a duplicate message
+            if isinstance(status, Exception) or status >= 400:
+                CHAT.error('Sending a chat message to %s failed (%s), dropped %d queued message(s)', self.clan_id, status, len(used))
+            else:
+                CHAT.info('Sent %d queued message(s) of %s as one chat message of %d characters', len(used), self.clan_id, len(message))
+            self.done(used, rest)
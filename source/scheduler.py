@@ -0,0 +1,96 @@
+from clanfuncs import start_cycle, manage, next_deadline, resume, update_info, update_chat, update_ledger, \
+    update_current_quest, update_available_quests
+from events import handles, TierFinished
+import clock
+from clock import SECOND, DAY
+
+SPEEDUP = 0.25  # interval multiplier after a poll that found changes
+SLOWDOWN = 1.5  # interval multiplier after a poll that found nothing
+MIN_SLEEP = 1  # seconds
+MAX_SLEEP = 60  # seconds, the loop wakes up at least this often
+SHUFFLE_POLL = 60  # seconds between polls of the available quests on Tuesdays until the weekly shuffle is seen
+
+
+class Poller:
+    """
+    Something polled on its own interval.
+
+    `poll` takes the state and returns whether it found any changes. The interval shrinks towards `min_interval`
+    after changes and grows towards `max_interval` while nothing changes, so busy parts of the clan are polled more
+    often than quiet ones.
+    """
+
+    def __init__(self, name: str, poll, min_interval: float, max_interval: float):
+        self.name = name
+        self.poll = poll
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.due = 0.
+        self.until = 0.  # see slow_until
+
+    def run(self, data: dict, now: float):
+        changed = self.poll(data)
+        if changed:
+            self.interval = max(self.min_interval, self.interval * SPEEDUP)
+        else:
+            self.interval = min(self.max_interval, self.interval * SLOWDOWN)
+        self.due = now + self.interval
+        if self.until > now:
+            self.interval = self.max_interval
+            self.due = min(now + self.interval, self.until)
+
+    def wake(self, at: float):
+        """Makes sure the poller runs no later than `at`."""
+        self.due = min(self.due, at)
+
+    def slow_until(self, at: float):
+        """Polls on the longest interval until `at` and right at `at`, as nothing is expected to change before."""
+        self.until = at
+        self.interval = self.max_interval
+        self.wake(at)
+
+
+class ClanScheduler:
+    """Runs the pollers of a clan when they are due, and the stages of the clan management (see clanfuncs.manage)
+    that the polled changes woke or whose deadlines came."""
+
+    def __init__(self, clan_id: str):
+        self.pollers = {p.name: p for p in (
+            Poller('info', lambda data: update_info(data, clan_id), 5, 60),
+            Poller('chat', update_chat, 2, 30),
+            Poller('ledger', update_ledger, 600, 3600),  # also fetched by info whenever gold or gems change
+            Poller('currentQuest', update_current_quest, 30, 900),
+            Poller('availableQuests', lambda data: update_available_quests(data, shuffled=False), 3600, 6 * 3600),
+        )}
+        self.resumed = False
+
+    def tick(self, data: dict) -> float:
+        """Runs everything that is due and returns how many seconds to sleep before the next tick."""
+        start_cycle(data)
+        data.stores['scheduler'] = self
+        if not self.resumed:
+            resume(data)
+            self.resumed = True
+        now = clock.now() / SECOND
+        for poller in self.pollers.values():
+            if poller.due <= now:
+                poller.run(data, now)
+        manage(data)
+
+        available = self.pollers['availableQuests']
+        today = clock.midnight(clock.now())
+        if clock.weekday(today) == 1 and clock.midnight(data.get('availableQuestsLastUpdate', today)) != today:
+            available.wake(now + SHUFFLE_POLL)  # the vote waits for the weekly shuffle, which isn't seen yet
+        else:
+            available.wake((today + ((1 - clock.weekday(today)) % 7 or 7) * DAY) / SECOND)  # next Tuesday midnight
+        deadline = next_deadline(data) / SECOND
+        wakeup = min(min(p.due for p in self.pollers.values()), deadline, now + MAX_SLEEP)
+        return max(MIN_SLEEP, wakeup - clock.now() / SECOND)
+
+
+@handles(TierFinished)
+def sleep_until_tier_end(data: dict, event: TierFinished):
+    """Nothing happens to a quest whose tier is finished until the next one starts."""
+    if 'scheduler' in data.stores:
+        data.stores['scheduler'].pollers['currentQuest'].slow_until(event.tier_end / SECOND)
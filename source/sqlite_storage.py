@@ -0,0 +1,224 @@
+import json
+import sqlite3
+import sys
+import clock
+from balances import LEGACY_TIMES
+from state import State
+from storage import Storage, units
+
+CURSORS = ('lastChatUpdate', 'lastLedgerUpdate', 'availableQuestsLastUpdate', 'lastWeeklyExpCheck')
+MEMBER_COLUMNS = ('username', 'xp', 'level', 'participateInClanQuests')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS members (
+    id TEXT PRIMARY KEY,
+    username TEXT,
+    xp INTEGER,
+    level INTEGER,
+    participateInClanQuests INTEGER,
+    extra TEXT NOT NULL  -- JSON of the remaining fields of the member
+);
+CREATE INDEX IF NOT EXISTS members_username ON members (username COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS player_stats (
+    member_id TEXT NOT NULL,
+    stat TEXT NOT NULL,  -- gameStats key, 'achievements.<roleId>' for role points
+    value,
+    PRIMARY KEY (member_id, stat)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS balances (
+    member_id TEXT PRIMARY KEY,
+    gold INTEGER NOT NULL,
+    gems INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS balance_events (
+    id INTEGER PRIMARY KEY,
+    t INTEGER NOT NULL,  -- epoch milliseconds
+    member_id TEXT NOT NULL,
+    gold INTEGER NOT NULL,
+    gems INTEGER NOT NULL,
+    reason TEXT NOT NULL,
+    counterparty TEXT
+);
+CREATE INDEX IF NOT EXISTS balance_events_member_t ON balance_events (member_id, t);
+CREATE TABLE IF NOT EXISTS votes (
+    member_id TEXT PRIMARY KEY,
+    quest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    name TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL  -- JSON
+);
+'''
+
+
+def stat_rows(member: dict) -> dict:
+    """Returns the player_stats rows of a member, {stat: value}."""
+    game_stats = member.get('p', {}).get('gameStats', {})
+    rows = {s: v for s, v in game_stats.items() if s != 'achievements'}
+    rows.update((f'achievements.{r}', v) for r, v in game_stats.get('achievements', {}).items())
+    return rows
+
+
+class SqliteBalanceLedger:
+    """Balance ledger (see balances.BalanceLedger) kept in the balance_events table. Appended events are part of the
+    open transaction, which SqliteStorage.commit commits together with the state."""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def append(self, member_id: str, gold: int, gems: int, reason: str, counterparty: str = None, t: float = None):
+        self.connection.execute('INSERT INTO balance_events (t, member_id, gold, gems, reason, counterparty) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (clock.now() if t is None else int(t), member_id, gold, gems, reason, counterparty))
+
+    def sync(self):
+        pass  # committed along with the state
+
+    def discard(self):
+        self.connection.rollback()
+
+    def history(self, member_id: str, page: int = 1, per_page: int = 10, since: float = None,
+                until: float = None) -> list:
+        rows = self.connection.execute(
+            'SELECT t, member_id, gold, gems, reason, counterparty FROM balance_events '
+            'WHERE member_id = ? AND t >= ? AND t < ? ORDER BY t DESC, id DESC LIMIT ? OFFSET ?',
+            (member_id, -2**62 if since is None else since, 2**62 if until is None else until, per_page,
+             (page - 1) * per_page))
+        return [tuple(row) for row in rows]
+
+    def count(self, member_id: str) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM balance_events WHERE member_id = ?',
+                                       (member_id, )).fetchone()[0]
+
+
+class SqliteStorage(Storage):
+    """
+    Storage backend keeping the state in SQLite tables.
+
+    Members, their game stats, balances, balance events, quest votes and cursors have tables of their own, the rest
+    of the state (clan info, quests, quest manager...) is kept as JSON per top-level key. A commit rewrites only the
+    rows of the units that changed, in a single transaction together with the balance events appended since the
+    previous one.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.connection = sqlite3.connect(path, check_same_thread=False)  # used by one clan thread at a time
+        self.connection.executescript(SCHEMA)
+        with self.connection:  # balance event times of older databases are in seconds
+            self.connection.execute('UPDATE balance_events SET t = t * ? WHERE t < ?', (clock.SECOND, LEGACY_TIMES))
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.ledger = SqliteBalanceLedger(self.connection)
+
+    def load(self) -> dict:
+        c = self.connection
+        data = {key: json.loads(value) for key, value in c.execute('SELECT key, value FROM state')}
+        data.update(c.execute('SELECT name, value FROM cursors'))
+        if isinstance(data.get('qm'), dict) and 'votes' in data['qm']:
+            data['qm']['votes'] = dict(c.execute('SELECT member_id, quest FROM votes'))
+        data['m'] = {}
+        for m_id, username, xp, level, participate, extra in c.execute('SELECT * FROM members'):
+            data['m'][m_id] = {'username': username, 'xp': xp, 'level': level,
+                               'participateInClanQuests': bool(participate), **json.loads(extra)}
+        for m_id, stat, value in c.execute('SELECT member_id, stat, value FROM player_stats'):
+            stats = data['m'][m_id]['p']['gameStats']
+            if stat.startswith('achievements.'):
+                stats['achievements'][stat[13:]] = value
+            else:
+                stats[stat] = value
+        data['b'] = {m_id: {'go': gold, 'ge': gems} for m_id, gold, gems in c.execute('SELECT * FROM balances')}
+        self.track(data)
+        return data
+
+    def commit(self, data: dict, paths: set = None) -> list:
+        """Writes the rows of the units changed since the last commit (only those of `paths` for a checkpoint) and
+        commits them with the pending balance events, returns the changes."""
+        ops = self.changes(data, paths)
+        if isinstance(data, State) and paths is None:
+            data.clean()
+        with self.connection:
+            for op in ops:
+                self.write(op)
+        self.persist(ops)
+        return ops
+
+    def write(self, op: list):
+        c = self.connection
+        section, key = op[1][0], op[1][-1]
+        if section == 'm':
+            if op[0] == 'del':
+                c.execute('DELETE FROM player_stats WHERE member_id = ?', (key, ))
+                c.execute('DELETE FROM members WHERE id = ?', (key, ))
+                return
+            extra = {k: v for k, v in op[2].items() if k not in MEMBER_COLUMNS}
+            if 'p' in extra and 'gameStats' in extra['p']:
+                extra['p'] = {**extra['p'], 'gameStats': {'achievements': {}}}
+            c.execute('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET username = '
+                      'excluded.username, xp = excluded.xp, level = excluded.level, participateInClanQuests = '
+                      'excluded.participateInClanQuests, extra = excluded.extra',  # unlike a REPLACE, keeps the index
+                      (key, *(op[2].get(col) for col in MEMBER_COLUMNS), json.dumps(extra)))
+            # only the stats that changed since the member was last persisted are written
+            old, new = stat_rows(self.persisted.get(('m', key), {})), stat_rows(op[2])
+            c.executemany('DELETE FROM player_stats WHERE member_id = ? AND stat = ?',
+                          [(key, s) for s in old if s not in new])
+            c.executemany('INSERT INTO player_stats VALUES (?, ?, ?) '
+                          'ON CONFLICT (member_id, stat) DO UPDATE SET value = excluded.value',
+                          [(key, s, v) for s, v in new.items() if s not in old or old[s] != v])
+        elif section == 'b':
+            if op[0] == 'del':
+                c.execute('DELETE FROM balances WHERE member_id = ?', (key, ))
+            else:
+                c.execute('INSERT OR REPLACE INTO balances VALUES (?, ?, ?)', (key, op[2]['go'], op[2]['ge']))
+        elif section in CURSORS:
+            if op[0] == 'del':
+                c.execute('DELETE FROM cursors WHERE name = ?', (key, ))
+            else:
+                c.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?)', (key, op[2]))
+        else:
+            if section == 'qm':
+                c.execute('DELETE FROM votes')
+            if op[0] == 'del':
+                c.execute('DELETE FROM state WHERE key = ?', (key, ))
+                return
+            value = op[2]
+            if section == 'qm' and isinstance(value, dict) and 'votes' in value:
+                c.executemany('INSERT INTO votes VALUES (?, ?)', value['votes'].items())
+                value = {**value, 'votes': None}
+            c.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, json.dumps(value)))
+
+
+def migrate(directory: str):
+    """Imports the state kept by the JSON journal (data.json, data.journal and balances.jsonl) of a directory into
+    its state.db, which the bot uses instead from then on."""
+    from journal import Journal
+    from balances import migrate_history
+    from clock import migrate_times
+    journal = Journal(directory)
+    data = State(journal.load())
+    data.pop('balancesSize', None)  # the journal's own bookkeeping, balance events are committed with the state here
+    migrate_times(data)
+    if 'b' in data:
+        migrate_history(data, journal.ledger)
+    storage = SqliteStorage(f'{directory}/state.db')
+    with storage.connection:  # replaces whatever the database held, so that nothing outside of the journal survives
+        for table in ('members', 'player_stats', 'balances', 'balance_events', 'votes', 'cursors', 'state'):
+            storage.connection.execute(f'DELETE FROM {table}')
+        for op in [['set', list(path), v] for path, v in units(data)]:
+            storage.write(op)
+        for events in journal.ledger.events.values():
+            for event in events:
+                storage.ledger.append(event[1], event[2], event[3], event[4], event[5], event[0])
+    print(f'Imported {len(data.get("m", {}))} members, {len(data.get("b", {}))} balances and '
+          f'{sum(len(e) for e in journal.ledger.events.values())} balance events into {directory}/state.db')
+
+
+if __name__ == '__main__':
+    # python sqlite_storage.py migrate [directory of the clan, ../data by default]
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        migrate(sys.argv[2] if len(sys.argv) > 2 else '../data')
+    else:
+        print('usage: sqlite_storage.py migrate [directory]')
@@ -0,0 +1,71 @@
+VOLATILE = ('request_counter', )  # per-cycle keys that don't make a cycle dirty
+EVERYTHING = ()  # dirty path meaning that anything may have changed
+
+
+class State(dict):
+    """
+    The clan state, a dict that records which parts of it were touched since the last `clean()`.
+
+    Assigning or deleting top-level keys is recorded automatically. Changes made deeper inside have to be reported
+    with `touch()`, e.g. `data.touch('b', player_id)` after changing a balance or `data.touch('qm')` after changing
+    the quest manager's state in place. Touched paths are only a hint of what may have changed, consumers still
+    compare the values themselves.
+
+    `derived` holds structures built from the state (indexes and such), which are never persisted. `stores` holds
+    the stores that keep parts of the clan's data outside of the dict (e.g. the balance ledger), they are attached and
+    persisted by the owner of the state. `saver`, if the owner sets it, durably saves the given paths of the state on
+    `checkpoint()`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+        self.batch = set()  # paths touched since the last mark(), checkpoint() or clean()
+        self.derived = {}
+        self.stores = {}
+        self.saver = None
+
+    def mark(self):
+        """Starts a batch of changes, e.g. the handling of a few chat commands, that `checkpoint()` saves."""
+        self.batch = set()
+
+    def checkpoint(self):
+        """Durably saves the units touched since `mark()` in the middle of a cycle, so that e.g. handled chat commands
+        and the chat cursor are saved together. The rest of the cycle is only saved once it ends."""
+        if self.saver is not None:
+            self.saver(self.batch)
+        self.batch = set()
+
+    def touch(self, *path):
+        """Marks a path as possibly changed, no path meaning the whole state (which also drops derived structures)."""
+        if len(path) == 0:
+            self.derived.clear()
+        if len(path) == 0 or path[0] not in VOLATILE:
+            self.dirty.add(path)
+            self.batch.add(path)
+
+    def clean(self):
+        self.dirty = set()
+        self.batch = set()
+
+    def __setitem__(self, key, value):
+        self.touch(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.touch(key)
+        super().__delitem__(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            self.touch(key)
+        return super().pop(key, *default)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
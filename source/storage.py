@@ -0,0 +1,102 @@
+import copy
+from abc import ABC, abstractmethod
+from state import State, EVERYTHING
+
+SPLIT_SECTIONS = ('m', 'b')  # sections stored per member instead of as a whole
+
+
+def units(data: dict):
+    """
+    Yields the units of the state that are stored separately.
+
+    Every top-level key is a unit, except for the sections in SPLIT_SECTIONS, whose entries are units of their own.
+
+    :param data: The state
+    :type data: dict
+    :return: Pairs of (path, value), path being a tuple of keys
+    """
+    for k, v in data.items():
+        if k in SPLIT_SECTIONS and isinstance(v, dict):
+            for sub_k, sub_v in v.items():
+                yield (k, sub_k), sub_v
+        else:
+            yield (k, ), v
+
+
+def apply(data: dict, ops: list):
+    """Applies operations ['set', path, value] and ['del', path] to the state."""
+    for op in ops:
+        *parents, key = op[1]
+        target = data
+        for k in parents:
+            target = target.setdefault(k, {})
+        if op[0] == 'set':
+            target[key] = op[2]
+        else:
+            target.pop(key, None)
+
+
+class Storage(ABC):
+    """
+    Interface of the storage backends of the clan state.
+
+    `load()` returns the stored state and `commit()` durably stores the changes made to it since the previous call
+    (only those of the given paths of a State, for a checkpoint), returning them as operations (['set', path, value]
+    or ['del', path], see `apply()`). Backends only store the units that changed: for a State, only the touched units
+    are even compared. Every backend also provides a balance ledger as `ledger`, see balances.BalanceLedger for its
+    interface.
+    """
+
+    def __init__(self):
+        self.persisted = {}  # path -> copy of the unit as it was last persisted
+
+    @abstractmethod
+    def load(self) -> dict:
+        pass
+
+    @abstractmethod
+    def commit(self, data: dict, paths: set = None) -> list:
+        pass
+
+    def track(self, data: dict):
+        """Remembers `data` as the persisted state."""
+        self.persisted = {path: copy.deepcopy(v) for path, v in units(data)}
+
+    def changes(self, data: dict, paths: set = None) -> list:
+        """Returns the operations that bring the persisted state up to date with `data`.\n
+        For a State, only its touched paths (or `paths`) are compared, everything is compared for a plain dict."""
+        paths = data.dirty if paths is None and isinstance(data, State) else paths
+        if paths is None or EVERYTHING in paths:
+            candidates, removable = list(units(data)), list(self.persisted)
+        else:
+            candidates, removable = [], []
+            for path in paths:
+                if path[0] not in data:
+                    removable += [p for p in self.persisted if p[0] == path[0]]
+                elif path[0] in SPLIT_SECTIONS and isinstance(data[path[0]], dict):
+                    if len(path) == 1:  # the whole section was replaced
+                        candidates += [((path[0], k), v) for k, v in data[path[0]].items()]
+                        removable += [p for p in self.persisted if p[0] == path[0] and p[1] not in data[path[0]]]
+                    elif path[1] in data[path[0]]:
+                        candidates.append((path[:2], data[path[0]][path[1]]))
+                    else:
+                        removable.append(path[:2])
+                else:
+                    candidates.append(((path[0], ), data[path[0]]))
+        ops, current = [], set()
+        for path, v in candidates:
+            if path not in current and (path not in self.persisted or self.persisted[path] != v):
+                ops.append(['set', list(path), v])
+            current.add(path)
+        for path in set(removable):
+            if path in self.persisted and path not in current:
+                ops.append(['del', list(path)])
+        return ops
+
+    def persist(self, ops: list):
+        """Remembers that `ops` were persisted."""
+        for op in ops:
+            if op[0] == 'set':
+                self.persisted[tuple(op[1])] = copy.deepcopy(op[2])
+            else:
+                del self.persisted[tuple(op[1])]
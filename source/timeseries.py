@@ -0,0 +1,255 @@
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left
+import clock
+
+# The file is a sequence of records made of unsigned LEB128 varints:
+#   DEFINE_MEMBER, length, utf-8 id         gives the next member index to a member id
+#   DEFINE_STAT, length, utf-8 name         gives the next stat index to a stat name
+#   SNAPSHOT, member, dt, n, (stat, dv) * n the n stats of a member that changed at a time
+# dt is the time in seconds since the previous snapshot of the file (which is never earlier), dv is the zigzag encoded
+# difference to the stat's previous value, so a snapshot of a few growing counters takes a handful of bytes.
+DEFINE_MEMBER, DEFINE_STAT, SNAPSHOT = 0, 1, 2
+
+
+def zigzag(n: int) -> int:
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def unzigzag(n: int) -> int:
+    return -((n + 1) >> 1) if n & 1 else n >> 1
+
+
+def put(out: bytearray, n: int):
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def take(buffer, i: int) -> tuple:
+    """Returns the varint at `i` and the position after it."""
+    n = shift = 0
+    while True:
+        byte = buffer[i]
+        i += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, i
+        shift += 7
+
+
+def flatten(values: dict, prefix: str = '') -> dict:
+    """Returns the integer values of nested dicts by dotted path, e.g. {'achievements.SEER': 120, 'totalWinCount': 50}."""
+    flat = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, int) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+class TimeSeries:
+    """
+    History of member stats (xp, level, game stats), one series per member and stat.
+
+    Every series is a pair of typed arrays (times in seconds, values), so a range is a slice and a point in time a
+    bisection: querying months of a member takes microseconds. Only the stats that changed since a member's previous
+    snapshot are recorded, delta and varint encoded into an append-only file, which is memory-mapped to be read back.
+    Like the balance ledger, recorded points are pending until `sync()` writes them or `discard()` drops them along
+    with the rest of a failed cycle. Without a path, nothing is persisted.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.clear()
+        self.pending, self.pending_points = bytearray(), []
+        self.synced = (0, 0, 0)  # members, stats and last time as of the last sync, for discard
+        self.file = None
+        if path is None:
+            return
+        valid = 0
+        try:
+            with open(path, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                if size > 0:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                        valid = self.decode(buffer, size)
+            if valid != size:  # torn write of the last cycle, everything after it is discarded
+                os.truncate(path, valid)
+        except FileNotFoundError:
+            pass
+        self.synced = (len(self.members), len(self.stats), self.last)
+        self.file = open(path, 'ab')
+
+    def clear(self):
+        self.members, self.member_index = [], {}  # member ids by index and the other way around
+        self.stats, self.stat_index = [], {}
+        self.series = {}  # (member index, stat index) -> (times, values), oldest first
+        self.last = 0  # time of the latest snapshot
+
+    def decode(self, buffer, size: int) -> int:
+        """Loads the records of the buffer, returns the size of its valid part."""
+        i = valid = 0
+        try:
+            while i < size:
+                kind, i = take(buffer, i)
+                if kind == SNAPSHOT:
+                    member, i = take(buffer, i)
+                    dt, i = take(buffer, i)
+                    n, i = take(buffer, i)
+                    self.last += dt
+                    for _ in range(n):
+                        stat, i = take(buffer, i)
+                        dv, i = take(buffer, i)
+                        times, values = self.series.setdefault((member, stat), (array('q'), array('q')))
+                        times.append(self.last)
+                        values.append((values[-1] if len(values) > 0 else 0) + unzigzag(dv))
+                else:
+                    length, i = take(buffer, i)
+                    if i + length > size:
+                        break
+                    name = bytes(buffer[i:i+length]).decode('utf-8')
+                    i += length
+                    names, index = (self.members, self.member_index) if kind == DEFINE_MEMBER else (self.stats, self.stat_index)
+                    index[name] = len(names)
+                    names.append(name)
+                valid = i
+        except IndexError:  # record cut short
+            pass
+        if valid < i:  # the points of the torn snapshot were loaded, drop them by reloading the valid part
+            self.clear()
+            self.decode(buffer, valid)
+        return valid
+
+    def index(self, names: list, index: dict, kind: int, name: str) -> int:
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+            encoded = name.encode('utf-8')
+            put(self.pending, kind)
+            put(self.pending, len(encoded))
+            self.pending += encoded
+        return index[name]
+
+    def record(self, member_id: str, values: dict, t: int = None) -> dict:
+        """Records a member's stats (name -> int) at a time in seconds, now by default. Only changed ones are stored,
+        returns how much those that were already recorded changed (name -> difference)."""
+        t = max(self.last, clock.now() // clock.SECOND if t is None else int(t))
+        member = self.index(self.members, self.member_index, DEFINE_MEMBER, member_id)
+        changes, differences = [], {}
+        for name, value in values.items():
+            stat = self.stat_index.get(name)
+            series = self.series.get((member, stat))
+            if series is not None and series[1][-1] == value:
+                continue
+            stat = self.index(self.stats, self.stat_index, DEFINE_STAT, name)
+            times, points = self.series.setdefault((member, stat), (array('q'), array('q')))
+            changes.append((stat, value - (points[-1] if len(points) > 0 else 0)))
+            if len(points) > 0:
+                differences[name] = value - points[-1]
+            times.append(t)
+            points.append(value)
+            self.pending_points.append((member, stat))
+        if len(changes) == 0:
+            return differences
+        put(self.pending, SNAPSHOT)
+        put(self.pending, member)
+        put(self.pending, t - self.last)
+        put(self.pending, len(changes))
+        for stat, dv in changes:
+            put(self.pending, stat)
+            put(self.pending, zigzag(dv))
+        self.last = t
+        return differences
+
+    def sync(self):
+        """Makes pending points durable."""
+        if self.file is not None and len(self.pending) > 0:
+            self.file.write(self.pending)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.pending, self.pending_points = bytearray(), []
+        self.synced = (len(self.members), len(self.stats), self.last)
+
+    def discard(self):
+        """Forgets pending points."""
+        for key in self.pending_points:
+            times, values = self.series[key]
+            times.pop()
+            values.pop()
+            if len(times) == 0:
+                del self.series[key]
+        members, stats, self.last = self.synced
+        for name in self.members[members:]:
+            del self.member_index[name]
+        for name in self.stats[stats:]:
+            del self.stat_index[name]
+        del self.members[members:], self.stats[stats:]
+        self.pending, self.pending_points = bytearray(), []
+
+    def get(self, member_id: str, stat: str) -> tuple:
+        """Returns the times and values of a series, empty arrays if it has no point."""
+        series = self.series.get((self.member_index.get(member_id), self.stat_index.get(stat)))
+        return series if series is not None else (array('q'), array('q'))
+
+    def names(self, member_id: str) -> list:
+        """Returns the stats recorded for a member."""
+        member = self.member_index.get(member_id)
+        return [self.stats[stat] for m, stat in self.series if m == member]
+
+    def at(self, member_id: str, stat: str, t: int):
+        """Returns a stat's value at a time, None if it wasn't recorded yet."""
+        times, values = self.get(member_id, stat)
+        i = bisect_left(times, t + 1)
+        return values[i-1] if i > 0 else None
+
+    def range(self, member_id: str, stat: str, since: int = None, until: int = None) -> tuple:
+        """Returns the times and values of a series in the time range [since, until)."""
+        times, values = self.get(member_id, stat)
+        start = 0 if since is None else bisect_left(times, since)
+        end = len(times) if until is None else bisect_left(times, until)
+        return times[start:end], values[start:end]
+
+    def downsample(self, member_id: str, stat: str, since: int, until: int, step: int, how: str = 'last') -> list:
+        """
+        Returns (start, value) for every bucket [start, start + step) of the time range [since, until).
+
+        :param how: 'last' for the value at the end of the bucket, 'increase' for how much it grew during the bucket
+            (xp per day and such), 'min', 'max' or 'mean' of the points in the bucket, None for a bucket without any
+        """
+        times, values = self.get(member_id, stat)
+        buckets = []
+        end = bisect_left(times, since)
+        for start in range(since, until, step):
+            first, end = end, bisect_left(times, min(start + step, until), end)
+            if how == 'last':
+                buckets.append((start, values[end-1] if end > 0 else None))
+            elif how == 'increase':
+                before = values[first-1] if first > 0 else values[first] if first < end else 0
+                buckets.append((start, values[end-1] - before if end > 0 else 0))
+            elif first == end:
+                buckets.append((start, None))
+            elif how == 'mean':
+                buckets.append((start, sum(values[first:end]) / (end - first)))
+            else:
+                buckets.append((start, {'min': min, 'max': max}[how](values[first:end])))
+        return buckets
+
+
+if __name__ == '__main__':
+    # prints how much a stat of a member grew every day of the last days:
+    #   python timeseries.py <member id> [stat] [days] [history file]
+    if len(sys.argv) < 2:
+        print('usage: timeseries.py <member id> [stat, default xp] [days, default 30] [file, default ../data/history.bin]')
+        sys.exit(1)
+    history = TimeSeries(sys.argv[4] if len(sys.argv) > 4 else '../data/history.bin')
+    today = clock.midnight(clock.now()) // clock.SECOND
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    stat_name = sys.argv[2] if len(sys.argv) > 2 else 'xp'
+    day = clock.DAY // clock.SECOND
+    for bucket, increase in history.downsample(sys.argv[1], stat_name, today - (days-1) * day, today + day, day, 'increase'):
+        print(f'{clock.format(bucket * clock.SECOND)[:10]} {increase}')